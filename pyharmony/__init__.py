@@ -1 +1,3 @@
 from .pyharmony import *
+from .codematcher import ANY, CodeMatch, CodeMatcher
+from .state import StateObject, StateView
@@ -0,0 +1,622 @@
+"""
+Contains the version-aware building blocks used to generate patched code.
+
+Each function returns the instructions for a single operation in the form the running version of Python expects, so the
+patch assemblers can be written once. On Python 3.11+ the output follows what CPython's own compiler emits for the same
+operation (PUSH_NULL/CALL pairs, forward jumps, exception tables), which keeps patched functions in a shape the specializing
+adaptive interpreter can quicken. On older versions it is identical to what pyHarmony has always generated.
+"""
+
+import dis
+import inspect
+import sys
+import types
+from typing import Dict, Iterable, List, Tuple
+from bytecode import Bytecode, CellVar, Compare, FreeVar, Instr, Label, TryBegin, TryEnd
+from . import opcodes
+
+PY39 = sys.version_info >= (3, 9)
+PY311 = sys.version_info >= (3, 11)
+PY312 = sys.version_info >= (3, 12)
+PY313 = sys.version_info >= (3, 13)
+
+if PY311:
+    from bytecode import BinaryOp
+
+if PY312:
+    from bytecode import Intrinsic1Op
+
+_GENERATOR_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+
+# MAKE_FUNCTION (or SET_FUNCTION_ATTRIBUTE) flag for a tuple of closure cells
+_MAKE_FUNCTION_CLOSURE = 0x08
+
+# Set in the argument of a RESUME after a yield, if the yield is only inside of the try block that wraps every generator (Python 3.13+)
+_RESUME_DEPTH1_MASK = 0x04
+
+# Instructions that can appear before the RESUME of a Python 3.11+ function
+_PROLOGUE_OPCODES = frozenset((opcodes.COPY_FREE_VARS, opcodes.MAKE_CELL, opcodes.RETURN_GENERATOR, opcodes.POP_TOP, opcodes.NOP))
+
+_BINARY_OPERATORS = {
+    "+": (opcodes.BINARY_ADD, "ADD"),
+    "-": (opcodes.BINARY_SUBTRACT, "SUBTRACT"),
+    "%": (opcodes.BINARY_MODULO, "REMAINDER"),
+}
+
+_COMPARE_OPERATORS = {
+    "==": Compare.EQ,
+    "<": Compare.LT,
+    ">=": Compare.GE,
+}
+
+# Local variable instructions, and which of their names they assign to
+_LOCAL_LOAD_OPCODES = frozenset((opcodes.LOAD_FAST, opcodes.LOAD_FAST_CHECK, opcodes.LOAD_FAST_AND_CLEAR, opcodes.LOAD_FAST_LOAD_FAST, opcodes.DELETE_FAST))
+_LOCAL_STORE_OPCODES = frozenset((opcodes.STORE_FAST, opcodes.STORE_FAST_LOAD_FAST, opcodes.STORE_FAST_STORE_FAST))
+
+
+
+# Calls
+
+def load_callable(func: object) -> List[Instr]:
+    """
+    Returns the instructions that push a constant callable, ready for its arguments to be pushed and call() to be used.
+    """
+
+    return [*null_before_callable(), Instr(opcodes.LOAD_CONST, func), *null_after_callable()]
+
+
+def null_before_callable() -> List[Instr]:
+    """
+    Returns the instructions to place before pushing a callable that isn't loaded from a constant, such as a new function.
+    """
+
+    if PY311 and not PY313:
+        return [Instr(opcodes.PUSH_NULL)]
+
+    return []
+
+
+def null_after_callable() -> List[Instr]:
+    """
+    Returns the instructions to place after pushing a callable that isn't loaded from a constant, such as a new function.
+    """
+
+    if PY313:
+        return [Instr(opcodes.PUSH_NULL)]
+
+    return []
+
+
+def call(arg_count: int) -> List[Instr]:
+    """
+    Returns the instructions that call a callable with positional arguments, which are expected to be on the stack.
+    """
+
+    if PY312:
+        return [Instr(opcodes.CALL, arg_count)]
+
+    if PY311:
+        return [Instr(opcodes.PRECALL, arg_count), Instr(opcodes.CALL, arg_count)]
+
+    return [Instr(opcodes.CALL_FUNCTION, arg_count)]
+
+
+def make_function(code: types.CodeType, freevars: Iterable[str]) -> List[Instr]:
+    """
+    Returns the instructions that create a function from a code object, closing over the given free variables of the current function.
+    """
+
+    freevars = list(freevars)
+    instruction_set = []
+    flags = 0
+
+    if len(freevars) > 0:
+        # Python 3.13 replaced LOAD_CLOSURE with LOAD_FAST, as free variables live in the same array as local variables
+        load_closure = opcodes.LOAD_FAST if PY313 else opcodes.LOAD_CLOSURE
+
+        for name in freevars:
+            instruction_set.append(Instr(load_closure, FreeVar(name)))
+
+        instruction_set.append(Instr(opcodes.BUILD_TUPLE, len(freevars)))
+        flags |= _MAKE_FUNCTION_CLOSURE
+
+    instruction_set.append(Instr(opcodes.LOAD_CONST, code))
+
+    if not PY311:
+        # Python 3.11+ reads the qualified name from the code object instead
+        instruction_set.append(Instr(opcodes.LOAD_CONST, getattr(code, "co_qualname", code.co_name)))
+
+    if PY313:
+        instruction_set.append(Instr(opcodes.MAKE_FUNCTION))
+
+        if flags:
+            instruction_set.append(Instr(opcodes.SET_FUNCTION_ATTRIBUTE, flags))
+    else:
+        instruction_set.append(Instr(opcodes.MAKE_FUNCTION, flags))
+
+    return instruction_set
+
+
+def await_value() -> List[Instr]:
+    """
+    Returns the instructions that await the value on top of the stack. Only valid inside of a coroutine or async generator.
+    """
+
+    if not PY311:
+        return [Instr(opcodes.GET_AWAITABLE), Instr(opcodes.LOAD_CONST, None), Instr(opcodes.YIELD_FROM)]
+
+    send_label = Label()
+    exit_label = Label()
+
+    instruction_set = [
+        Instr(opcodes.GET_AWAITABLE, 0),
+        Instr(opcodes.LOAD_CONST, None),
+        send_label,
+        Instr(opcodes.SEND, exit_label),
+    ]
+
+    if PY312:
+        # Exceptions thrown into the coroutine while it's suspended are handled by CLEANUP_THROW, which extracts the value of a StopIteration
+        throw_label = Label()
+        try_begin = TryBegin(throw_label, False)
+
+        instruction_set.extend([try_begin, Instr(opcodes.YIELD_VALUE, 1 if PY313 else 2), TryEnd(try_begin)])
+    else:
+        instruction_set.append(Instr(opcodes.YIELD_VALUE))
+
+    instruction_set.append(Instr(opcodes.RESUME, 3))
+    instruction_set.append(Instr(opcodes.JUMP_BACKWARD_NO_INTERRUPT, send_label))
+
+    if PY312:
+        # Only reachable through the exception table, and leaves the stack the same way SEND does when it jumps
+        instruction_set.append(throw_label)
+        instruction_set.append(Instr(opcodes.CLEANUP_THROW))
+        instruction_set.append(exit_label)
+        instruction_set.append(Instr(opcodes.END_SEND))
+    else:
+        instruction_set.append(exit_label)
+
+    return instruction_set
+
+
+
+# Stack manipulation and operators
+
+def dup_top() -> List[Instr]:
+    return [Instr(opcodes.COPY, 1)] if PY311 else [Instr(opcodes.DUP_TOP)]
+
+
+def load_attr(name: str) -> List[Instr]:
+    """
+    Returns the instructions that replace the object on top of the stack with one of its attributes.
+    """
+
+    if PY312:
+        # The flag requests a method load, which we never want
+        return [Instr(opcodes.LOAD_ATTR, (False, name))]
+
+    return [Instr(opcodes.LOAD_ATTR, name)]
+
+
+def binary_op(operator: str) -> List[Instr]:
+    """
+    Returns the instructions that apply a binary operator ("+", "-" or "%") to the top two values of the stack.
+    """
+
+    opcode, op_name = _BINARY_OPERATORS[operator]
+
+    if PY311:
+        return [Instr(opcodes.BINARY_OP, BinaryOp[op_name])]
+
+    return [Instr(opcode)]
+
+
+def is_op() -> List[Instr]:
+    """
+    Returns the instructions required to replace the top two values of the stack with whether or not they are the same object.
+    """
+
+    if PY39:
+        return [Instr(opcodes.IS_OP, 0)]
+
+    return [Instr(opcodes.COMPARE_OP, Compare.IS)]
+
+
+def compare_op(operator: str) -> List[Instr]:
+    """
+    Returns the instructions required to replace the top two values of the stack with the result of comparing them. The result may not be a bool.
+    """
+
+    return [Instr(opcodes.COMPARE_OP, _COMPARE_OPERATORS[operator])]
+
+
+def is_constant(value: object) -> List[Instr]:
+    """
+    Returns the instructions required to replace the top of the stack with whether or not it is the given constant.
+    """
+
+    return [Instr(opcodes.LOAD_CONST, value), *is_op()]
+
+
+
+# Jumps
+# Generated code only ever jumps forward, which Python 3.11+ has dedicated instructions for
+
+def jump(label: Label) -> List[Instr]:
+    return [Instr(opcodes.JUMP_FORWARD if PY311 else opcodes.JUMP_ABSOLUTE, label)]
+
+
+def pop_jump_if_true(label: Label, is_bool: bool = False) -> List[Instr]:
+    """
+    Returns the instructions that pop the top of the stack, and jump if it is truthy. is_bool marks values known to be a bool, which don't need converting.
+    """
+
+    return _to_bool(is_bool) + [Instr(opcodes.POP_JUMP_FORWARD_IF_TRUE if PY311 and not PY312 else opcodes.POP_JUMP_IF_TRUE, label)]
+
+
+def pop_jump_if_false(label: Label, is_bool: bool = False) -> List[Instr]:
+    """
+    Returns the instructions that pop the top of the stack, and jump if it is falsy. is_bool marks values known to be a bool, which don't need converting.
+    """
+
+    return _to_bool(is_bool) + [Instr(opcodes.POP_JUMP_FORWARD_IF_FALSE if PY311 and not PY312 else opcodes.POP_JUMP_IF_FALSE, label)]
+
+
+def pop_jump_if_none(label: Label) -> List[Instr]:
+    if PY312:
+        return [Instr(opcodes.POP_JUMP_IF_NONE, label)]
+
+    if PY311:
+        return [Instr(opcodes.POP_JUMP_FORWARD_IF_NONE, label)]
+
+    return [*is_constant(None), Instr(opcodes.POP_JUMP_IF_TRUE, label)]
+
+
+def pop_jump_if_not_none(label: Label) -> List[Instr]:
+    if PY312:
+        return [Instr(opcodes.POP_JUMP_IF_NOT_NONE, label)]
+
+    if PY311:
+        return [Instr(opcodes.POP_JUMP_FORWARD_IF_NOT_NONE, label)]
+
+    return [*is_constant(None), Instr(opcodes.POP_JUMP_IF_FALSE, label)]
+
+
+def _to_bool(is_bool: bool) -> List[Instr]:
+    # Conditional jumps in Python 3.13+ only accept exact bools
+    if PY313 and not is_bool:
+        return [Instr(opcodes.TO_BOOL)]
+
+    return []
+
+
+
+# Returns
+
+def return_constant(value: object) -> List[Instr]:
+    if "RETURN_CONST" in dis.opmap:
+        return [Instr(opcodes.RETURN_CONST, value)]
+
+    return [Instr(opcodes.LOAD_CONST, value), Instr(opcodes.RETURN_VALUE)]
+
+
+def expand_return_constants(bytecode: Bytecode) -> None:
+    """
+    Replaces every RETURN_CONST (Python 3.12+) with a LOAD_CONST and RETURN_VALUE, so RETURN_VALUE is the only instruction that returns.
+    """
+
+    for index in range(len(bytecode) - 1, -1, -1):
+        instr = bytecode[index]
+
+        if isinstance(instr, Instr) and instr.name == opcodes.RETURN_CONST:
+            bytecode[index:index + 1] = [
+                Instr(opcodes.LOAD_CONST, instr.arg, location=instr.location),
+                Instr(opcodes.RETURN_VALUE, location=instr.location),
+            ]
+
+
+def reraise() -> List[Instr]:
+    """
+    Returns the instructions that reraise the exception being handled.
+
+    Before Python 3.11, the exception is expected to be on the stack as its type, value and traceback. Afterwards, it is just the exception.
+    """
+
+    if sys.version_info >= (3, 10):
+        return [Instr(opcodes.RERAISE, 0)]
+
+    if PY39:
+        return [Instr(opcodes.RERAISE)]
+
+    return [Instr(opcodes.END_FINALLY)]
+
+
+
+# Local variables
+
+def get_local_names(instr: Instr) -> Tuple[str, ...]:
+    """
+    Returns the names of the local variables an instruction accesses, which is more than one for the superinstructions of Python 3.13+.
+    """
+
+    if instr.name not in _LOCAL_LOAD_OPCODES and instr.name not in _LOCAL_STORE_OPCODES:
+        return ()
+
+    names = instr.arg if isinstance(instr.arg, tuple) else (instr.arg, )
+
+    # Python 3.13+ also uses LOAD_FAST for closure cells
+    return tuple(name for name in names if isinstance(name, str))
+
+
+def get_stored_names(instr: Instr) -> Tuple[str, ...]:
+    """
+    Returns the names of the local variables an instruction assigns to.
+    """
+
+    if instr.name == opcodes.STORE_FAST_LOAD_FAST:
+        return (instr.arg[0], )
+
+    if instr.name in _LOCAL_STORE_OPCODES:
+        return get_local_names(instr)
+
+    return ()
+
+
+def get_cleared_names(instr: Instr) -> Tuple[str, ...]:
+    """
+    Returns the names of the local variables an instruction unbinds.
+
+    LOAD_FAST_AND_CLEAR (Python 3.12+, used by inlined comprehensions) saves a variable that may be unbound, and restores it with
+    STORE_FAST afterwards. That STORE_FAST can store an unbound value, so variables touched by it can't ever be trusted to be assigned.
+    """
+
+    if instr.name in (opcodes.DELETE_FAST, opcodes.LOAD_FAST_AND_CLEAR):
+        return get_local_names(instr)
+
+    return ()
+
+
+def rename_locals(instr: Instr, names: Dict[str, str]) -> Instr:
+    """
+    Returns a copy of an instruction with the local variables it accesses renamed, given a mapping of old names to new names.
+    """
+
+    if isinstance(instr.arg, tuple):
+        return Instr(instr.name, tuple(names.get(name, name) for name in instr.arg))
+
+    if isinstance(instr.arg, str):
+        return Instr(instr.name, names.get(instr.arg, instr.arg))
+
+    return Instr(instr.name, instr.arg)
+
+
+def load_variable(bytecode: Bytecode, name: str) -> List[Instr]:
+    """
+    Returns the instructions that load a local variable or argument, which might have been turned into a cell for a closure.
+    """
+
+    if name in bytecode.cellvars:
+        return [Instr(opcodes.LOAD_DEREF, CellVar(name))]
+
+    return [Instr(opcodes.LOAD_FAST, name)]
+
+
+def store_variable(bytecode: Bytecode, name: str) -> List[Instr]:
+    if name in bytecode.cellvars:
+        return [Instr(opcodes.STORE_DEREF, CellVar(name))]
+
+    return [Instr(opcodes.STORE_FAST, name)]
+
+
+
+# Function structure
+
+def copy_bytecode(bytecode: Bytecode) -> Bytecode:
+    """
+    Returns a copy of bytecode that can be modified (including its instructions, in place) without affecting the original.
+    Labels are shared, as nothing ever modifies them.
+    """
+
+    copied = bytecode.copy()
+    copied.clear()
+    copied.argnames = list(bytecode.argnames)
+
+    try_blocks = {}
+
+    # Iterating over the bytecode itself refuses nested try blocks, so index into it instead
+    for index in range(len(bytecode)):
+        item = bytecode[index]
+
+        if isinstance(item, Instr):
+            item = item.copy()
+        elif isinstance(item, TryBegin):
+            try_blocks[id(item)] = TryBegin(item.target, item.push_lasti, item.stack_depth)
+            item = try_blocks[id(item)]
+        elif isinstance(item, TryEnd):
+            item = TryEnd(try_blocks.get(id(item.entry), item.entry))
+
+        copied.append(item)
+
+    return copied
+
+
+def get_body_start(bytecode: Bytecode) -> int:
+    """
+    Returns the index of the first instruction that code can be inserted before, which is after the prologue of the function.
+
+    In Python 3.11+ the prologue ends with RESUME, and may set up cells and free variables or create the generator before it.
+    Generators in Python 3.10 have to start with GEN_START.
+    """
+
+    for index, instr in enumerate(bytecode):
+        if not isinstance(instr, Instr):
+            continue
+
+        if instr.name in (opcodes.RESUME, opcodes.GEN_START):
+            return index + 1
+
+        if not PY311 or instr.name not in _PROLOGUE_OPCODES:
+            break
+
+    return 0
+
+
+def function_prologue(bytecode: Bytecode) -> List[Instr]:
+    """
+    Returns the instructions that a new, non-generator function has to start with.
+    """
+
+    if not PY311:
+        return []
+
+    instruction_set = []
+
+    if len(bytecode.freevars) > 0:
+        instruction_set.append(Instr(opcodes.COPY_FREE_VARS, len(bytecode.freevars)))
+
+    for name in bytecode.cellvars:
+        instruction_set.append(Instr(opcodes.MAKE_CELL, CellVar(name)))
+
+    instruction_set.append(Instr(opcodes.RESUME, 0))
+
+    return instruction_set
+
+
+def deepen_yields(bytecode: Bytecode) -> None:
+    """
+    Marks each yield in the bytecode as being inside of one more try block, for code that gets wrapped in one.
+
+    Python 3.12+ closes generators that are suspended outside of any try block (other than the one every generator is wrapped in)
+    without running them, which would skip a handler we've added.
+    """
+
+    for instr in bytecode:
+        if not isinstance(instr, Instr):
+            continue
+
+        if PY313 and instr.name == opcodes.RESUME and instr.arg & _RESUME_DEPTH1_MASK:
+            instr.arg &= ~_RESUME_DEPTH1_MASK
+        elif PY312 and not PY313 and instr.name == opcodes.YIELD_VALUE:
+            instr.arg += 1
+
+
+def unwrap_generator(bytecode: Bytecode) -> None:
+    """
+    Removes the try block that Python 3.12+ wraps the body of every generator in, which turns a StopIteration leaking out of it into a RuntimeError.
+
+    It has to be the outermost try block, so to_code() puts it back once everything else has been added.
+    """
+
+    if not PY312 or not bytecode.flags & _GENERATOR_FLAGS:
+        return
+
+    handler_labels = set()
+
+    for index, instr in enumerate(bytecode[:-2]):
+        if isinstance(instr, Label) and _is_stop_iteration_handler(bytecode[index + 1], bytecode[index + 2]):
+            handler_labels.add(instr)
+
+    if len(handler_labels) == 0:
+        return
+
+    unwrapped = []
+    skip = 0
+
+    for instr in bytecode:
+        if skip > 0:
+            skip -= 1
+        elif isinstance(instr, Label) and instr in handler_labels:
+            skip = 2
+        elif not (isinstance(instr, TryBegin) and instr.target in handler_labels) and not (isinstance(instr, TryEnd) and instr.entry.target in handler_labels):
+            unwrapped.append(instr)
+
+    bytecode[:] = unwrapped
+
+
+def _is_stop_iteration_handler(first: object, second: object) -> bool:
+    return (isinstance(first, Instr) and first.name == opcodes.CALL_INTRINSIC_1 and first.arg == Intrinsic1Op.INTRINSIC_STOPITERATION_ERROR
+            and isinstance(second, Instr) and second.name == opcodes.RERAISE and second.arg == 1)
+
+
+def _wrap_generator(bytecode: Bytecode) -> None:
+    """
+    Reverses unwrap_generator().
+    """
+
+    if not PY312 or not bytecode.flags & _GENERATOR_FLAGS:
+        return
+
+    handler_label = Label()
+    try_begin = TryBegin(handler_label, True)
+
+    # The compiler starts the try block right before RESUME
+    bytecode.insert(max(get_body_start(bytecode) - 1, 0), try_begin)
+
+    bytecode.append(TryEnd(try_begin))
+    bytecode.append(handler_label)
+    bytecode.append(Instr(opcodes.CALL_INTRINSIC_1, Intrinsic1Op.INTRINSIC_STOPITERATION_ERROR))
+    bytecode.append(Instr(opcodes.RERAISE, 1))
+
+
+def flatten_try_blocks(bytecode: Bytecode) -> None:
+    """
+    Splits nested try blocks into the flat, non-overlapping ranges of the exception table used by Python 3.11+.
+
+    Generated code wraps code that may already contain try blocks (such as a finalizer wrapping the entire function), which the
+    bytecode library can't nest. The innermost try block covers an instruction, the same as it would for nested try statements.
+    Every piece of a split try block keeps the same handler, so the stack is unwound to the same depth no matter which one raised.
+    """
+
+    if not PY311:
+        return
+
+    flattened = []
+    blocks: List[TryBegin] = []    # Enclosing try blocks, innermost last
+    used_blocks = set()
+    current_range = None    # The TryBegin of the range that is currently open, which always belongs to the innermost block
+
+    # Iterating over the bytecode itself refuses nested try blocks, so index into it instead
+    for index in range(len(bytecode)):
+        instr = bytecode[index]
+
+        if isinstance(instr, TryBegin):
+            if current_range is not None:
+                flattened.append(TryEnd(current_range))
+                current_range = None
+
+            blocks.append(instr)
+
+        elif isinstance(instr, TryEnd):
+            if len(blocks) > 0 and blocks[-1] is instr.entry and current_range is not None:
+                flattened.append(TryEnd(current_range))
+                current_range = None
+
+            blocks = [block for block in blocks if block is not instr.entry]
+
+        else:
+            if isinstance(instr, Instr) and current_range is None and len(blocks) > 0:
+                # Open a range for the innermost block, now that it's known not to be empty
+                block = blocks[-1]
+                current_range = TryBegin(block.target, block.push_lasti) if id(block) in used_blocks else block
+                used_blocks.add(id(block))
+                flattened.append(current_range)
+
+            flattened.append(instr)
+
+    if current_range is not None:
+        flattened.append(TryEnd(current_range))
+
+    bytecode[:] = flattened
+
+
+def to_code(bytecode: Bytecode) -> types.CodeType:
+    """
+    Converts finished bytecode to a code object.
+    """
+
+    if PY311:
+        bytecode = bytecode.copy()
+        _wrap_generator(bytecode)
+        flatten_try_blocks(bytecode)
+
+    return bytecode.to_code()
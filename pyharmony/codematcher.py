@@ -0,0 +1,459 @@
+"""
+Contains CodeMatcher, which finds and edits sequences of instructions in the bytecode given to transpilers.
+"""
+
+import bisect
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from bytecode import Bytecode, Instr, Label
+from . import opcodes
+
+# Instructions whose argument is a (flag, name) tuple on newer versions of Python, which are matched by the name alone
+_FLAGGED_NAME_OPCODES = frozenset((opcodes.LOAD_GLOBAL, opcodes.LOAD_ATTR, opcodes.LOAD_SUPER_ATTR))
+
+
+class _Any:
+    """
+    Matches any argument.
+    """
+    def __repr__(self) -> str:
+        return "ANY"
+
+
+ANY = _Any()
+
+
+def _normalize_arg(name: str, arg: object) -> object:
+    if name in _FLAGGED_NAME_OPCODES and isinstance(arg, tuple) and len(arg) == 2 and isinstance(arg[1], str):
+        return arg[1]
+
+    return arg
+
+
+def _get_index_key(name: str, arg: object) -> Optional[tuple]:
+    """
+    Returns the key of an instruction in the argument index, or None if its argument can't be indexed.
+    """
+
+    arg = _normalize_arg(name, arg)
+
+    try:
+        hash(arg)
+    except TypeError:
+        return None
+
+    # Include the type, as 1, 1.0 and True are equal but never interchangeable as constants
+    return (name, type(arg), arg)
+
+
+def _get_snapshot_entry(item: object) -> tuple:
+    # Instructions can be changed in place, so their name and argument are kept as well (see CodeMatcher._is_unchanged())
+    if isinstance(item, Instr):
+        return (item, item.name, item.arg)
+
+    return (item, None, None)
+
+
+class CodeMatch:
+    """
+    A single element of a pattern passed to CodeMatcher.
+
+    name: The name of the instruction (such as "LOAD_CONST"), or None to match any instruction.
+    arg: The argument of the instruction, or ANY to match any argument. Arguments are compared by type and value.
+        On Python 3.11+, the name is enough to match the (flag, name) arguments of LOAD_GLOBAL and LOAD_ATTR.
+    predicate: If supplied, a function that receives the instruction and returns whether or not it matches.
+    """
+
+    __slots__ = ("name", "arg", "predicate")
+
+    def __init__(self, name: Optional[str] = None, arg: object = ANY, predicate: Optional[Callable[[Instr], bool]] = None) -> None:
+        self.name = name
+        self.arg = arg
+        self.predicate = predicate
+
+    def matches(self, instr: Instr) -> bool:
+        if self.name is not None and instr.name != self.name:
+            return False
+
+        if self.arg is not ANY:
+            arg = _normalize_arg(instr.name, instr.arg)
+
+            if type(arg) is not type(self.arg) or arg != self.arg:
+                return False
+
+        return self.predicate is None or bool(self.predicate(instr))
+
+    def __repr__(self) -> str:
+        return f"CodeMatch({self.name!r}, {self.arg!r})"
+
+
+PatternElement = Union[CodeMatch, Instr, str]
+
+
+def _to_code_match(element: PatternElement) -> CodeMatch:
+    if isinstance(element, CodeMatch):
+        return element
+
+    if isinstance(element, Instr):
+        return CodeMatch(element.name, element.arg)
+
+    if isinstance(element, str):
+        return CodeMatch(element)
+
+    raise TypeError(f"Expected a CodeMatch, Instr or instruction name, instead recieved {element!r}")
+
+
+class Match:
+    """
+    A sequence of instructions found by CodeMatcher.
+
+    positions: The index in the bytecode of each matched instruction. Labels and other pseudo instructions in between them are skipped over.
+    Positions are only valid until the bytecode is edited, apart from edits made through the CodeMatcher to this match itself.
+    """
+
+    __slots__ = ("positions", "instructions")
+
+    def __init__(self, positions: List[int], instructions: List[Instr]) -> None:
+        self.positions = positions
+        self.instructions = instructions
+
+    @property
+    def start(self) -> int:
+        return self.positions[0]
+
+    @property
+    def end(self) -> int:
+        """
+        The index just after the last matched instruction.
+        """
+
+        return self.positions[-1] + 1
+
+    def __repr__(self) -> str:
+        return f"Match({self.start}, {self.end}, {self.instructions!r})"
+
+
+class CodeMatcher:
+    """
+    Finds sequences of instructions in a Bytecode, and edits the bytecode around them without breaking jumps.
+
+    Instructions are indexed by name and argument, so searching for a pattern only looks at the places where its most specific
+    element appears instead of scanning the whole function. The index is kept up to date by the editing methods; the bytecode
+    must not be modified any other way while a CodeMatcher is in use (see of()).
+
+    Labels, line numbers and try block markers are never matched, and edits keep them in place: jumps to a removed or replaced
+    instruction land on whatever takes its place.
+    """
+    def __init__(self, bytecode: Bytecode) -> None:
+        self.bytecode = bytecode
+
+        self._by_name: Dict[str, List[int]] = {}
+        self._by_arg: Dict[tuple, List[int]] = {}
+        self._unindexed: List[int] = []    # Positions of instructions with unhashable arguments
+        self._resume: Optional[int] = None    # Where find_all() continues searching from
+
+        self._build_index()
+
+    @classmethod
+    def of(cls, bytecode: Bytecode) -> "CodeMatcher":
+        """
+        Returns a CodeMatcher for a Bytecode, reusing the one created by a previous transpiler of the same target if the bytecode
+        hasn't been modified without it since (including instructions changed in place). Checking that is much cheaper than indexing
+        the bytecode again.
+        """
+
+        matcher = getattr(bytecode, "_pyharmony_code_matcher", None)
+
+        if matcher is None or matcher.bytecode is not bytecode or not matcher._is_unchanged():
+            matcher = cls(bytecode)
+            bytecode._pyharmony_code_matcher = matcher
+
+        return matcher
+
+    # Searching
+
+    def find(self, *pattern: PatternElement, start: int = 0) -> Optional[Match]:
+        """
+        Returns the first match of a sequence of instructions at or after the index start, or None if there isn't one.
+
+        Each element of the pattern can be a CodeMatch, an Instr (matching its name and argument) or just the name of an instruction.
+        """
+
+        matches = [_to_code_match(element) for element in pattern]
+
+        if len(matches) == 0:
+            raise ValueError("Expected at least one element in the pattern")
+
+        anchor, candidates = self._get_candidates(matches)
+
+        for candidate in candidates[bisect.bisect_left(candidates, start):]:
+            match = self._match_at(matches, anchor, candidate)
+
+            if match is not None and match.start >= start:
+                return match
+
+        return None
+
+    def find_all(self, *pattern: PatternElement) -> Iterator[Match]:
+        """
+        Yields every match of a sequence of instructions, in order.
+
+        The matches can be edited through this CodeMatcher while iterating, and searching continues after the edited code.
+        """
+
+        self._resume = 0
+
+        try:
+            while True:
+                match = self.find(*pattern, start=self._resume)
+
+                if match is None:
+                    return
+
+                self._resume = match.end
+                yield match
+        finally:
+            self._resume = None
+
+    def count(self, *pattern: PatternElement) -> int:
+        return sum(1 for _ in self.find_all(*pattern))
+
+    # Editing
+
+    def insert_before(self, match: Match, instructions: Iterable[object], before_labels: bool = False) -> None:
+        """
+        Inserts instructions before a match.
+
+        By default, they go in between the match and any labels pointing at it, so jumps to the match run them as well.
+        If before_labels is true, they go before those labels instead, so they only run when falling through into the match.
+        """
+
+        position = match.start
+
+        if before_labels:
+            while position > 0 and isinstance(self.bytecode[position - 1], Label):
+                position -= 1
+
+        instructions = list(instructions)
+
+        self._insert(position, instructions)
+        match.positions = [matched + len(instructions) for matched in match.positions]
+
+    def insert_after(self, match: Match, instructions: Iterable[object]) -> None:
+        """
+        Inserts instructions right after the last instruction of a match.
+        """
+
+        self._insert(match.end, list(instructions))
+
+    def replace(self, match: Match, instructions: Iterable[object]) -> None:
+        """
+        Replaces the instructions of a match. Anything in between them (such as labels) is kept, in front of the new instructions.
+        """
+
+        instructions = list(instructions)
+        start = match.start
+
+        kept = [item for item in self.bytecode[start:match.end] if not isinstance(item, Instr)]
+
+        self._remove(start, match.end)
+        self._insert(start, kept + instructions)
+
+        match.positions = [start + len(kept) + index for index, item in enumerate(instructions) if isinstance(item, Instr)]
+        match.instructions = [item for item in instructions if isinstance(item, Instr)]
+
+    def remove(self, match: Match) -> None:
+        """
+        Removes the instructions of a match. Anything in between them (such as labels) is kept.
+        """
+
+        self.replace(match, [])
+
+    def set_arg(self, match: Match, index: int, arg: object) -> None:
+        """
+        Changes the argument of the index-th instruction of a match, keeping its name and line number.
+        """
+
+        instr = match.instructions[index]
+        self.replace_instruction(match, index, Instr(instr.name, arg, lineno=instr.lineno))
+
+    def replace_instruction(self, match: Match, index: int, instr: Instr) -> None:
+        """
+        Replaces a single instruction of a match with another one.
+        """
+
+        position = match.positions[index]
+
+        self._unindex(position, self.bytecode[position])
+        self.bytecode[position] = instr
+        self._index(position, instr)
+        self._snapshot[position] = _get_snapshot_entry(instr)
+
+        match.instructions[index] = instr
+
+    # Index
+
+    def _build_index(self) -> None:
+        for position, item in enumerate(self.bytecode):
+            if isinstance(item, Instr):
+                self._index(position, item, append=True)
+
+        self._snapshot = list(map(_get_snapshot_entry, self.bytecode))
+
+    def _is_unchanged(self) -> bool:
+        """
+        Returns whether the bytecode still holds the same items as when it was last indexed or edited, with the same names and arguments.
+
+        Items and arguments are compared by identity. The snapshot keeps them alive, so a new object can't be given the id of an old one.
+        """
+
+        if len(self._snapshot) != len(self.bytecode):
+            return False
+
+        for (item, name, arg), current in zip(self._snapshot, self.bytecode):
+            if current is not item or (name is not None and (current.name != name or current.arg is not arg)):
+                return False
+
+        return True
+
+    def _index(self, position: int, instr: Instr, append: bool = False) -> None:
+        add = list.append if append else bisect.insort
+
+        add(self._by_name.setdefault(instr.name, []), position)
+
+        key = _get_index_key(instr.name, instr.arg)
+
+        if key is not None:
+            add(self._by_arg.setdefault(key, []), position)
+        else:
+            add(self._unindexed, position)
+
+    def _unindex(self, position: int, instr: Instr) -> None:
+        key = _get_index_key(instr.name, instr.arg)
+
+        self._discard_position(self._by_name, instr.name, position)
+
+        if key is not None:
+            self._discard_position(self._by_arg, key, position)
+        else:
+            del self._unindexed[bisect.bisect_left(self._unindexed, position)]
+
+    @staticmethod
+    def _discard_position(index: dict, key: object, position: int) -> None:
+        positions = index[key]
+        del positions[bisect.bisect_left(positions, position)]
+
+        if len(positions) == 0:
+            del index[key]
+
+    def _shift(self, position: int, delta: int) -> None:
+        """
+        Moves every indexed position at or after position by delta.
+        """
+
+        for positions in [*self._by_name.values(), *self._by_arg.values(), self._unindexed]:
+            for index in range(bisect.bisect_left(positions, position), len(positions)):
+                positions[index] += delta
+
+        if self._resume is not None and self._resume >= position:
+            self._resume += delta
+
+    def _insert(self, position: int, items: List[object]) -> None:
+        if len(items) == 0:
+            return
+
+        self._shift(position, len(items))
+        self.bytecode[position:position] = items
+        self._snapshot[position:position] = map(_get_snapshot_entry, items)
+
+        for offset, item in enumerate(items):
+            if isinstance(item, Instr):
+                self._index(position + offset, item)
+
+    def _remove(self, start: int, end: int) -> None:
+        for position in range(start, end):
+            item = self.bytecode[position]
+
+            if isinstance(item, Instr):
+                self._unindex(position, item)
+
+        del self.bytecode[start:end]
+        del self._snapshot[start:end]
+
+        self._shift(end, start - end)
+
+    def _get_candidates(self, matches: List[CodeMatch]) -> Tuple[int, List[int]]:
+        """
+        Picks the most specific element of a pattern, and returns its index in the pattern along with every position it appears at.
+        """
+
+        best: Optional[Tuple[int, List[int]]] = None
+
+        for index, match in enumerate(matches):
+            if match.name is None:
+                continue
+
+            if match.arg is not ANY:
+                key = _get_index_key(match.name, match.arg)
+                positions = self._by_arg.get(key, []) if key is not None else self._by_name.get(match.name, [])
+            else:
+                positions = self._by_name.get(match.name, [])
+
+            if best is None or len(positions) < len(best[1]):
+                best = (index, positions)
+
+        if best is None:
+            # Nothing to narrow it down with
+            return 0, [position for position, item in enumerate(self.bytecode) if isinstance(item, Instr)]
+
+        return best
+
+    def _match_at(self, matches: List[CodeMatch], anchor: int, anchor_position: int) -> Optional[Match]:
+        """
+        Checks if a pattern matches, given the position of its anchor element.
+        """
+
+        positions = [anchor_position]
+
+        # Walk backwards from the anchor to the start of the pattern, then forwards to its end
+
+        position = anchor_position
+
+        for _ in range(anchor):
+            position = self._step(position, -1)
+
+            if position is None:
+                return None
+
+            positions.insert(0, position)
+
+        position = anchor_position
+
+        for _ in range(len(matches) - anchor - 1):
+            position = self._step(position, 1)
+
+            if position is None:
+                return None
+
+            positions.append(position)
+
+        instructions = [self.bytecode[position] for position in positions]
+
+        if all(match.matches(instr) for match, instr in zip(matches, instructions)):
+            return Match(positions, instructions)
+
+        return None
+
+    def _step(self, position: int, direction: int) -> Optional[int]:
+        """
+        Returns the position of the next (or previous) instruction, skipping over labels and other pseudo instructions.
+        """
+
+        position += direction
+
+        while 0 <= position < len(self.bytecode):
+            if isinstance(self.bytecode[position], Instr):
+                return position
+
+            position += direction
+
+        return None
@@ -0,0 +1,357 @@
+"""
+Contains the persistent on-disk cache of patched code objects.
+"""
+
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+import tempfile
+import types
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Bump this whenever the layout of cache files changes
+CACHE_FORMAT_VERSION = 1
+
+# The maximum amount of patch combinations to store per target
+MAX_ENTRIES_PER_TARGET = 16
+
+_CACHE_FILE_EXTENSION = ".pyhc"
+
+
+def code_digest(code: types.CodeType) -> str:
+    """
+    Returns a hash of a code object that is stable across processes.
+
+    marshal.dumps() can't be used for this, as its output depends on reference counts.
+    """
+
+    digest = hashlib.sha256()
+    _update_code_digest(digest, code)
+
+    return digest.hexdigest()
+
+
+def _update_code_digest(digest: "hashlib._Hash", code: types.CodeType) -> None:
+    for value in (code.co_name, code.co_filename, code.co_firstlineno, code.co_flags, code.co_argcount,
+                  code.co_posonlyargcount, code.co_kwonlyargcount, code.co_names, code.co_varnames,
+                  code.co_freevars, code.co_cellvars):
+        digest.update(repr(value).encode())
+
+    digest.update(code.co_code)
+
+    for const in code.co_consts:
+        _update_const_digest(digest, const)
+
+
+def _update_const_digest(digest: "hashlib._Hash", const: object) -> None:
+    digest.update(type(const).__name__.encode())
+
+    if isinstance(const, types.CodeType):
+        _update_code_digest(digest, const)
+    elif isinstance(const, tuple):
+        for item in const:
+            _update_const_digest(digest, item)
+    elif isinstance(const, frozenset):
+        # The iteration order of a frozenset depends on string hashing, which changes between processes
+        for item in sorted(repr(item) for item in const):
+            digest.update(item.encode())
+    else:
+        digest.update(repr(const).encode())
+
+
+_library_digest: Optional[str] = None
+
+
+def library_digest() -> str:
+    """
+    Returns a hash of the pyHarmony source files, so code generated by a different version of the library is never loaded.
+    """
+
+    global _library_digest
+
+    if _library_digest is None:
+        digest = hashlib.sha256()
+        package_directory = os.path.dirname(os.path.abspath(__file__))
+
+        for file_name in sorted(os.listdir(package_directory)):
+            if file_name.endswith(".py"):
+                with open(os.path.join(package_directory, file_name), "rb") as file:
+                    digest.update(file.read())
+
+        _library_digest = digest.hexdigest()
+
+    return _library_digest
+
+
+def _is_marshallable(value: object) -> bool:
+    try:
+        marshal.dumps(value)
+        return True
+    except ValueError:
+        return False
+
+
+def unlink_code(code: types.CodeType, link_objects: List[object]) -> Optional[Tuple[types.CodeType, tuple]]:
+    """
+    Replaces the constants of a code object that appear in link_objects with None, so that it can be marshalled.
+
+    Returns the new code object, along with a tuple of (constant index, link object index) pairs for link_code().
+    Returns None if the code has any other constants that can't be marshalled.
+    """
+
+    links: List[Tuple[int, int]] = []
+    consts = list(code.co_consts)
+
+    for const_index, const in enumerate(consts):
+        link_index = next((index for index, link_object in enumerate(link_objects) if const is link_object), None)
+
+        if link_index is not None:
+            links.append((const_index, link_index))
+            consts[const_index] = None
+        elif not _is_marshallable(const):
+            # Something (probably a transpiler) put an object in the code that we have no way of linking back in
+            return None
+
+    return code.replace(co_consts=tuple(consts)), tuple(links)
+
+
+def link_code(code: types.CodeType, links: tuple, link_objects: List[object]) -> Optional[types.CodeType]:
+    """
+    Reverses unlink_code(), using a list of live objects built the same way as the one it was given.
+    """
+
+    consts = list(code.co_consts)
+
+    for const_index, link_index in links:
+        if link_index >= len(link_objects):
+            return None
+
+        consts[const_index] = link_objects[link_index]
+
+    return code.replace(co_consts=tuple(consts))
+
+
+class DiskCache:
+    """
+    Stores marshalled patched code objects in a directory, similar to __pycache__.
+
+    Each target gets its own file, which is discarded as soon as the original code or Python version no longer matches it.
+    Objects that can't be marshalled (such as hook functions) are replaced with placeholders when storing, and linked
+    back in from a list of live objects when loading.
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def load(self, original_code: types.CodeType, target_name: str, patch_identities: tuple, link_objects: List[object]) -> Optional[types.CodeType]:
+        """
+        Returns the cached patched code for a target and set of patches, or None if it isn't cached.
+
+        link_objects must be built the same way as the list that was passed to store().
+        """
+
+        contents = self._read(original_code, target_name)
+
+        if contents is None:
+            return None
+
+        entry = contents["entries"].get(self._get_entry_key(patch_identities))
+
+        if entry is None:
+            return None
+
+        return link_code(*entry, link_objects)
+
+    def store(self, original_code: types.CodeType, target_name: str, patch_identities: tuple, link_objects: List[object], patched_code: types.CodeType) -> bool:
+        """
+        Stores patched code for a target and set of patches. Returns false if the code can't be stored.
+        """
+
+        unlinked = unlink_code(patched_code, link_objects)
+
+        if unlinked is None:
+            return False
+
+        contents = self._read(original_code, target_name) or self._create_contents(original_code)
+        entries: Dict[str, tuple] = contents["entries"]
+
+        entry_key = self._get_entry_key(patch_identities)
+        entries.pop(entry_key, None)
+        entries[entry_key] = unlinked
+
+        # Dictionaries keep their insertion order through marshal, so the oldest entries are first
+        while len(entries) > MAX_ENTRIES_PER_TARGET:
+            del entries[next(iter(entries))]
+
+        self._write(original_code, target_name, contents)
+
+        return True
+
+    def clear(self) -> None:
+        """
+        Deletes every cache file in the cache directory.
+        """
+
+        if not os.path.isdir(self.directory):
+            return
+
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(_CACHE_FILE_EXTENSION):
+                self._remove(os.path.join(self.directory, file_name))
+
+    def _get_path(self, original_code: types.CodeType, target_name: str) -> str:
+        qualified_name = getattr(original_code, "co_qualname", original_code.co_name)
+        target_key = hashlib.sha256(f"{original_code.co_filename}:{qualified_name}:{target_name}".encode())
+
+        # Include the interpreter's cache tag (like __pycache__ does), so different Python versions don't keep discarding each other's files
+        return os.path.join(self.directory, f"{original_code.co_name}.{sys.implementation.cache_tag}.{target_key.hexdigest()[:32]}{_CACHE_FILE_EXTENSION}")
+
+    @staticmethod
+    def _get_entry_key(patch_identities: tuple) -> str:
+        return hashlib.sha256(repr(patch_identities).encode()).hexdigest()
+
+    @staticmethod
+    def _create_contents(original_code: types.CodeType) -> dict:
+        return {
+            "magic": importlib.util.MAGIC_NUMBER,
+            "format_version": CACHE_FORMAT_VERSION,
+            "library_digest": library_digest(),
+            "code_digest": code_digest(original_code),
+            "entries": {},
+        }
+
+    def _read(self, original_code: types.CodeType, target_name: str) -> Optional[dict]:
+        path = self._get_path(original_code, target_name)
+
+        try:
+            with open(path, "rb") as file:
+                contents = marshal.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError):
+            # Unreadable or corrupt
+            self._remove(path)
+            return None
+
+        if (not isinstance(contents, dict) or contents.get("magic") != importlib.util.MAGIC_NUMBER
+                or contents.get("format_version") != CACHE_FORMAT_VERSION
+                or contents.get("library_digest") != library_digest()
+                or contents.get("code_digest") != code_digest(original_code)
+                or not isinstance(contents.get("entries"), dict)):
+            # Stale, as either Python, pyHarmony or the target function have changed since it was written
+            self._remove(path)
+            return None
+
+        return contents
+
+    def _write(self, original_code: types.CodeType, target_name: str, contents: dict) -> None:
+        path = self._get_path(original_code, target_name)
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # Write to a temporary file first, so other processes never see a partially written file
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+            try:
+                with os.fdopen(file_descriptor, "wb") as file:
+                    marshal.dump(contents, file)
+
+                os.replace(temp_path, path)
+            except BaseException:
+                self._remove(temp_path)
+                raise
+        except OSError:
+            # The cache is only an optimization, so failing to write it isn't an error
+            pass
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_patch_identity(kind: str, hook_func: object, options: Iterable[object] = (), include_bindings: bool = False) -> Optional[tuple]:
+    """
+    Returns a value identifying a patch that is stable across processes, or None if one can't be determined.
+
+    The hook is identified by its qualified name and a digest of its code, so editing a hook invalidates any cached code built from it.
+    If include_bindings is true, the values of its closure, defaults and keyword defaults are part of the identity as well, which is needed
+    for hooks that generate code (transpilers). None is returned if any of those values can't be identified across processes.
+    """
+
+    code = getattr(hook_func, "__code__", None)
+
+    if code is None:
+        return None
+
+    identity = (kind, getattr(hook_func, "__module__", None), getattr(hook_func, "__qualname__", None), code_digest(code), *options)
+
+    if include_bindings:
+        bindings_digest = _get_bindings_digest(hook_func)
+
+        if bindings_digest is None:
+            return None
+
+        identity += (bindings_digest, )
+
+    return identity
+
+
+# Values that are identified by their repr(), which is the same in every process
+_STABLE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _get_bindings_digest(hook_func: object) -> Optional[str]:
+    """
+    Returns a hash of the closure, defaults and keyword defaults of a function, or None if any of them isn't a simple constant.
+    """
+
+    values: List[object] = []
+
+    for cell in getattr(hook_func, "__closure__", None) or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:
+            # An empty cell
+            values.append(None)
+
+    values.append(getattr(hook_func, "__defaults__", None))
+    values.append(tuple(sorted((getattr(hook_func, "__kwdefaults__", None) or {}).items())))
+
+    digest = hashlib.sha256()
+
+    for value in values:
+        if not _update_value_digest(digest, value):
+            return None
+
+    return digest.hexdigest()
+
+
+def _update_value_digest(digest: "hashlib._Hash", value: object) -> bool:
+    digest.update(f"{type(value).__name__}:".encode())
+
+    # Mutable containers are never stable, as they can be changed after the code has been cached
+    if type(value) is tuple:
+        # Include the length, so nested tuples can't be confused with flat ones
+        digest.update(f"{len(value)}:".encode())
+        return all(_update_value_digest(digest, item) for item in value)
+
+    if type(value) is frozenset:
+        if not all(isinstance(item, _STABLE_TYPES) for item in value):
+            return False
+
+        # The iteration order of a frozenset depends on string hashing, which changes between processes
+        for item in sorted(repr(item) for item in value):
+            digest.update(f"{item}:".encode())
+
+        return True
+
+    if type(value) not in _STABLE_TYPES:
+        return False
+
+    digest.update(f"{value!r}:".encode())
+    return True
@@ -0,0 +1,107 @@
+"""
+Contains the import hook used to patch modules that haven't been imported yet, as soon as they are.
+"""
+
+import importlib.abc
+import sys
+import threading
+import types
+from typing import Callable, Optional, Set
+
+
+class _PatchingLoader(importlib.abc.Loader):
+    """
+    Wraps the loader of a watched module, and calls back once the module has been executed.
+    """
+    def __init__(self, loader: importlib.abc.Loader, callback: Callable[[str], None]) -> None:
+        self._loader = loader
+        self._callback = callback
+
+    def create_module(self, spec: "importlib.machinery.ModuleSpec") -> Optional[types.ModuleType]:
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module: types.ModuleType) -> None:
+        # Put the real loader back, so nothing can tell the module went through us
+        module.__loader__ = self._loader
+
+        if getattr(module, "__spec__", None) is not None:
+            module.__spec__.loader = self._loader
+
+        self._loader.exec_module(module)
+        self._callback(module.__name__)
+
+    def __getattr__(self, name: str) -> object:
+        # Anything else (get_resource_reader(), is_package(), ...) is answered by the real loader
+        return getattr(self._loader, name)
+
+
+class _PatchingFinder(importlib.abc.MetaPathFinder):
+    """
+    A meta path finder that doesn't find anything itself. When a watched module is about to be imported, it finds the module
+    through the other finders, and wraps its loader in a _PatchingLoader.
+    """
+    def __init__(self, callback: Callable[[str], None]) -> None:
+        self.callback = callback
+        self.module_names: Set[str] = set()
+
+    def find_spec(self, fullname: str, path: object, target: Optional[types.ModuleType] = None) -> Optional["importlib.machinery.ModuleSpec"]:
+        if fullname not in self.module_names:
+            return None
+
+        for finder in list(sys.meta_path):
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+
+            spec = finder.find_spec(fullname, path, target)
+
+            if spec is not None:
+                break
+        else:
+            return None
+
+        if spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            # Namespace packages and legacy loaders can't be wrapped
+            return spec
+
+        spec.loader = _PatchingLoader(spec.loader, self.callback)
+
+        return spec
+
+
+_finder: Optional[_PatchingFinder] = None
+_finder_lock = threading.Lock()
+
+
+def watch(module_name: str, callback: Callable[[str], None]) -> None:
+    """
+    Calls callback with the name of a module once it has been imported. Only a single callback is supported, which is replaced by every call.
+
+    The module must not be imported yet.
+    """
+
+    global _finder
+
+    with _finder_lock:
+        if _finder is None:
+            _finder = _PatchingFinder(callback)
+
+        _finder.callback = callback
+        _finder.module_names.add(module_name)
+
+        if _finder not in sys.meta_path:
+            sys.meta_path.insert(0, _finder)
+
+
+def unwatch(module_name: str) -> None:
+    """
+    Stops watching a module. The import hook is removed entirely once no modules are being watched.
+    """
+
+    with _finder_lock:
+        if _finder is None:
+            return
+
+        _finder.module_names.discard(module_name)
+
+        if len(_finder.module_names) == 0 and _finder in sys.meta_path:
+            sys.meta_path.remove(_finder)
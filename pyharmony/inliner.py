@@ -0,0 +1,95 @@
+"""
+Contains support for splicing the bodies of small hook functions directly into their targets, instead of calling them.
+"""
+
+import inspect
+import types
+from typing import Callable, List, Optional
+from bytecode import Bytecode, Instr, Label, SetLineno
+from . import assembler, opcodes
+
+# Hooks with more instructions than this are always called, as the call overhead no longer matters much next to their body
+MAX_INSTRUCTIONS = 48
+
+_UNSUPPORTED_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR \
+    | inspect.CO_VARARGS | inspect.CO_VARKEYWORDS
+
+# Instructions that only work in a frame of the hook's own: closures, nested functions, generators, exception handling, imports,
+#   and anything that reads or writes a namespace other than the hook's local variables.
+# That includes globals and builtins: looking them up in the hook's namespace on every call costs more than the call it saves
+_UNSUPPORTED_OPCODES = frozenset((
+    opcodes.LOAD_DEREF, opcodes.STORE_DEREF, opcodes.DELETE_DEREF, opcodes.LOAD_CLOSURE, opcodes.LOAD_CLASSDEREF, opcodes.LOAD_FROM_DICT_OR_DEREF,
+    opcodes.MAKE_CELL, opcodes.COPY_FREE_VARS, opcodes.MAKE_FUNCTION, opcodes.LOAD_BUILD_CLASS, opcodes.LOAD_SUPER_ATTR,
+    opcodes.LOAD_NAME, opcodes.STORE_NAME, opcodes.DELETE_NAME, opcodes.LOAD_LOCALS, opcodes.LOAD_FROM_DICT_OR_GLOBALS,
+    opcodes.LOAD_GLOBAL, opcodes.STORE_GLOBAL, opcodes.DELETE_GLOBAL, opcodes.IMPORT_NAME, opcodes.IMPORT_FROM, opcodes.IMPORT_STAR, opcodes.SETUP_ANNOTATIONS,
+    opcodes.YIELD_VALUE, opcodes.YIELD_FROM, opcodes.GET_AWAITABLE, opcodes.RETURN_GENERATOR, opcodes.SEND,
+    opcodes.SETUP_FINALLY, opcodes.SETUP_WITH, opcodes.SETUP_ASYNC_WITH, opcodes.BEFORE_WITH, opcodes.POP_BLOCK, opcodes.POP_EXCEPT,
+    opcodes.END_FINALLY, opcodes.BEGIN_FINALLY, opcodes.CALL_FINALLY, opcodes.POP_FINALLY, opcodes.RERAISE, opcodes.PUSH_EXC_INFO,
+))
+
+
+def inline_call(hook_func: Callable, arg_count: int, local_prefix: str) -> Optional[List[object]]:
+    """
+    Returns the body of a hook function, rewritten so it can be spliced into another function in place of calling it.
+    Returns None if the hook can't be inlined, in which case it has to be called as normal.
+
+    The arguments are expected to be on the stack, the same as for a call, and the return value is left on the stack.
+    Local variables of the hook are renamed by adding local_prefix, so they don't clash with the target's.
+    Hooks that use global variables or builtins aren't inlined, as the body would otherwise see the globals of the target instead.
+    """
+
+    if not isinstance(hook_func, types.FunctionType):
+        return None
+
+    code = hook_func.__code__
+
+    # Python 3.11+ keeps try blocks in an exception table, instead of using instructions
+    if code.co_flags & _UNSUPPORTED_FLAGS or code.co_freevars or code.co_cellvars or len(getattr(code, "co_exceptiontable", b"")) > 0:
+        return None
+
+    if code.co_argcount != arg_count or code.co_kwonlyargcount != 0:
+        return None
+
+    hook_bytecode = Bytecode.from_code(code)
+
+    if sum(1 for instr in hook_bytecode if isinstance(instr, Instr)) > MAX_INSTRUCTIONS:
+        return None
+
+    local_names = {name: local_prefix + name for name in code.co_varnames}
+    return_label = Label()
+
+    # Move the arguments off the stack, into the hook's (renamed) parameters
+    body: List[object] = [Instr(opcodes.STORE_FAST, local_names[name]) for name in reversed(code.co_varnames[:arg_count])]
+
+    for instr in hook_bytecode:
+        if isinstance(instr, (Label, SetLineno)):
+            # Line numbers of the hook would be attributed to the target's file, so the target's own are kept instead
+            if isinstance(instr, Label):
+                body.append(instr)
+
+            continue
+
+        if instr.name in _UNSUPPORTED_OPCODES or (instr.name == opcodes.RAISE_VARARGS and instr.arg == 0):
+            return None
+
+        if instr.name == opcodes.RESUME:
+            # Only found at the start, as hooks can't yield
+            continue
+
+        if instr.name == opcodes.RETURN_VALUE:
+            body.extend(assembler.jump(return_label))
+        elif instr.name == opcodes.RETURN_CONST:
+            body.append(Instr(opcodes.LOAD_CONST, instr.arg))
+            body.extend(assembler.jump(return_label))
+        elif len(assembler.get_local_names(instr)) > 0:
+            body.append(assembler.rename_locals(instr, local_names))
+        else:
+            body.append(Instr(instr.name, instr.arg))
+
+    # The last return can just fall through
+    if len(body) > 0 and isinstance(body[-1], Instr) and body[-1].has_jump() and body[-1].arg is return_label:
+        body.pop()
+
+    body.append(return_label)
+
+    return body
@@ -122,3 +122,61 @@ LOAD_METHOD = "LOAD_METHOD"
 CALL_METHOD = "CALL_METHOD"
 CALL_FINALLY = "CALL_FINALLY"
 POP_FINALLY = "POP_FINALLY"
+
+# Added in Python 3.9
+
+IS_OP = "IS_OP"
+CONTAINS_OP = "CONTAINS_OP"
+RERAISE = "RERAISE"
+
+# Added in Python 3.10
+
+GEN_START = "GEN_START"
+
+# Added in Python 3.11
+
+CACHE = "CACHE"
+PUSH_NULL = "PUSH_NULL"
+PUSH_EXC_INFO = "PUSH_EXC_INFO"
+CHECK_EXC_MATCH = "CHECK_EXC_MATCH"
+RETURN_GENERATOR = "RETURN_GENERATOR"
+SEND = "SEND"
+SWAP = "SWAP"
+COPY = "COPY"
+BINARY_OP = "BINARY_OP"
+JUMP_BACKWARD = "JUMP_BACKWARD"
+JUMP_BACKWARD_NO_INTERRUPT = "JUMP_BACKWARD_NO_INTERRUPT"
+POP_JUMP_FORWARD_IF_FALSE = "POP_JUMP_FORWARD_IF_FALSE"
+POP_JUMP_FORWARD_IF_TRUE = "POP_JUMP_FORWARD_IF_TRUE"
+POP_JUMP_FORWARD_IF_NONE = "POP_JUMP_FORWARD_IF_NONE"
+POP_JUMP_FORWARD_IF_NOT_NONE = "POP_JUMP_FORWARD_IF_NOT_NONE"
+MAKE_CELL = "MAKE_CELL"
+COPY_FREE_VARS = "COPY_FREE_VARS"
+RESUME = "RESUME"
+PRECALL = "PRECALL"
+CALL = "CALL"
+KW_NAMES = "KW_NAMES"
+BEFORE_WITH = "BEFORE_WITH"
+
+# Added in Python 3.12
+
+RETURN_CONST = "RETURN_CONST"
+END_SEND = "END_SEND"
+CLEANUP_THROW = "CLEANUP_THROW"
+CALL_INTRINSIC_1 = "CALL_INTRINSIC_1"
+POP_JUMP_IF_NONE = "POP_JUMP_IF_NONE"
+POP_JUMP_IF_NOT_NONE = "POP_JUMP_IF_NOT_NONE"
+LOAD_FAST_CHECK = "LOAD_FAST_CHECK"
+LOAD_FAST_AND_CLEAR = "LOAD_FAST_AND_CLEAR"
+LOAD_SUPER_ATTR = "LOAD_SUPER_ATTR"
+LOAD_LOCALS = "LOAD_LOCALS"
+LOAD_FROM_DICT_OR_DEREF = "LOAD_FROM_DICT_OR_DEREF"
+LOAD_FROM_DICT_OR_GLOBALS = "LOAD_FROM_DICT_OR_GLOBALS"
+
+# Added in Python 3.13
+
+TO_BOOL = "TO_BOOL"
+SET_FUNCTION_ATTRIBUTE = "SET_FUNCTION_ATTRIBUTE"
+LOAD_FAST_LOAD_FAST = "LOAD_FAST_LOAD_FAST"
+STORE_FAST_LOAD_FAST = "STORE_FAST_LOAD_FAST"
+STORE_FAST_STORE_FAST = "STORE_FAST_STORE_FAST"
@@ -0,0 +1,140 @@
+"""
+Contains support for compiling patched code in a pool of worker processes.
+"""
+
+import concurrent.futures
+import marshal
+import multiprocessing
+import os
+import pickle
+import threading
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .pyharmony import _Reevaluation
+
+# Starting worker processes is far more expensive than the compiling itself (each one has to import pyharmony and the modules of the hooks),
+#   so the pool is kept around and reused by later calls with the same amount of workers. Idle workers are shut down when the interpreter exits
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_pid = 0
+_pool_lock = threading.Lock()
+
+
+def compile_reevaluations(reevaluations: List["_Reevaluation"], workers: int) -> None:
+    """
+    Compiles the code objects of multiple pending reevaluations in a pool of worker processes, and stores them in reevaluation.new_code.
+
+    Original code objects are sent to the workers through marshal, and patches are pickled with their hooks referenced by name.
+    Any reevaluation that can't be sent to a worker (or fails to compile there) is left untouched, so it can be compiled serially instead.
+
+    The worker processes are started by the first call, and reused by later ones (see _get_pool()).
+    """
+
+    jobs = []
+
+    for reevaluation in reevaluations:
+        job = _create_job(reevaluation)
+
+        if job is not None:
+            jobs.append((reevaluation, job))
+
+    if len(jobs) == 0:
+        return
+
+    try:
+        pool = _get_pool(workers)
+        results = list(pool.map(_compile_job, [job for _, job in jobs], chunksize=max(1, len(jobs) // (workers * 4))))
+    except (OSError, RuntimeError, concurrent.futures.process.BrokenProcessPool):
+        # Worker processes aren't available here (or one of them died), so everything gets compiled serially
+        _discard_pool()
+        return
+
+    from . import diskcache
+
+    for (reevaluation, _), result in zip(jobs, results):
+        if result is None:
+            continue
+
+        code_bytes, links = result
+
+        # The hooks in the compiled code are copies from the worker, so swap our own in
+        reevaluation.new_code = diskcache.link_code(marshal.loads(code_bytes), links, reevaluation.get_link_objects())
+
+
+def _get_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Returns the pool of worker processes, starting a new one if there isn't one with the requested amount of workers.
+
+    A pool inherited from the parent process through fork() can't be used, as its workers belong to the parent.
+
+    Workers are never forked from this process directly. Compiling happens outside of _state_lock, so another thread could be holding it
+    (or any other lock) at that moment, and a forked worker would wait on its copy of the lock forever.
+    """
+
+    global _pool, _pool_workers, _pool_pid    # pylint: disable=global-statement
+
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers or _pool_pid != os.getpid():
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.shutdown(wait=False)
+
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+            _pool_workers = workers
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def _discard_pool() -> None:
+    global _pool    # pylint: disable=global-statement
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False)
+
+        _pool = None
+
+
+def _create_job(reevaluation: "_Reevaluation") -> Optional[bytes]:
+    """
+    Pickles everything a worker needs to compile a reevaluation, or returns None if that isn't possible.
+    """
+
+    try:
+        code_bytes = marshal.dumps(reevaluation.func_def_code)
+
+        # Targets can't be pickled, and aren't needed for compiling anyway
+        patch_lists = tuple([patch._detached_copy() for patch in plist]
+                            for plist in (reevaluation.our_transpilers, reevaluation.our_prefixes, reevaluation.our_postfixes, reevaluation.our_finalizers))
+
+        return pickle.dumps((code_bytes, patch_lists))
+    except (ValueError, TypeError, AttributeError, pickle.PicklingError):
+        # Most likely a hook that can't be imported by name, such as a lambda or nested function
+        return None
+
+
+def _compile_job(job: bytes) -> Optional[Tuple[bytes, tuple]]:
+    """
+    Runs in a worker process. Returns the marshalled patched code, along with the links required to turn it back into a working code object.
+    """
+
+    from . import diskcache
+    from .pyharmony import _compile_function, _get_link_objects
+
+    try:
+        code_bytes, (our_transpilers, our_prefixes, our_postfixes, our_finalizers) = pickle.loads(job)
+
+        func_def_code = marshal.loads(code_bytes)
+
+        new_code = _compile_function(func_def_code, our_transpilers, our_prefixes, our_postfixes, our_finalizers)
+        unlinked = diskcache.unlink_code(new_code, _get_link_objects(func_def_code, our_prefixes, our_postfixes, our_finalizers))
+
+        if unlinked is None:
+            return None
+
+        return marshal.dumps(unlinked[0]), unlinked[1]
+    except Exception:    # pylint: disable=broad-except
+        # Let the main process compile it instead, so any errors are raised from there
+        return None
@@ -2,230 +2,2542 @@
 Contains the main functionality, classes and decorators for pyHarmony.
 """
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import contextlib
+import copy
+import dis
+import inspect
+import itertools
+import os
+import sys
+import threading
+import time
 import types
-from typing import Callable, List, Dict, Optional, Tuple
-from bytecode import Bytecode, Instr, Label
-from . import opcodes
+import warnings
+import weakref
+from typing import Callable, ContextManager, Iterable, Iterator, List, Dict, Optional, Tuple, Union
+from bytecode import Bytecode, Instr, Label, TryBegin, TryEnd
+from . import assembler, diskcache, importhook, inliner, opcodes, parallel, state, trampoline
 
 
 # Type hinting declarations
 
-FunctionTarget = Tuple[object, str]
-FunctionDefinition = Tuple[types.FunctionType, types.CodeType]
+PatchTarget = namedtuple("PatchTarget", ["target_object", "target_function_name"])
+
+# Identifies a target by the id() of its object, so the object itself doesn't have to be referenced. String targets that are waiting for
+#   their module to be imported use the dotted path of their object instead, as they don't have one yet (see Patch._bind_target())
+_TargetKey = Tuple[Union[int, str], str]
+
+_InjectedParameter = namedtuple("_InjectedParameter", ["name", "writable"])
+
+_ASYNC_OR_GENERATOR_FLAGS = inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+
+_ASYNC_FLAGS = inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+
+
+class Ref:
+    """
+    A mutable reference to a value of the target function, passed to injected hooks.
+
+    Annotate a parameter of an injected hook with Ref (or Ref[T]) to receive the value wrapped in a Ref.
+    Anything assigned to Ref.value is stored back into the target function after the hook returns.
+    """
+
+    __slots__ = ("value", )
+
+    def __init__(self, value: object) -> None:
+        self.value = value
+
+    def __class_getitem__(cls, item: object) -> type:
+        # Allows Ref[int] style annotations, which are treated the same as a plain Ref
+        return cls
+
+    def __repr__(self) -> str:
+        return f"Ref({self.value!r})"
+
+
+def _is_ref_annotation(annotation: object) -> bool:
+    """
+    Determines if a parameter annotation marks the parameter as a writable Ref.
+    """
+
+    if annotation is Ref:
+        return True
+
+    if isinstance(annotation, str):
+        # Annotations may be strings, either written explicitly or through "from __future__ import annotations"
+        annotation = annotation.split("[", 1)[0].strip()
+        return annotation in ("Ref", "pyharmony.Ref")
+
+    return False
+
+
+def _get_injected_parameters(hook_func: Callable) -> List[_InjectedParameter]:
+    """
+    Reads the parameters that an injected hook requests from the target function.
+    """
+
+    parameters = []
+
+    for param in inspect.signature(hook_func).parameters.values():
+        if param.kind not in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
+            raise ValueError(f"Injected hook {hook_func.__name__} can only declare positional parameters, but '{param.name}' is {param.kind.description}")
+
+        parameters.append(_InjectedParameter(param.name, _is_ref_annotation(param.annotation)))
+
+    return parameters
+
+
+def _is_special_name(name: str, special_name: str) -> bool:
+    """
+    Determines if an injected parameter name refers to a special value, such as "__result".
+
+    Hooks defined inside of a class body have their parameter names mangled, so that form is accepted too.
+    """
+
+    return name == special_name or (name.startswith("_") and name.endswith(special_name) and not name.startswith("__"))
+
+
+def _is_result_name(name: str) -> bool:
+    """
+    Determines if an injected parameter name refers to the result of the target function.
+    """
+
+    return _is_special_name(name, "__result")
+
+
+def _is_exception_name(name: str) -> bool:
+    """
+    Determines if an injected parameter name refers to the exception raised by the target function.
+    """
+
+    return _is_special_name(name, "__exception")
+
+
+def _returns_none_only(hook_func: Callable) -> bool:
+    """
+    Determines if a hook function can only ever return None, by checking what each of its return instructions returns.
+    """
+
+    code = getattr(hook_func, "__code__", None)
+
+    if code is None or code.co_flags & _ASYNC_OR_GENERATOR_FLAGS:
+        return False
+
+    previous_instruction = None
+
+    for instruction in dis.get_instructions(code):
+        if instruction.opname == opcodes.RETURN_CONST:
+            if instruction.argval is not None:
+                return False
+
+        elif instruction.opname == opcodes.RETURN_VALUE:
+            if instruction.is_jump_target or previous_instruction is None:
+                return False
+
+            if previous_instruction.opname != opcodes.LOAD_CONST or previous_instruction.argval is not None:
+                return False
+
+        previous_instruction = instruction
+
+    return True
+
+
+def _prefix_result_check(patch: "Patch", skip_label: Optional[Label] = None) -> List[Instr]:
+    """
+    Returns the instructions that check the return value of a prefix, which is expected to be on top of the stack.
+
+    None and truthy values continue, while any other falsy value exits the function (or jumps to skip_label, if supplied).
+    """
+
+    if _returns_none_only(patch.prefix_func):
+        # Nothing to check
+        return [Instr(opcodes.POP_TOP)]
+
+    none_label = Label()
+    continue_label = Label()
+
+    if skip_label is not None:
+        exit_instructions = assembler.jump(skip_label)
+    else:
+        exit_instructions = assembler.return_constant(None)
+
+    return [
+        *assembler.dup_top(),
+        *assembler.pop_jump_if_none(none_label),
+        *assembler.pop_jump_if_true(continue_label),
+
+        # Exit if false
+        *_instrument_skip(patch),
+        *exit_instructions,
+
+        none_label,
+        Instr(opcodes.POP_TOP),
+        continue_label,
+    ]
+
+
+def _validate_guards(bytecode: Bytecode, patch: "Patch", special_names: Iterable[str] = ()) -> None:
+    """
+    Checks that every guard of a patch checks a value it has access to.
+    """
+
+    for guard in patch.guards:
+        if guard.name not in bytecode.argnames and not any(_is_special_name(guard.name, name) for name in special_names):
+            raise ValueError(f"A guard of {patch.patch_name} checks '{guard.name}', which is not an argument of {patch.target.target_function_name}")
+
+
+def _is_conditional(patch: "Patch") -> bool:
+    """
+    Determines if a hook might not be called when its target runs, because of guards, sampling or a rate limit.
+    """
+
+    return len(patch.guards) > 0 or patch.sample_every is not None or patch.rate_limit is not None
+
+
+def _guard_instructions(bytecode: Bytecode, patch: "Patch", skip_label: Label, special_variables: Optional[Dict[str, str]] = None) -> List[Instr]:
+    """
+    Returns the instructions that check the guards of a patch, jumping to skip_label if any of them doesn't hold. Stack neutral.
+
+    Sampling and the rate limit are checked last, so they only count calls that pass every guard.
+    special_variables maps special names (such as "__result") to the variables holding their values.
+    """
+
+    instruction_set = []
+
+    for guard in patch.guards:
+        variable = next((v for name, v in (special_variables or {}).items() if _is_special_name(guard.name, name)), None)
+
+        if variable is not None:
+            load_instructions = [Instr(opcodes.LOAD_FAST, variable)]
+        else:
+            load_instructions = assembler.load_variable(bytecode, guard.name)
+
+        is_bool = False
+
+        if guard.kind == Guard.IS_NONE:
+            instruction_set.extend(load_instructions)
+            instruction_set.extend(assembler.pop_jump_if_none(skip_label) if guard.negated else assembler.pop_jump_if_not_none(skip_label))
+            continue
+
+        if guard.kind == Guard.IS_INSTANCE:
+            instruction_set.extend(assembler.load_callable(isinstance))
+            instruction_set.extend(load_instructions)
+            instruction_set.append(Instr(opcodes.LOAD_CONST, guard.value))
+            instruction_set.extend(assembler.call(2))
+            is_bool = True
+
+        elif guard.kind == Guard.EQUALS:
+            instruction_set.extend(load_instructions)
+            instruction_set.append(Instr(opcodes.LOAD_CONST, guard.value))
+            instruction_set.extend(assembler.compare_op("=="))
+
+        elif guard.kind == Guard.HAS_FLAG:
+            instruction_set.extend(load_instructions)
+            instruction_set.extend(assembler.load_attr(guard.value))
+
+        else:
+            raise ValueError(f"Unknown guard kind {guard.kind!r}")
+
+        if guard.negated:
+            instruction_set.extend(assembler.pop_jump_if_true(skip_label, is_bool))
+        else:
+            instruction_set.extend(assembler.pop_jump_if_false(skip_label, is_bool))
+
+    instruction_set.extend(_sampling_instructions(patch, skip_label))
+
+    return instruction_set
+
+
+def _sampling_instructions(patch: "Patch", skip_label: Label) -> List[Instr]:
+    """
+    Returns the instructions that skip all but one call out of every sample_every, and any calls over the rate limit. Stack neutral.
+
+    The counters aren't protected by a lock, so threads calling the target at the same time can make sampling slightly uneven.
+    """
+
+    instruction_set = []
+    sample_state = patch._sample_state
+
+    if patch.sample_every is not None:
+        # if (sample_state.calls := sample_state.calls + 1) % sample_every: skip
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.extend(assembler.load_attr("calls"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, 1))
+        instruction_set.extend(assembler.binary_op("+"))
+        instruction_set.extend(assembler.dup_top())
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.append(Instr(opcodes.STORE_ATTR, "calls"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, patch.sample_every))
+        instruction_set.extend(assembler.binary_op("%"))
+        instruction_set.extend(assembler.pop_jump_if_true(skip_label))
+
+    if patch.rate_limit is not None:
+        # Count calls in windows of a second, and skip once a window has had rate_limit of them
+        in_window_label = Label()
+        count_label = Label()
+
+        instruction_set.extend(assembler.load_callable(time.monotonic))
+        instruction_set.extend(assembler.call(0))
+        instruction_set.extend(assembler.dup_top())
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.extend(assembler.load_attr("window_end"))
+        instruction_set.extend(assembler.compare_op("<"))
+        instruction_set.extend(assembler.pop_jump_if_true(in_window_label, is_bool=True))
+
+        # Start a new window
+        instruction_set.append(Instr(opcodes.LOAD_CONST, 1.0))
+        instruction_set.extend(assembler.binary_op("+"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.append(Instr(opcodes.STORE_ATTR, "window_end"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, 0))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.append(Instr(opcodes.STORE_ATTR, "window_calls"))
+        instruction_set.extend(assembler.jump(count_label))
+
+        instruction_set.append(in_window_label)
+        instruction_set.append(Instr(opcodes.POP_TOP))
+
+        instruction_set.append(count_label)
+        instruction_set.append(Instr(opcodes.LOAD_CONST, sample_state))
+        instruction_set.extend(assembler.load_attr("window_calls"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, patch.rate_limit))
+        instruction_set.extend(assembler.compare_op(">="))
+        instruction_set.extend(assembler.pop_jump_if_true(skip_label, is_bool=True))
+        instruction_set.extend(_increment_stat(sample_state, "window_calls"))
+
+    return instruction_set
+
+
+def _is_async_hook(hook_func: Callable) -> bool:
+    return inspect.iscoroutinefunction(hook_func)
+
+
+def _await_instructions(hook_func: Callable) -> List[Instr]:
+    """
+    Returns the instructions that await the return value of a hook, if it is an async hook. Only valid inside of a coroutine or async generator.
+    """
+
+    if not _is_async_hook(hook_func):
+        return []
+
+    return assembler.await_value()
+
+
+def _call_hook(patch: "Patch", hook_func: Callable, arguments: List[Instr], arg_count: int, local_prefix: str) -> List[object]:
+    """
+    Returns the instructions that call a hook with the values pushed by arguments (awaiting it if it's async), leaving its return value on the stack.
+
+    Inlined patches have the body of the hook spliced in instead, with its local variables renamed using local_prefix.
+    Hooks that can't be inlined (see inliner.inline_call()) are called as normal.
+    """
+
+    if patch.inline:
+        inlined_body = inliner.inline_call(hook_func, arg_count, local_prefix)
+
+        if inlined_body is not None:
+            return [*arguments, *inlined_body]
+
+    return [*assembler.load_callable(hook_func), *arguments, *assembler.call(arg_count), *_await_instructions(hook_func)]
+
+
+def _instrument_before_call(patch: "Patch") -> List[Instr]:
+    """
+    Returns the instructions that record a call to a hook, placed before it is called. Stack neutral.
+
+    Returns nothing if the patch isn't instrumented, so uninstrumented code is left exactly as it was.
+    """
+
+    if patch.instrumentation is None:
+        return []
+
+    instruction_set = _increment_stat(patch.stats, "calls")
+
+    if patch.instrumentation == INSTRUMENT_TIMING:
+        instruction_set.extend(assembler.load_callable(time.perf_counter))
+        instruction_set.extend(assembler.call(0))
+        instruction_set.append(Instr(opcodes.STORE_FAST, "_pyharmony_timer"))
+
+    elif patch.instrumentation == INSTRUMENT_SAMPLED_TIMING:
+        # Only start the timer every sample_interval calls, and leave it as None otherwise
+        skip_label = Label()
+
+        instruction_set.append(Instr(opcodes.LOAD_CONST, None))
+        instruction_set.append(Instr(opcodes.STORE_FAST, "_pyharmony_timer"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, patch.stats))
+        instruction_set.extend(assembler.load_attr("calls"))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, patch.sample_interval))
+        instruction_set.extend(assembler.binary_op("%"))
+        instruction_set.extend(assembler.pop_jump_if_true(skip_label))
+        instruction_set.extend(assembler.load_callable(time.perf_counter))
+        instruction_set.extend(assembler.call(0))
+        instruction_set.append(Instr(opcodes.STORE_FAST, "_pyharmony_timer"))
+        instruction_set.append(skip_label)
+
+    return instruction_set
+
+
+def _instrument_after_call(patch: "Patch") -> List[Instr]:
+    """
+    Returns the instructions that stop the timer started by _instrument_before_call(). Stack neutral, so the return value of the hook can stay on the stack.
+    """
+
+    if patch.instrumentation not in (INSTRUMENT_TIMING, INSTRUMENT_SAMPLED_TIMING):
+        return []
+
+    instruction_set = []
+    skip_label = Label()
+
+    if patch.instrumentation == INSTRUMENT_SAMPLED_TIMING:
+        instruction_set.append(Instr(opcodes.LOAD_FAST, "_pyharmony_timer"))
+        instruction_set.extend(assembler.pop_jump_if_none(skip_label))
+
+    # stats.time += time.perf_counter() - _pyharmony_timer
+    instruction_set.extend(assembler.load_callable(time.perf_counter))
+    instruction_set.extend(assembler.call(0))
+    instruction_set.append(Instr(opcodes.LOAD_FAST, "_pyharmony_timer"))
+    instruction_set.extend(assembler.binary_op("-"))
+    instruction_set.append(Instr(opcodes.LOAD_CONST, patch.stats))
+    instruction_set.extend(assembler.load_attr("time"))
+    instruction_set.extend(assembler.binary_op("+"))
+    instruction_set.append(Instr(opcodes.LOAD_CONST, patch.stats))
+    instruction_set.append(Instr(opcodes.STORE_ATTR, "time"))
+    instruction_set.extend(_increment_stat(patch.stats, "timed_calls"))
+
+    if patch.instrumentation == INSTRUMENT_SAMPLED_TIMING:
+        instruction_set.append(skip_label)
+
+    return instruction_set
+
+
+def _instrument_skip(patch: "Patch") -> List[Instr]:
+    """
+    Returns the instructions that record a prefix skipping the original function.
+    """
+
+    if patch.instrumentation is None:
+        return []
+
+    return _increment_stat(patch.stats, "skips")
+
+
+def _increment_stat(stats: object, attribute: str) -> List[Instr]:
+    return [
+        Instr(opcodes.LOAD_CONST, stats),
+        *assembler.load_attr(attribute),
+        Instr(opcodes.LOAD_CONST, 1),
+        *assembler.binary_op("+"),
+        Instr(opcodes.LOAD_CONST, stats),
+        Instr(opcodes.STORE_ATTR, attribute),
+    ]
+
+
+def _assemble_prefix(bytecode: Bytecode, prefixes: List["Patch"], skip_label: Optional[Label] = None, state_class: Optional[type] = None) -> None:
+    """
+    Inserts the required bytecode for prefix functionality.
+
+    Each prefix is called directly in priority order, with the early exit check done inline.
+    Regular prefixes share a single state dictionary, which is only built if there is at least one of them. If state_class is supplied,
+    they share an instance of it instead (see _get_state_classes()).
+    If skip_label is supplied, prefixes jump to it to skip the original function instead of returning None.
+    """
+
+    instruction_set = []
+
+    for patch in prefixes:
+        for param in patch.injected_params:
+            if param.name not in bytecode.argnames:
+                raise ValueError(f"Prefix {patch.patch_name} requests parameter '{param.name}', which is not an argument of {patch.target.target_function_name}")
+
+        _validate_guards(bytecode, patch)
+
+    state_variable = "_pyharmony_prefix_state"
+
+    # Keep track of which copy of the arguments is up to date, so we only move values between them when needed
+
+    state_built = False
+    stale_state_args = set()    # Arguments changed by injected prefixes since they were put in the dictionary
+    stale_args = False    # Whether or not a regular prefix might have changed arguments in the dictionary
+
+    for index, patch in enumerate(prefixes):
+        guard_label = None
+        local_prefix = f"_pyharmony_prefix{index}_"
+
+        if _is_conditional(patch):
+            # The prefix might not be called, so the arguments have to be up to date whichever way we come out of it
+            if stale_args:
+                instruction_set.extend(_read_args_from_state(bytecode, state_variable, state_class))
+                stale_args = False
+
+            guard_label = Label()
+            guarded_state_built = state_built
+            guarded_stale_state_args = set(stale_state_args)
+
+            instruction_set.extend(_guard_instructions(bytecode, patch, guard_label))
+
+        if not patch.inject:
+            if not state_built:
+                # Create an empty dictionary (or state object) and put it in a variable named "_pyharmony_prefix_state"
+                instruction_set.extend(_create_state(state_class, state_variable))
+                stale_state_args = set(bytecode.argnames)
+                state_built = True
+
+            for arg_name in bytecode.argnames:
+                if arg_name in stale_state_args and _is_state_field(state_class, arg_name):
+                    # Insert each argument into the dictionary
+                    instruction_set.extend(assembler.load_variable(bytecode, arg_name))
+                    instruction_set.extend(_store_state_value(state_class, state_variable, arg_name))
+
+            stale_state_args.clear()
+
+            # Call the prefix with the dictionary
+            instruction_set.extend(_instrument_before_call(patch))
+            instruction_set.extend(_call_hook(patch, patch.prefix_func, _pass_state(patch, state_class, state_variable), 1, local_prefix))
+            instruction_set.extend(_instrument_after_call(patch))
+
+            stale_args = True
+
+        else:
+            if stale_args:
+                instruction_set.extend(_read_args_from_state(bytecode, state_variable, state_class))
+                stale_args = False
+
+            # Call the prefix, passing each requested argument positionally
+            arguments = []
+
+            for param in patch.injected_params:
+                if param.writable:
+                    # Wrap the argument in a Ref, and keep a copy of the Ref around so we can read it back later
+                    arguments.extend(assembler.load_callable(Ref))
+                    arguments.extend(assembler.load_variable(bytecode, param.name))
+                    arguments.extend(assembler.call(1))
+                    arguments.extend(assembler.dup_top())
+                    arguments.append(Instr(opcodes.STORE_FAST, "_pyharmony_ref_" + param.name))
+                else:
+                    arguments.extend(assembler.load_variable(bytecode, param.name))
+
+            instruction_set.extend(_instrument_before_call(patch))
+            instruction_set.extend(_call_hook(patch, patch.prefix_func, arguments, len(patch.injected_params), local_prefix))
+            instruction_set.extend(_instrument_after_call(patch))
+
+            # Store any writable arguments back. The return value of the prefix stays on the stack while we do this
+
+            for param in patch.injected_params:
+                if param.writable:
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, "_pyharmony_ref_" + param.name))
+                    instruction_set.extend(assembler.load_attr("value"))
+                    instruction_set.extend(assembler.store_variable(bytecode, param.name))
+
+                    if state_built:
+                        stale_state_args.add(param.name)
+
+        # Check if the prefix returned true or false
+
+        instruction_set.extend(_prefix_result_check(patch, skip_label))
+
+        if guard_label is not None:
+            if stale_args:
+                instruction_set.extend(_read_args_from_state(bytecode, state_variable, state_class))
+                stale_args = False
+
+            instruction_set.append(guard_label)
+
+            # The dictionary is only guaranteed to exist (and be as up to date) as it was before the prefix
+            state_built = guarded_state_built
+            stale_state_args |= guarded_stale_state_args
+
+    # Otherwise continue, and set parameters to the potentially modified values of the dictionary
+
+    if stale_args:
+        instruction_set.extend(_read_args_from_state(bytecode, state_variable, state_class))
+
+    # Done with assembling, main execution begins here
+
+    # Insert instructions to the start of the function
+
+    body_start = assembler.get_body_start(bytecode)
+    bytecode[body_start:body_start] = instruction_set
+
+
+def _read_args_from_state(bytecode: Bytecode, state_variable: str, state_class: Optional[type] = None) -> List[Instr]:
+    """
+    Returns the instructions that set each argument to its value in a state dictionary (or state object, if state_class is supplied).
+    """
+
+    instruction_set = []
+
+    for arg_name in bytecode.argnames:
+        if _is_state_field(state_class, arg_name):
+            instruction_set.extend(_load_state_value(state_class, state_variable, arg_name))
+            instruction_set.extend(assembler.store_variable(bytecode, arg_name))
+
+    return instruction_set
+
+
+def _create_state(state_class: Optional[type], state_variable: str) -> List[Instr]:
+    """
+    Returns the instructions that store an empty state dictionary in a variable, or an empty instance of state_class if it's supplied.
+    """
+
+    if state_class is None:
+        return [Instr(opcodes.BUILD_MAP, 0), Instr(opcodes.STORE_FAST, state_variable)]
+
+    return [*assembler.load_callable(state_class), *assembler.call(0), Instr(opcodes.STORE_FAST, state_variable)]
+
+
+def _is_state_field(state_class: Optional[type], name: str) -> bool:
+    """
+    Returns whether a value can be put in the state. Dictionaries take anything, while state objects only have their fields.
+    """
+
+    return state_class is None or name in state_class.__slots__
+
+
+def _store_state_value(state_class: Optional[type], state_variable: str, name: str) -> List[Instr]:
+    """
+    Returns the instructions that move the value on top of the stack into a state dictionary or object.
+    """
+
+    if state_class is None:
+        return [Instr(opcodes.LOAD_FAST, state_variable), Instr(opcodes.LOAD_CONST, name), Instr(opcodes.STORE_SUBSCR)]
+
+    return [Instr(opcodes.LOAD_FAST, state_variable), Instr(opcodes.STORE_ATTR, name)]
+
+
+def _load_state_value(state_class: Optional[type], state_variable: str, name: str) -> List[Instr]:
+    """
+    Returns the instructions that push a value of a state dictionary or object onto the stack.
+    """
+
+    if state_class is None:
+        return [Instr(opcodes.LOAD_FAST, state_variable), Instr(opcodes.LOAD_CONST, name), Instr(opcodes.BINARY_SUBSCR)]
+
+    return [Instr(opcodes.LOAD_FAST, state_variable), *assembler.load_attr(name)]
+
+
+def _pass_state(patch: "Patch", state_class: Optional[type], state_variable: str) -> List[Instr]:
+    """
+    Returns the instructions that push the state for a regular hook. Hooks that don't use state objects get a StateView of one instead.
+    """
+
+    if state_class is not None and not patch.state_object:
+        return [*assembler.load_callable(state.StateView), Instr(opcodes.LOAD_FAST, state_variable), *assembler.call(1)]
+
+    return [Instr(opcodes.LOAD_FAST, state_variable)]
+
+
+def _get_local_names(bytecode: Bytecode) -> List[str]:
+    """
+    Returns the names of all local variables used by the bytecode that aren't arguments, in order of first use.
+    """
+
+    argnames = set(bytecode.argnames)
+    local_names = {}
+
+    for instruction in bytecode:
+        if isinstance(instruction, Instr):
+            for name in assembler.get_local_names(instruction):
+                if name not in argnames:
+                    local_names[name] = None
+
+    return list(local_names)
+
+
+def _get_assigned_at_returns(bytecode: Bytecode, names: List[str]) -> Dict[int, frozenset]:
+    """
+    Performs a definite assignment analysis of the given local variable names.
+
+    Returns the subset of names that are guaranteed to be assigned at each RETURN_VALUE instruction, keyed by the index of the instruction.
+    """
+
+    # Variables that can be cleared without a DELETE_FAST are never trusted to be assigned
+    cleared_names = {name for instruction in bytecode if isinstance(instruction, Instr) and instruction.name == opcodes.LOAD_FAST_AND_CLEAR
+                     for name in assembler.get_cleared_names(instruction)}
+
+    tracked_names = frozenset(names) - cleared_names
+    label_indexes = {item: index for index, item in enumerate(bytecode) if isinstance(item, Label)}
+
+    # The state for each index is the set of names assigned before the instruction at that index runs, or None if it hasn't been reached yet
+
+    states: List[Optional[frozenset]] = [None] * len(bytecode)
+    pending = [(0, tracked_names.intersection(bytecode.argnames))]
+
+    while pending:
+        index, assigned_names = pending.pop()
+
+        while index < len(bytecode):
+            current_names = states[index]
+
+            if current_names is not None:
+                if current_names <= assigned_names:
+                    # Nothing new can be learned by continuing down this path
+                    break
+
+                assigned_names = current_names & assigned_names
+
+            states[index] = assigned_names
+            instruction = bytecode[index]
+
+            if isinstance(instruction, TryBegin):
+                # Treat the exception handler as reachable from the start of the try block
+                pending.append((label_indexes[instruction.target], assigned_names))
+
+            elif isinstance(instruction, Instr):
+                assigned_names = (assigned_names | tracked_names.intersection(assembler.get_stored_names(instruction))) - frozenset(assembler.get_cleared_names(instruction))
+
+                if instruction.has_jump():
+                    pending.append((label_indexes[instruction.arg], assigned_names))
+
+                if instruction.is_final():
+                    break
+
+            index += 1
+
+    return {
+        index: states[index] or frozenset()
+        for index, instruction in enumerate(bytecode)
+        if isinstance(instruction, Instr) and instruction.name == opcodes.RETURN_VALUE
+    }
+
+
+def _redirect_returns(bytecode: Bytecode, names: List[str]) -> Dict[frozenset, Label]:
+    """
+    Replaces all instances of RETURN_VALUE with jumps, so code can be appended to run when the function returns.
+
+    Return sites are grouped by which of the given local variable names are definitely assigned there.
+    Returns a label for each group, which must be placed by the caller.
+    """
+
+    group_labels: Dict[frozenset, Label] = {}
+
+    assembler.expand_return_constants(bytecode)
+
+    for index, assigned_names in _get_assigned_at_returns(bytecode, names).items():
+        label = group_labels.setdefault(assigned_names, Label())
+        bytecode[index:index + 1] = assembler.jump(label)
+
+    return group_labels
+
+
+def _assemble_postfix(bytecode: Bytecode, postfixes: List["Patch"], state_class: Optional[type] = None) -> None:
+    """
+    Inserts the required bytecode for postfix functionality.
+
+    Each postfix is called directly in priority order. Regular postfixes share a single state dictionary, containing every
+    argument and local variable (or an instance of state_class if it's supplied, containing its fields). Injected postfixes
+    only capture the values they request, with local variables that are not definitely assigned at a return site passed as None.
+    """
+
+    instruction_set = []
+
+    # Get a list of variable names, and figure out which ones we need to capture
+
+    variable_names = list(bytecode.argnames) + _get_local_names(bytecode)
+    captured_names = {}
+
+    for patch in postfixes:
+        if not patch.inject:
+            captured_names.update(dict.fromkeys(variable_names))
+            continue
+
+        for param in patch.injected_params:
+            if param.name in variable_names:
+                if param.writable:
+                    raise ValueError(f"Postfix {patch.patch_name} can only write to the result, but requested '{param.name}' as a Ref")
+
+                captured_names[param.name] = None
+            elif not _is_result_name(param.name):
+                raise ValueError(f"Postfix {patch.patch_name} requests '{param.name}', which is not an argument or local variable of {patch.target.target_function_name}")
+
+    for patch in postfixes:
+        _validate_guards(bytecode, patch, ("__result", ))
+
+    # Replace all instances of RETURN_VALUE (including the prefix) to jump to our new bytecode.
+    # Each group of return sites gets its own copy of the postfix code, so we never read a variable that hasn't been assigned
+
+    group_labels = _redirect_returns(bytecode, list(captured_names))
+
+    state_variable = "_pyharmony_postfix_state"
+    result_variable = "_pyharmony_result"
+    result_ref_variable = "_pyharmony_ref_result"
+
+    for assigned_names, postfix_label in group_labels.items():
+        instruction_set.append(postfix_label)
+
+        # Move the result off the stack, where it has been lingering this entire time
+
+        instruction_set.append(Instr(opcodes.STORE_FAST, result_variable))
+
+        # Keep track of where the up to date result is, so we only move it around when needed
+
+        state_built = False
+        state_result_current = False
+        result_variable_current = True
+
+        for index, patch in enumerate(postfixes):
+            guard_label = None
+            local_prefix = f"_pyharmony_postfix{index}_"
+
+            if _is_conditional(patch):
+                # The postfix might not be called, so the result has to be in its variable whichever way we come out of it
+                if not result_variable_current:
+                    instruction_set.extend(_read_result_from_state(state_variable, result_variable, state_class))
+                    result_variable_current = True
+
+                guard_label = Label()
+                guarded_state_built = state_built
+
+                instruction_set.extend(_guard_instructions(bytecode, patch, guard_label, {"__result": result_variable}))
+
+            if not patch.inject:
+                if not state_built:
+                    # Create an empty dictionary (or state object) and put it in a variable named "_pyharmony_postfix_state"
+                    instruction_set.extend(_create_state(state_class, state_variable))
+
+                    for arg_name in variable_names:
+                        if arg_name in assigned_names and _is_state_field(state_class, arg_name):
+                            # Insert each argument and variable into the dictionary
+                            instruction_set.extend(assembler.load_variable(bytecode, arg_name))
+                            instruction_set.extend(_store_state_value(state_class, state_variable, arg_name))
+
+                    state_built = True
+
+                if not state_result_current:
+                    # Insert the result into the dictionary
+                    # This will replace any variable named "__result" but that's very unlikely
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+                    instruction_set.extend(_store_state_value(state_class, state_variable, "__result"))
+
+                # Call the postfix with the dictionary
+
+                instruction_set.extend(_instrument_before_call(patch))
+                instruction_set.extend(_call_hook(patch, patch.postfix_func, _pass_state(patch, state_class, state_variable), 1, local_prefix))
+                instruction_set.append(Instr(opcodes.POP_TOP))
+                instruction_set.extend(_instrument_after_call(patch))
+
+                state_result_current = True
+                result_variable_current = False
+
+            else:
+                if not result_variable_current:
+                    instruction_set.extend(_read_result_from_state(state_variable, result_variable, state_class))
+                    result_variable_current = True
+
+                # Call the postfix, passing each requested value positionally
+
+                arguments = []
+
+                for param in patch.injected_params:
+                    if param.name in variable_names:
+                        if param.name in assigned_names:
+                            arguments.extend(assembler.load_variable(bytecode, param.name))
+                        else:
+                            arguments.append(Instr(opcodes.LOAD_CONST, None))
+
+                    elif param.writable:
+                        arguments.extend(assembler.load_callable(Ref))
+                        arguments.append(Instr(opcodes.LOAD_FAST, result_variable))
+                        arguments.extend(assembler.call(1))
+                        arguments.extend(assembler.dup_top())
+                        arguments.append(Instr(opcodes.STORE_FAST, result_ref_variable))
+
+                    else:
+                        arguments.append(Instr(opcodes.LOAD_FAST, result_variable))
+
+                instruction_set.extend(_instrument_before_call(patch))
+                instruction_set.extend(_call_hook(patch, patch.postfix_func, arguments, len(patch.injected_params), local_prefix))
+                instruction_set.append(Instr(opcodes.POP_TOP))
+                instruction_set.extend(_instrument_after_call(patch))
+
+                if any(param.writable for param in patch.injected_params):
+                    # Read back the (potentially modified) result
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, result_ref_variable))
+                    instruction_set.extend(assembler.load_attr("value"))
+                    instruction_set.append(Instr(opcodes.STORE_FAST, result_variable))
+                    state_result_current = False
+
+            if guard_label is not None:
+                if not result_variable_current:
+                    instruction_set.extend(_read_result_from_state(state_variable, result_variable, state_class))
+                    result_variable_current = True
+
+                instruction_set.append(guard_label)
+
+                # The dictionary is only guaranteed to exist as it was before the postfix, and might not have the latest result
+                state_built = guarded_state_built
+                state_result_current = False
+
+        # Get our return value, and return it
+
+        if result_variable_current:
+            instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+        else:
+            instruction_set.extend(_load_state_value(state_class, state_variable, "__result"))
+
+        instruction_set.append(Instr(opcodes.RETURN_VALUE))
+
+    # Done with assembling, execution ends here
+    # Insert everything at the very end
+
+    bytecode.extend(instruction_set)
+
+
+def _read_result_from_state(state_variable: str, result_variable: str, state_class: Optional[type] = None) -> List[Instr]:
+    """
+    Returns the instructions that set the result variable to the result in a state dictionary (or state object, if state_class is supplied).
+    """
+
+    return [*_load_state_value(state_class, state_variable, "__result"), Instr(opcodes.STORE_FAST, result_variable)]
+
+
+def _assemble_finalizer(bytecode: Bytecode, finalizers: List["Patch"], state_class: Optional[type] = None) -> None:
+    """
+    Wraps the entire function (including prefixes and postfixes) in a try block, and inserts the required bytecode for finalizer functionality.
+
+    Finalizers run in priority order once the function has returned or raised. Each one receives the current exception (None if there
+    isn't one) and the result, and decides what happens to the exception through its return value:
+        True: Swallows it, so the function returns the result instead
+        An exception instance: Replaces it, with the previous exception as its context
+        Anything else (such as None): Leaves it as is
+    The return value is ignored if there is no exception. If an exception is left once every finalizer has run, it is raised (the original one with its traceback untouched). Otherwise the result is returned.
+    Regular finalizers receive an instance of state_class instead of a state dictionary, if it's supplied.
+    """
+
+    for patch in finalizers:
+        for param in patch.injected_params:
+            if param.name in bytecode.argnames or _is_exception_name(param.name):
+                if param.writable:
+                    raise ValueError(f"Finalizer {patch.patch_name} can only write to the result, but requested '{param.name}' as a Ref")
+            elif not _is_result_name(param.name):
+                raise ValueError(f"Finalizer {patch.patch_name} requests '{param.name}', which is not an argument of {patch.target.target_function_name}")
+
+        _validate_guards(bytecode, patch, ("__result", "__exception"))
+
+    result_variable = "_pyharmony_result"
+    exception_variable = "_pyharmony_exception"
+
+    handler_label = Label()
+    exit_label = Label()
+
+    # Replace all instances of RETURN_VALUE (including the prefix and postfix) to jump to the end of the try block
+
+    assembler.expand_return_constants(bytecode)
+
+    for index, instr in enumerate(bytecode):
+        if isinstance(instr, Instr) and instr.name == opcodes.RETURN_VALUE:
+            bytecode[index:index + 1] = assembler.jump(exit_label)
+
+    body_start = assembler.get_body_start(bytecode)
+    instruction_set = [exit_label]
+
+    if assembler.PY311:
+        # Try blocks are zero-cost, and only exist in the exception table
+        try_begin = TryBegin(handler_label, False)
+        assembler.deepen_yields(bytecode)
+        bytecode.insert(body_start, try_begin)
+
+        instruction_set.append(TryEnd(try_begin))
+    else:
+        bytecode.insert(body_start, Instr(opcodes.SETUP_FINALLY, handler_label))
+
+        instruction_set.append(Instr(opcodes.POP_BLOCK))
+
+    # Returned normally. Move the result off the stack, and run the finalizers without an exception, which leaves nothing for them to change
+
+    instruction_set.append(Instr(opcodes.STORE_FAST, result_variable))
+    instruction_set.append(Instr(opcodes.LOAD_CONST, None))
+    instruction_set.append(Instr(opcodes.STORE_FAST, exception_variable))
+
+    instruction_set.extend(_call_finalizers(bytecode, finalizers, result_variable, exception_variable, state_class, handling_exception=False))
+
+    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+
+    # Raised
+    instruction_set.append(handler_label)
+
+    if assembler.PY311:
+        instruction_set.extend(_finalizer_handler(bytecode, finalizers, state_class))
+    else:
+        instruction_set.extend(_legacy_finalizer_handler(bytecode, finalizers, state_class))
+
+    # Insert everything at the very end
+
+    bytecode.extend(instruction_set)
+
+    # The try block wraps any that the function already has
+    assembler.flatten_try_blocks(bytecode)
+
+
+def _finalizer_handler(bytecode: Bytecode, finalizers: List["Patch"], state_class: Optional[type]) -> List[Instr]:
+    """
+    Returns the exception handler of a finalizer for Python 3.11+, which is entered with the exception on the stack.
+
+    Laid out the same way as the handler of a try statement, including the cleanup block that restores the exception being handled
+    if the handler raises.
+    """
+
+    result_variable = "_pyharmony_result"
+    exception_variable = "_pyharmony_exception"
+    original_exception_variable = "_pyharmony_original_exception"
+
+    swallow_label = Label()
+    reraise_label = Label()
+    cleanup_label = Label()
+
+    cleanup_try_begin = TryBegin(cleanup_label, True)
+
+    instruction_set = [
+        Instr(opcodes.PUSH_EXC_INFO),
+        cleanup_try_begin,
+        *assembler.dup_top(),
+        *_store_finalizer_exception(),
+    ]
+
+    instruction_set.extend(_call_finalizers_on_exception(bytecode, finalizers, state_class, swallow_label, reraise_label))
+
+    instruction_set.append(reraise_label)
+    instruction_set.append(Instr(opcodes.LOAD_FAST, original_exception_variable))
+    instruction_set.extend(_clear_variables(exception_variable, original_exception_variable))
+    instruction_set.extend(assembler.reraise())
+    instruction_set.append(TryEnd(cleanup_try_begin))
+
+    # Swallowed by a finalizer
+    instruction_set.append(swallow_label)
+    instruction_set.extend(_clear_variables(original_exception_variable))
+    instruction_set.append(Instr(opcodes.POP_EXCEPT))
+    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+
+    # The handler raised. Restore the exception that was being handled before, and let it propagate
+    instruction_set.append(cleanup_label)
+    instruction_set.append(Instr(opcodes.COPY, 3))
+    instruction_set.append(Instr(opcodes.POP_EXCEPT))
+    instruction_set.append(Instr(opcodes.RERAISE, 1))
+
+    return instruction_set
+
+
+def _legacy_finalizer_handler(bytecode: Bytecode, finalizers: List["Patch"], state_class: Optional[type]) -> List[Instr]:
+    """
+    Returns the exception handler of a finalizer for Python 3.8 to 3.10.
+
+    The exception type, value and traceback are on the stack, and stay there so the original exception can be reraised as is.
+    """
+
+    result_variable = "_pyharmony_result"
+    exception_variable = "_pyharmony_exception"
+    original_exception_variable = "_pyharmony_original_exception"
+
+    swallow_label = Label()
+    reraise_label = Label()
+
+    instruction_set = [
+        Instr(opcodes.ROT_TWO),
+        Instr(opcodes.DUP_TOP),
+        Instr(opcodes.DUP_TOP),
+        *_store_finalizer_exception(),
+        Instr(opcodes.ROT_TWO),
+    ]
+
+    instruction_set.extend(_call_finalizers_on_exception(bytecode, finalizers, state_class, swallow_label, reraise_label))
+
+    instruction_set.append(reraise_label)
+    instruction_set.extend(_clear_variables(exception_variable, original_exception_variable))
+    instruction_set.extend(assembler.reraise())
+
+    # Swallowed by a finalizer
+    instruction_set.append(swallow_label)
+    instruction_set.extend(_clear_variables(original_exception_variable))
+    instruction_set.append(Instr(opcodes.POP_TOP))
+    instruction_set.append(Instr(opcodes.POP_TOP))
+    instruction_set.append(Instr(opcodes.POP_TOP))
+    instruction_set.append(Instr(opcodes.POP_EXCEPT))
+    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+
+    return instruction_set
+
+
+def _store_finalizer_exception() -> List[Instr]:
+    """
+    Returns the instructions that store the exception entering a finalizer's exception handler, which is expected on the stack twice.
+    It becomes both the current and the original exception, and the result starts out as None.
+    """
+
+    return [
+        Instr(opcodes.STORE_FAST, "_pyharmony_exception"),
+        Instr(opcodes.STORE_FAST, "_pyharmony_original_exception"),
+        Instr(opcodes.LOAD_CONST, None),
+        Instr(opcodes.STORE_FAST, "_pyharmony_result"),
+    ]
+
+
+def _call_finalizers_on_exception(bytecode: Bytecode, finalizers: List["Patch"], state_class: Optional[type], swallow_label: Label,
+                                  reraise_label: Label) -> List[Instr]:
+    """
+    Returns the instructions that call the finalizers from an exception handler (see _store_finalizer_exception()), and act on the exception they leave.
+
+    An exception that a finalizer replaced the original with is raised right away. Otherwise this jumps to swallow_label if the exception
+    was swallowed, or to reraise_label if it was left as is. Both of those still have to clear the exception variables.
+    """
+
+    exception_variable = "_pyharmony_exception"
+    original_exception_variable = "_pyharmony_original_exception"
+
+    instruction_set = _call_finalizers(bytecode, finalizers, "_pyharmony_result", exception_variable, state_class, handling_exception=True)
+
+    instruction_set.append(Instr(opcodes.LOAD_FAST, exception_variable))
+    instruction_set.extend(assembler.pop_jump_if_none(swallow_label))
+    instruction_set.append(Instr(opcodes.LOAD_FAST, exception_variable))
+    instruction_set.append(Instr(opcodes.LOAD_FAST, original_exception_variable))
+    instruction_set.extend(assembler.is_op())
+    instruction_set.extend(assembler.pop_jump_if_true(reraise_label, is_bool=True))
+
+    # Replaced by a finalizer. Raising it here sets the original exception as its context
+    instruction_set.append(Instr(opcodes.LOAD_FAST, exception_variable))
+    instruction_set.extend(_clear_variables(exception_variable, original_exception_variable))
+    instruction_set.append(Instr(opcodes.RAISE_VARARGS, 1))
+
+    return instruction_set
+
+
+def _call_finalizers(bytecode: Bytecode, finalizers: List["Patch"], result_variable: str, exception_variable: str, state_class: Optional[type],
+                     handling_exception: bool) -> List[Instr]:
+    """
+    Returns the instructions that call each finalizer, and update the exception variable from their return values (see _assemble_finalizer()).
+
+    handling_exception: Whether the finalizers run from the exception handler. Otherwise there is no exception, so return values are discarded.
+    """
+
+    instruction_set = []
+
+    state_variable = "_pyharmony_finalizer_state"
+    result_ref_variable = "_pyharmony_ref_result"
+    return_variable = "_pyharmony_finalizer_return"
+
+    for patch in finalizers:
+        guard_label = Label()
+        instruction_set.extend(_guard_instructions(bytecode, patch, guard_label, {"__result": result_variable, "__exception": exception_variable}))
+
+        if not patch.inject:
+            # Regular finalizers get a fresh dictionary each, as the exception can change between them
+            instruction_set.extend(_create_state(state_class, state_variable))
+
+            for name, variable in [(arg_name, arg_name) for arg_name in bytecode.argnames] + [("__result", result_variable), ("__exception", exception_variable)]:
+                if _is_state_field(state_class, name):
+                    instruction_set.extend(assembler.load_variable(bytecode, variable))
+                    instruction_set.extend(_store_state_value(state_class, state_variable, name))
+
+            instruction_set.extend(_instrument_before_call(patch))
+            instruction_set.extend(assembler.load_callable(patch.finalizer_func))
+            instruction_set.extend(_pass_state(patch, state_class, state_variable))
+            instruction_set.extend(assembler.call(1))
+            instruction_set.extend(_await_instructions(patch.finalizer_func))
+            instruction_set.extend(_instrument_after_call(patch))
+
+            # Read back the (potentially modified) result. The return value of the finalizer stays on the stack while we do this
+            instruction_set.extend(_read_result_from_state(state_variable, result_variable, state_class))
+
+        else:
+            # Call the finalizer, passing each requested value positionally
+
+            instruction_set.extend(_instrument_before_call(patch))
+            instruction_set.extend(assembler.load_callable(patch.finalizer_func))
+
+            for param in patch.injected_params:
+                if param.name in bytecode.argnames:
+                    instruction_set.extend(assembler.load_variable(bytecode, param.name))
+                elif _is_exception_name(param.name):
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, exception_variable))
+                elif param.writable:
+                    instruction_set.extend(assembler.load_callable(Ref))
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+                    instruction_set.extend(assembler.call(1))
+                    instruction_set.extend(assembler.dup_top())
+                    instruction_set.append(Instr(opcodes.STORE_FAST, result_ref_variable))
+                else:
+                    instruction_set.append(Instr(opcodes.LOAD_FAST, result_variable))
+
+            instruction_set.extend(assembler.call(len(patch.injected_params)))
+            instruction_set.extend(_await_instructions(patch.finalizer_func))
+            instruction_set.extend(_instrument_after_call(patch))
+
+            if any(param.writable for param in patch.injected_params):
+                # Read back the (potentially modified) result
+                instruction_set.append(Instr(opcodes.LOAD_FAST, result_ref_variable))
+                instruction_set.extend(assembler.load_attr("value"))
+                instruction_set.append(Instr(opcodes.STORE_FAST, result_variable))
+
+        # Decide what happens to the exception
+
+        if not handling_exception or _returns_none_only(patch.finalizer_func):
+            instruction_set.append(Instr(opcodes.POP_TOP))
+            instruction_set.append(guard_label)
+            continue
+
+        swallow_label = Label()
+        done_label = Label()
+
+        # An earlier finalizer may have swallowed the exception already
+        instruction_set.append(Instr(opcodes.STORE_FAST, return_variable))
+        instruction_set.append(Instr(opcodes.LOAD_FAST, exception_variable))
+        instruction_set.extend(assembler.pop_jump_if_none(done_label))
+        instruction_set.append(Instr(opcodes.LOAD_FAST, return_variable))
+        instruction_set.extend(assembler.is_constant(True))
+        instruction_set.extend(assembler.pop_jump_if_true(swallow_label, is_bool=True))
+
+        # Replace, but only with an actual exception. Anything else (such as a falsy value) keeps the current one
+        instruction_set.extend(assembler.load_callable(isinstance))
+        instruction_set.append(Instr(opcodes.LOAD_FAST, return_variable))
+        instruction_set.append(Instr(opcodes.LOAD_CONST, BaseException))
+        instruction_set.extend(assembler.call(2))
+        instruction_set.extend(assembler.pop_jump_if_false(done_label, is_bool=True))
+        instruction_set.append(Instr(opcodes.LOAD_FAST, return_variable))
+        instruction_set.append(Instr(opcodes.STORE_FAST, exception_variable))
+        instruction_set.extend(assembler.jump(done_label))
+
+        # Swallow
+        instruction_set.append(swallow_label)
+        instruction_set.append(Instr(opcodes.LOAD_CONST, None))
+        instruction_set.append(Instr(opcodes.STORE_FAST, exception_variable))
+
+        instruction_set.append(done_label)
+        instruction_set.extend(_clear_variables(return_variable))
+        instruction_set.append(guard_label)
+
+    return instruction_set
+
+
+def _clear_variables(*names: str) -> List[Instr]:
+    """
+    Returns the instructions that set variables to None. Used on exceptions, which would otherwise form a reference cycle with the frame.
+    """
+
+    instruction_set = []
+
+    for name in names:
+        instruction_set.append(Instr(opcodes.LOAD_CONST, None))
+        instruction_set.append(Instr(opcodes.STORE_FAST, name))
+
+    return instruction_set
+
+
+def _reevaluate_function(target_object: object, target_function_name: str) -> None:
+    """
+    Recalculates the code object for a function, including the defined function hooks.
+    """
+
+    _reevaluate_functions((PatchTarget(target_object, target_function_name), ))
+
+
+def _reevaluate_functions(targets: Iterable[PatchTarget], workers: Optional[int] = None) -> None:
+    """
+    Recalculates the code objects for multiple functions.
+
+    If workers is supplied, functions that aren't already cached are compiled in a pool of that many processes.
+    The new code objects are only installed once every function has been compiled.
+
+    Compiling happens outside of _state_lock. If the patches of a target change while it is being compiled, the result is
+    discarded and the target is compiled again from its new patches, so the last change always wins.
+    """
+
+    targets = list(targets)
+
+    while len(targets) > 0:
+        with _state_lock:
+            _purge_dead_targets()
+            reevaluations = [r for r in (_begin_reevaluation(t.target_object, t.target_function_name) for t in targets) if r is not None]
+
+        for reevaluation in reevaluations:
+            if reevaluation.new_code is None:
+                reevaluation.load_from_disk()
+
+        pending = [r for r in reevaluations if r.new_code is None]
+
+        if workers is not None and len(pending) > 1:
+            parallel.compile_reevaluations(pending, workers)
+
+        for reevaluation in pending:
+            if reevaluation.new_code is None:
+                # Either we're not compiling in parallel, or this function couldn't be sent to a worker process
+                reevaluation.compile()
+
+        # Anything that lost the race to another change is tried again
+        targets = [r.target for r in reevaluations if not r.finish()]
+
+
+def _begin_reevaluation(target_object: object, target_function_name: str) -> Optional["_Reevaluation"]:
+    """
+    Looks up the original definition and enabled patches of a function, in preparation of recalculating its code object.
+    Returns None if the target function can't be patched. Must be called while holding _state_lock.
+    """
+
+    if not hasattr(target_object, target_function_name):
+        # Do nothing if the target function doesn't exist.
+        return None
+
+    patch_target = PatchTarget(target_object, target_function_name)
+    target_key = _get_target_key(patch_target)
+
+    original_function = _get_original_function(target_object, target_function_name)
+
+    if original_function is None:
+        # This isn't a function.
+        # Arguably, we can move this check into the decorators
+        if not trampoline.is_writable(target_object) and any(len(plist) > 0 for plist in _patch_index.get_enabled_patches(target_key)):
+            raise ValueError(f"{target_function_name} of {target_object.__name__} can't be patched, as it belongs to a builtin or immutable type")
+
+        return None
+
+    func_def, func_def_code = original_function
+
+    # Figure out what we actually have for patching
+
+    our_transpilers, our_prefixes, our_postfixes, our_finalizers = _patch_index.get_enabled_patches(target_key)
+    fingerprint = tuple(p._get_compile_key() for plist in (our_transpilers, our_prefixes, our_postfixes, our_finalizers) for p in plist)
+
+    # Leave the function alone if it already has exactly these patches applied (or has none, and isn't supposed to)
+
+    applied_fingerprint, applied_code = _applied_patches.get(target_key, ((), func_def_code))
+
+    if fingerprint == applied_fingerprint and func_def.__code__ is applied_code:
+        return None
+
+    return _Reevaluation(func_def, func_def_code, patch_target, _patch_index.get_version(target_key), fingerprint, our_transpilers, our_prefixes, our_postfixes,
+                         our_finalizers)
+
+
+def _get_original_function(target_object: object, target_function_name: str) -> Optional[Tuple[types.FunctionType, types.CodeType]]:
+    """
+    Returns the original function of a target along with its original code, or None if the target can't be patched.
+    Must be called while holding _state_lock.
+
+    Targets that aren't Python functions are patched through the function wrapped by their descriptor (for classmethods and properties),
+    or else through a trampoline (see trampoline.create_trampoline()).
+    """
+
+    target_key = _get_target_key(PatchTarget(target_object, target_function_name))
+
+    original_function = _original_functions.get(target_key)
+    func_def: Optional[types.FunctionType] = original_function[0]() if original_function is not None else None
+
+    if func_def is not None:
+        # Use our stored function / code definition
+        return func_def, original_function[1]
+
+    # We don't have an original version of the function. Get it
+    func_def = getattr(target_object, target_function_name, None)
+
+    if not isinstance(func_def, types.FunctionType):
+        func_def = trampoline.get_wrapped_function(target_object, target_function_name)
+
+    if func_def is None:
+        target_trampoline = trampoline.create_trampoline(target_object, target_function_name)
+
+        if target_trampoline is None:
+            return None
+
+        # The trampoline is only installed once the target has patches. Until then, this is what keeps it alive
+        func_def = target_trampoline.function
+        _trampolines[target_key] = target_trampoline
+
+    # Only the code is kept alive, as the function could reference the target object (through the __class__ cell of super() calls, for example)
+    _track_target(target_object)
+    _original_functions[target_key] = (_create_reference(func_def), func_def.__code__)
+
+    return func_def, func_def.__code__
+
+
+class _Reevaluation:
+    """
+    The state of recalculating the code object for a single function.
+    """
+    def __init__(self, func_def: types.FunctionType, func_def_code: types.CodeType, target: PatchTarget, version: int, fingerprint: tuple,
+                 our_transpilers: List["Patch"], our_prefixes: List["Patch"], our_postfixes: List["Patch"], our_finalizers: List["Patch"]) -> None:
+        self.func_def = func_def
+        self.func_def_code = func_def_code
+        self.target = target
+        self.target_function_name = target.target_function_name
+
+        # The version of the target's patches this was built from. See finish()
+        self.version = version
+
+        self.our_transpilers = our_transpilers
+        self.our_prefixes = our_prefixes
+        self.our_postfixes = our_postfixes
+        self.our_finalizers = our_finalizers
+
+        self.fingerprint = fingerprint
+        self.new_code: Optional[types.CodeType]
+
+        if len(fingerprint) == 0:
+            # Without any patches, the function gets its original code object back as is
+            self.new_code = func_def_code
+            self._from_code_cache = True
+        else:
+            # Check if we've already compiled this exact combination of patches before
+            self.new_code = _code_cache.get(func_def_code, fingerprint)
+            self._from_code_cache = self.new_code is not None
+
+        self._from_disk_cache = False
+
+        self.disk_cache = _disk_cache
+        self.disk_identity = None
+
+    def load_from_disk(self) -> None:
+        """
+        Checks if a previous run of the program has compiled this code already. Doesn't need _state_lock.
+        """
+
+        if self.disk_cache is None:
+            return
+
+        self.disk_identity = _get_disk_identity(self.our_transpilers, self.our_prefixes, self.our_postfixes, self.our_finalizers)
+
+        if self.disk_identity is not None:
+            self.new_code = self.disk_cache.load(self.func_def_code, self.target_function_name, self.disk_identity, self.get_link_objects())
+            self._from_disk_cache = self.new_code is not None
+
+    def get_link_objects(self) -> List[object]:
+        return _get_link_objects(self.func_def_code, self.our_prefixes, self.our_postfixes, self.our_finalizers)
+
+    def compile(self) -> None:
+        self.new_code = _compile_function(self.func_def_code, self.our_transpilers, self.our_prefixes, self.our_postfixes, self.our_finalizers)
+
+    def finish(self) -> bool:
+        """
+        Stores newly compiled code in the caches, and sets the function to use it.
+
+        The code is only installed if the target's patches haven't changed since this reevaluation began (a compare-and-swap on its version).
+        Returns false if it wasn't installed, in which case the target needs to be reevaluated again.
+        """
+
+        if not self._from_disk_cache and self.disk_identity is not None:
+            self.disk_cache.store(self.func_def_code, self.target_function_name, self.disk_identity, self.get_link_objects(), self.new_code)
+
+        with _state_lock:
+            # Even if it's outdated, the code is still correct for the patches it was built from
+            if not self._from_code_cache:
+                _code_cache.put(self.func_def_code, self.fingerprint, self.new_code)
+
+            target_key = _get_target_key(self.target)
+
+            if _patch_index.get_version(target_key) != self.version:
+                return False
+
+            # Set the original function to use our bytecode.
+            # Threads that are already running the function carry on with the code they started with
+
+            self.func_def.__code__ = self.new_code
+            _update_coroutine_marker(self.func_def, self.func_def_code, self.new_code)
+
+            target_trampoline = _trampolines.get(target_key)
+
+            if target_trampoline is not None:
+                if len(self.fingerprint) > 0:
+                    target_trampoline.install(self.target.target_object, self.target_function_name)
+                else:
+                    target_trampoline.uninstall(self.target.target_object, self.target_function_name)
+
+            if len(self.fingerprint) > 0:
+                _applied_patches[target_key] = (self.fingerprint, self.new_code)
+            else:
+                _applied_patches.pop(target_key, None)
+
+        return True
+
+
+def _update_coroutine_marker(func_def: types.FunctionType, original_code: types.CodeType, new_code: types.CodeType) -> None:
+    """
+    Marks a coroutine function that has been replaced by a trampoline, so asyncio (and inspect, on Python 3.12+) still recognize it as one.
+    """
+
+    if original_code.co_flags & inspect.CO_COROUTINE and not new_code.co_flags & inspect.CO_COROUTINE:
+        import asyncio.coroutines    # pylint: disable=import-outside-toplevel
+
+        func_def._is_coroutine = getattr(asyncio.coroutines, "_is_coroutine", None)
+
+        if hasattr(inspect, "markcoroutinefunction"):
+            inspect.markcoroutinefunction(func_def)
+    else:
+        func_def.__dict__.pop("_is_coroutine", None)
+        func_def.__dict__.pop("_is_coroutine_marker", None)
+
+
+def _compile_function(func_def_code: types.CodeType, our_transpilers: List["Patch"], our_prefixes: List["Patch"], our_postfixes: List["Patch"],
+                      our_finalizers: List["Patch"]) -> types.CodeType:
+    """
+    Builds the code object for a function from its original code, and the (sorted) patches to apply to it.
+
+    This happens in stages: decoding the original code, running the transpilers, injecting prefixes, postfixes and finalizers, and
+    emitting the finished code object. The output of the first two is kept per target, so they only run again when the original
+    code or the transpilers change. See _StageCache.
+    """
+
+    # Perform transpilers first.
+    # Transpilers expect the original instruction set, so things like prefixes and postfixes
+    #   (which require manual instruction insertions) have to happen after
+
+    func_working_bytecode = _stage_cache.get_transpiled(func_def_code, our_transpilers)
+
+    # Anything we add to a generator has to be inside of the try block that Python 3.12+ wraps it in, so take it off until we're done
+    assembler.unwrap_generator(func_working_bytecode)
+
+    for patch in our_prefixes + our_postfixes + our_finalizers:
+        hook_func = patch.prefix_func or patch.postfix_func or patch.finalizer_func
+
+        if _is_async_hook(hook_func) and not func_working_bytecode.flags & _ASYNC_FLAGS:
+            raise ValueError(f"{patch.patch_name} is async, so it can only patch coroutines and async generators, not {patch.target.target_function_name}")
+
+    state_classes = _get_state_classes(func_def_code, our_prefixes, our_postfixes, our_finalizers)
+
+    if func_working_bytecode.flags & _ASYNC_OR_GENERATOR_FLAGS:
+        return _compile_generator_function(func_working_bytecode, our_prefixes, our_postfixes, our_finalizers, state_classes)
+
+    # Do prefixes.
+    # Every prefix is called directly from the function's bytecode, so there's no extra layer of dispatching
+
+    if len(our_prefixes) > 0:    # Don't bother with it if there's no prefixes
+        _assemble_prefix(func_working_bytecode, our_prefixes, state_class=state_classes.prefix)
+
+    # Do postfixes.
+
+    if len(our_postfixes) > 0:    # Don't bother with it if there's no postfixes
+        _assemble_postfix(func_working_bytecode, our_postfixes, state_classes.postfix)
+
+    # Do finalizers. These go last, as they wrap everything else
+
+    if len(our_finalizers) > 0:
+        _assemble_finalizer(func_working_bytecode, our_finalizers, state_classes.finalizer)
+
+    return assembler.to_code(func_working_bytecode)
+
+
+def _compile_generator_function(body_bytecode: Bytecode, our_prefixes: List["Patch"], our_postfixes: List["Patch"], our_finalizers: List["Patch"],
+                                state_classes: "_StateClasses") -> types.CodeType:
+    """
+    Builds the code object for a generator, coroutine or async generator function.
+
+    Postfixes are assembled into the body itself, so they run once the generator finishes (with its actual return value),
+    rather than when the function returns the generator object.
+    Sync prefixes need to run as soon as the function is called, which happens before the body starts. So the function is replaced with
+    a trampoline, which runs them and then creates the generator from the patched body. Async prefixes can't run until the body
+    starts, so they are assembled into the start of the body instead, after every sync prefix has run.
+    Finalizers wrap the body, so they observe exceptions raised while iterating or awaiting it.
+    """
+
+    sync_prefixes = [p for p in our_prefixes if not _is_async_hook(p.prefix_func)]
+    async_prefixes = [p for p in our_prefixes if _is_async_hook(p.prefix_func)]
+
+    if len(async_prefixes) > 0:
+        _assemble_prefix(body_bytecode, async_prefixes, state_class=state_classes.prefix)
+
+    if len(our_postfixes) > 0:
+        _assemble_postfix(body_bytecode, our_postfixes, state_classes.postfix)
+
+    if len(our_finalizers) > 0:
+        _assemble_finalizer(body_bytecode, our_finalizers, state_classes.finalizer)
+
+    if len(sync_prefixes) == 0:
+        # The function can stay a generator
+        return assembler.to_code(body_bytecode)
+
+    # Skipping the original function still creates a generator of the right kind, which only runs the postfixes.
+    # Its body is an empty copy of the original one
+
+    skipped_bytecode = body_bytecode.copy()
+    skipped_bytecode.clear()
+    skipped_bytecode.extend(body_bytecode[:assembler.get_body_start(body_bytecode)])
+    skipped_bytecode.extend(assembler.return_constant(None))
+
+    if len(our_postfixes) > 0:
+        _assemble_postfix(skipped_bytecode, our_postfixes, state_classes.postfix)
+
+    if len(our_finalizers) > 0:
+        _assemble_finalizer(skipped_bytecode, our_finalizers, state_classes.finalizer)
+
+    # Build the trampoline
+
+    trampoline_bytecode = body_bytecode.copy()
+    trampoline_bytecode.clear()
+    trampoline_bytecode.flags &= ~_ASYNC_OR_GENERATOR_FLAGS
+    trampoline_bytecode.cellvars = []
+
+    skip_label = Label()
+
+    trampoline_bytecode.extend(assembler.function_prologue(trampoline_bytecode))
+    trampoline_bytecode.extend(_create_generator_instructions(body_bytecode))
+    trampoline_bytecode.append(skip_label)
+    trampoline_bytecode.extend(_create_generator_instructions(skipped_bytecode))
+
+    _assemble_prefix(trampoline_bytecode, sync_prefixes, skip_label, state_classes.prefix)
+
+    return assembler.to_code(trampoline_bytecode)
+
+
+def _create_generator_instructions(body_bytecode: Bytecode) -> List[Instr]:
+    """
+    Returns the instructions for a trampoline that create a generator from a body, passing along every argument, and return it.
+    """
+
+    # Make every argument positional, so they can be passed along without rebuilding *args and **kwargs
+
+    body_code = assembler.to_code(body_bytecode)
+    argument_count = len(body_bytecode.argnames)
+
+    body_code = body_code.replace(co_argcount=argument_count,
+                                  co_posonlyargcount=0,
+                                  co_kwonlyargcount=0,
+                                  co_flags=body_code.co_flags & ~(inspect.CO_VARARGS | inspect.CO_VARKEYWORDS))
+
+    # Pass along the closure of the function
+    instruction_set = [
+        *assembler.null_before_callable(),
+        *assembler.make_function(body_code, body_bytecode.freevars),
+        *assembler.null_after_callable(),
+    ]
+
+    for arg_name in body_bytecode.argnames:
+        instruction_set.append(Instr(opcodes.LOAD_FAST, arg_name))
+
+    instruction_set.extend(assembler.call(argument_count))
+    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+
+    return instruction_set
+
+
+def _get_link_objects(func_def_code: types.CodeType, our_prefixes: List["Patch"], our_postfixes: List["Patch"], our_finalizers: List["Patch"]) -> List[object]:
+    """
+    Returns every object that generated code may reference, which can't be marshalled.
+    The order only depends on the original code and the patches, so the same list can be rebuilt when loading marshalled code.
+    """
+
+    patches = our_prefixes + our_postfixes + our_finalizers
+    state_classes = [state_class for state_class in _get_state_classes(func_def_code, our_prefixes, our_postfixes, our_finalizers) if state_class is not None]
+
+    return [Ref, time.perf_counter, time.monotonic, isinstance, BaseException, state.StateView] + state_classes \
+        + [p.prefix_func for p in our_prefixes] + [p.postfix_func for p in our_postfixes] \
+        + [p.finalizer_func for p in our_finalizers] + [p.stats for p in patches] + [p._sample_state for p in patches] \
+        + [guard.value for p in patches for guard in p.guards]
+
+
+_StateClasses = namedtuple("_StateClasses", ["prefix", "postfix", "finalizer"])
+
+
+def _get_state_classes(func_def_code: types.CodeType, our_prefixes: List["Patch"], our_postfixes: List["Patch"], our_finalizers: List["Patch"]) -> _StateClasses:
+    """
+    Returns the state classes that the regular prefixes, postfixes and finalizers of a target share, or None for each kind of hook
+    that only uses state dictionaries. State objects are used as soon as a single regular hook of a kind asks for them.
+
+    The fields come from the original code, rather than the transpiled code, so that the classes can be found again without compiling.
+    Local variables added by transpilers (or those that can't be attributes, like the variables of comprehensions) aren't included.
+    """
+
+    arg_count = func_def_code.co_argcount + func_def_code.co_kwonlyargcount + bool(func_def_code.co_flags & inspect.CO_VARARGS) \
+        + bool(func_def_code.co_flags & inspect.CO_VARKEYWORDS)
+
+    arg_names = [name for name in func_def_code.co_varnames[:arg_count] if state.is_field_name(name)]
+    local_names = [name for name in func_def_code.co_varnames[arg_count:] if state.is_field_name(name)]
+
+    def get_state_class(kind: str, patches: List["Patch"], fields: List[str]) -> Optional[type]:
+        if not any(p.state_object for p in patches):
+            return None
+
+        return state.get_state_class(f"{func_def_code.co_name}_{kind}", tuple(dict.fromkeys(fields)))
+
+    return _StateClasses(get_state_class("prefix", our_prefixes, arg_names),
+                         get_state_class("postfix", our_postfixes, arg_names + local_names + ["__result"]),
+                         get_state_class("finalizer", our_finalizers, arg_names + ["__result", "__exception"]))
+
+
+def _get_disk_identity(our_transpilers: List["Patch"], our_prefixes: List["Patch"], our_postfixes: List["Patch"], our_finalizers: List["Patch"]) -> Optional[tuple]:
+    """
+    Returns a value identifying a set of patches across processes, or None if any of them can't be identified.
+    """
+
+    identities = tuple(p._get_disk_identity() for plist in (our_transpilers, our_prefixes, our_postfixes, our_finalizers) for p in plist)
+
+    if any(identity is None for identity in identities):
+        return None
+
+    return identities
+
+
+# Compile stages
+
+class _CompileStages:
+    """
+    The output of the early compile stages for a single original code object.
+    """
+
+    __slots__ = ("original_code", "decoded", "transpile_key", "transpiled")
+
+    def __init__(self, original_code: types.CodeType) -> None:
+        self.original_code = original_code
+        self.decoded: Optional[Bytecode] = None
+
+        # The compile keys of the transpilers that built transpiled
+        self.transpile_key: Optional[tuple] = None
+        self.transpiled: Optional[Bytecode] = None
+
+
+class _StageCache:
+    """
+    Keeps the decoded original code of each target, along with the output of its transpilers.
+
+    Only the latest transpiler output is kept, as the transpilers of a target rarely go back and forth. Everything after the
+    transpilers depends on every patch, so the finished code is stored in the code cache instead.
+    Callers always receive a copy, which they're free to modify.
+    """
+    def __init__(self) -> None:
+        # Keyed by id() of the original code object, which is kept in the entry to keep the id valid
+        self._entries: Dict[int, _CompileStages] = {}
+
+    def get_transpiled(self, original_code: types.CodeType, our_transpilers: List["Patch"]) -> Bytecode:
+        """
+        Returns the bytecode of the original code with the (sorted) transpilers applied to it, only running them if their output isn't known yet.
+        """
+
+        transpile_key = tuple(p._get_compile_key() for p in our_transpilers)
+
+        with _state_lock:
+            stages = self._get_stages(original_code)
+
+            if stages.transpile_key == transpile_key:
+                return assembler.copy_bytecode(stages.transpiled)
+
+        # Transpilers can take a while, so they run without the lock
+
+        transpiled = self.get_decoded(original_code)
+
+        for patch in our_transpilers:
+            transpiled = patch.transpiler_func(transpiled)
+
+        with _state_lock:
+            stages.transpile_key = transpile_key
+            stages.transpiled = transpiled
+
+        return assembler.copy_bytecode(transpiled)
+
+    def get_decoded(self, original_code: types.CodeType) -> Bytecode:
+        """
+        Returns the bytecode of the original code, only decoding it if it hasn't been already.
+        """
+
+        with _state_lock:
+            stages = self._get_stages(original_code)
+            decoded = stages.decoded
+
+        if decoded is None:
+            decoded = Bytecode.from_code(original_code)
+
+            with _state_lock:
+                stages.decoded = decoded
+
+        return assembler.copy_bytecode(decoded)
+
+    def _get_stages(self, original_code: types.CodeType) -> _CompileStages:
+        stages = self._entries.get(id(original_code))
+
+        if stages is None or stages.original_code is not original_code:
+            stages = self._entries[id(original_code)] = _CompileStages(original_code)
+
+        return stages
+
+    def discard(self, original_code: types.CodeType) -> None:
+        stages = self._entries.get(id(original_code))
+
+        if stages is not None and stages.original_code is original_code:
+            del self._entries[id(original_code)]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+
+# Code cache
+
+CodeCacheInfo = namedtuple("CodeCacheInfo", ["hits", "misses", "max_size", "current_size"])
+
+
+class _CodeCache:
+    """
+    A bounded LRU cache of patched code objects, keyed by the original code object and a fingerprint of the patches applied to it.
+    """
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        # Keyed by id() of the original code object, as code objects compare equal even if they come from different files.
+        # The original code object is kept in the entry, which keeps the id valid
+        self._entries: "OrderedDict[Tuple[int, tuple], Tuple[types.CodeType, types.CodeType]]" = OrderedDict()
+
+    def get(self, original_code: types.CodeType, fingerprint: tuple) -> Optional[types.CodeType]:
+        key = (id(original_code), fingerprint)
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] is not original_code:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[1]
+
+    def put(self, original_code: types.CodeType, fingerprint: tuple, patched_code: types.CodeType) -> None:
+        if self.max_size <= 0:
+            return
+
+        key = (id(original_code), fingerprint)
+        self._entries[key] = (original_code, patched_code)
+        self._entries.move_to_end(key)
+
+        self._evict()
+
+    def discard(self, original_code: types.CodeType) -> None:
+        """
+        Removes every entry built from an original code object.
+        """
+
+        for key in [key for key, entry in self._entries.items() if entry[0] is original_code]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._evict()
+
+    def info(self) -> CodeCacheInfo:
+        return CodeCacheInfo(self.hits, self.misses, self.max_size, len(self._entries))
+
+    def get_size(self) -> int:
+        """
+        Returns the approximate amount of memory in bytes used by the patched code objects in the cache.
+        """
+
+        return sum(_get_code_size(entry[1]) for entry in self._entries.values())
+
+    def _evict(self) -> None:
+        while len(self._entries) > max(self.max_size, 0):
+            self._entries.popitem(last=False)
+
+
+def code_cache_info() -> CodeCacheInfo:
+    """
+    Returns the hit and miss counters of the patched code cache, along with its maximum and current size.
+    """
+
+    with _state_lock:
+        return _code_cache.info()
+
+
+def clear_code_cache() -> None:
+    """
+    Removes every entry from the patched code cache (along with the cached output of transpilers), and resets its counters.
+
+    Patched code is only rebuilt when the set of enabled patches on a target changes, so call this if a transpiler's output changes for another reason.
+    Every target is then rebuilt the next time its patches are applied.
+    """
+
+    with _state_lock:
+        _code_cache.clear()
+        _stage_cache.clear()
+        _applied_patches.clear()
+        _reverse_patches.clear()
+
+
+def set_disk_cache_dir(directory: Optional[str]) -> None:
+    """
+    Enables the persistent on-disk cache of patched code, stored in the given directory. Passing None disables it.
+
+    Defaults to the directory in the PYHARMONY_CACHE_DIR environment variable, if it is set.
+    """
+
+    global _disk_cache
+
+    _disk_cache = diskcache.DiskCache(directory) if directory else None
+
+
+def set_code_cache_size(max_size: int) -> None:
+    """
+    Sets the maximum amount of patched code objects to keep in the cache. A size of zero disables caching.
+    """
+
+    with _state_lock:
+        _code_cache.resize(max_size)
+
+
+
+# Target tracking
+
+# Target objects are only referenced weakly, so patching a method of a dynamically created class or module doesn't keep it alive.
+# When a target object is garbage collected, its id is queued up by a weakref callback. As callbacks can run in the middle of
+#   anything (including code holding _state_lock), everything else is cleaned up later by _purge_dead_targets().
+
+StateInfo = namedtuple("StateInfo", ["targets", "original_functions", "handlers", "patches", "deferred_patches", "retained_bytes"])
+
+
+class _StrongReference:
+    """
+    Stands in for a weak reference to an object that doesn't support them.
+    """
+
+    __slots__ = ("obj", )
+
+    def __init__(self, obj: object) -> None:
+        self.obj = obj
+
+    def __call__(self) -> object:
+        return self.obj
+
+
+def _create_reference(obj: object) -> Callable[[], object]:
+    """
+    Returns a weak reference to an object, or a strong one if it doesn't support weak references.
+    """
+
+    try:
+        return weakref.ref(obj)
+    except TypeError:
+        return _StrongReference(obj)
+
+
+def _get_target_key(target: PatchTarget) -> _TargetKey:
+    return (id(target.target_object), target.target_function_name)
+
+
+def _track_target(target_object: object) -> None:
+    """
+    Makes sure the state of a target object is cleaned up once it's garbage collected.
+    """
+
+    with _state_lock:
+        # A dead object with the same id has to be cleaned up first, so its state isn't mistaken for this one's
+        _purge_dead_targets()
+
+        target_id = id(target_object)
+
+        if target_id not in _target_references:
+            _target_references[target_id] = _create_target_reference(target_object, target_id)
+
+
+def _create_target_reference(target_object: object, target_id: int) -> Callable[[], object]:
+    try:
+        # Only the id is captured by the callback, so it doesn't keep anything else alive
+        return weakref.ref(target_object, lambda _: _dead_target_ids.append(target_id))
+    except TypeError:
+        return _StrongReference(target_object)
+
+
+def _purge_dead_targets() -> None:
+    """
+    Removes everything belonging to target objects that have been garbage collected, along with the patch lists of handlers
+    that no longer exist and have no patches left. Must be called while holding _state_lock.
+    """
+
+    while _dead_target_ids:
+        target_id = _dead_target_ids.pop()
+        _target_references.pop(target_id, None)
+
+        for target_key in [key for key in _original_functions if key[0] == target_id]:
+            original_code = _original_functions.pop(target_key)[1]
+            _code_cache.discard(original_code)
+            _stage_cache.discard(original_code)
+            _applied_patches.pop(target_key, None)
+            _trampolines.pop(target_key, None)
+
+        for cache_key in [key for key in _reverse_patches if key[0][0] == target_id]:
+            del _reverse_patches[cache_key]
+
+        dead_patches = _patch_index.discard_object(target_id)
+
+        if len(dead_patches) > 0:
+            for patch_list in _handler_patches.values():
+                patch_list._discard(dead_patches)
+
+    for instance_name in [name for name, patch_list in _handler_patches.items() if len(patch_list) == 0 and name not in all_patch_handlers]:
+        del _handler_patches[instance_name]
+
+
+def _get_code_size(code: types.CodeType) -> int:
+    """
+    Returns the approximate amount of memory in bytes used by a code object, including any nested code objects.
+    """
+
+    size = sys.getsizeof(code)
+
+    if not assembler.PY311:
+        # Older versions keep the bytecode in a separate bytes object
+        size += sys.getsizeof(code.co_code)
+
+    return size + sum(_get_code_size(const) for const in code.co_consts if isinstance(const, types.CodeType))
+
+
+def state_info() -> StateInfo:
+    """
+    Returns how much global state pyHarmony is keeping alive.
+
+    targets: The amount of live target objects that are being tracked, either because they have been patched or because a patch refers to them.
+    original_functions: The amount of original functions being kept around so they can be repatched.
+    handlers: The amount of PatchHandler instance names being tracked, either because a handler with that name exists or because its patches are still registered.
+    patches: The amount of patches registered across every handler, not counting deferred ones.
+    deferred_patches: The amount of patches waiting for their module to be imported.
+    retained_bytes: The approximate amount of memory used by the original and cached patched code objects.
+    """
+
+    with _state_lock:
+        _purge_dead_targets()
+
+        retained_bytes = sum(_get_code_size(code) for _, code in _original_functions.values()) + _code_cache.get_size()
+
+        return StateInfo(len(_target_references), len(_original_functions), len(_handler_patches), _patch_index.get_patch_count(),
+                         sum(len(patches) for patches in _deferred_patches.values()), retained_bytes)
+
+
+
+# Deferred targets
+
+# A patch with a string target for a module that hasn't been imported yet waits in _deferred_patches once it's registered with a handler.
+# The import hook then binds it to its target object as soon as the module has been executed, and applies it if its handler has been patched.
+
+def _parse_target_path(target_path: str, target_function_name: Optional[str]) -> Tuple[str, Tuple[str, ...], str]:
+    """
+    Splits a string target such as "package.module:Class.method" into the name of the module, the attribute path of the target object
+    within it, and the name of the function. If target_function_name is supplied, it's appended to the path.
+    """
+
+    module_name, _, attribute_path = target_path.partition(":")
+    attributes = tuple(name for name in attribute_path.split(".") if name) + ((target_function_name, ) if target_function_name else ())
+
+    if not module_name or len(attributes) == 0:
+        raise ValueError(f"Expected a target of the form \"package.module:Class.method\", instead recieved {target_path!r}")
+
+    return module_name, attributes[:-1], attributes[-1]
+
+
+def _resolve_target_object(module_name: str, object_path: Tuple[str, ...]) -> Optional[object]:
+    """
+    Returns the object at an attribute path in a module, or None if the module hasn't been imported yet.
+    """
+
+    target_object = sys.modules.get(module_name)
+
+    if target_object is None:
+        return None
+
+    for name in object_path:
+        try:
+            target_object = getattr(target_object, name)
+        except AttributeError:
+            raise ValueError(f"Module {module_name} has no attribute {'.'.join(object_path)}") from None
+
+    return target_object
+
+
+def _defer_patch(patch: "Patch") -> None:
+    """
+    Registers a patch to be bound to its target once its module is imported. Must be called while holding _state_lock.
+    """
+
+    module_name = patch._pending_module_name
+
+    if module_name in sys.modules:
+        # Imported in the meantime
+        _bind_deferred_patches(module_name, [patch])
+        return
+
+    _deferred_patches.setdefault(module_name, []).append(patch)
+    importhook.watch(module_name, _on_module_imported)
+
+
+def _undefer_patch(patch: "Patch") -> None:
+    module_name = patch._pending_module_name
+    patches = _deferred_patches.get(module_name, [])
+
+    if patch in patches:
+        patches.remove(patch)
+
+    if len(patches) == 0:
+        _deferred_patches.pop(module_name, None)
+        importhook.unwatch(module_name)
+
+
+def _bind_deferred_patches(module_name: str, patches: List["Patch"]) -> List[PatchTarget]:
+    """
+    Binds waiting patches to their target objects, and adds them to the patch index. Returns the targets that need to be patched.
+
+    Patches whose target the module doesn't define are reported with a warning, and removed from their handlers, the same way a
+    Patch for a module that was already imported would raise a ValueError.
+    """
+
+    targets = []
+    missing_patches = []
+
+    for patch in patches:
+        try:
+            target_object = _resolve_target_object(module_name, patch._target_object_path)
+        except ValueError as error:
+            warnings.warn(f"{patch.patch_name} can't be applied to {patch.target_path}: {error}", RuntimeWarning)
+            missing_patches.append(patch)
+            continue
+
+        patch._bind_target(target_object)
+        _patch_index.add(patch)
+
+        if patch._apply_on_import:
+            targets.append(patch.target)
+
+    if len(missing_patches) > 0:
+        for patch_list in _handler_patches.values():
+            patch_list._discard(missing_patches)
+
+    return targets
+
+
+def _on_module_imported(module_name: str) -> None:
+    """
+    Called by the import hook once a module with deferred patches has been imported.
+    """
+
+    with _state_lock:
+        patches = _deferred_patches.pop(module_name, [])
+        importhook.unwatch(module_name)
+
+        targets = _bind_deferred_patches(module_name, patches)
+
+    _apply_targets(targets)
+
+
+
+# Reverse patches
+
+# A reverse patch is a copy of the original (unpatched) function of a target, which hooks can call to bypass every patch.
+# The copies are only referenced weakly, as their closure could reference the target object. The code they're built from
+#   (after their transpiler, if any) is kept until the original function changes, so recreating them is cheap.
+
+_ReversePatch = namedtuple("_ReversePatch", ["original_code", "reverse_code", "function_reference"])
+
+
+def reverse_patch(target_object: object, target_function_name: Optional[str] = None, transpiler_func: Optional[Callable[[Bytecode], Bytecode]] = None) -> types.FunctionType:
+    """
+    Returns a standalone function running the original code of a target function, without any of the patches applied to it.
+
+    It shares the globals, defaults and closure of the original function, so calling it is the same as calling any other function.
+    The same function object is returned for as long as it is kept alive, and the original function hasn't changed.
+
+    target_object: The object that the target function belongs to, or a string such as "package.module:Class.method" (which must already be imported). See Patch
+    target_function_name: The attribute name of the function, which belongs to target_object. Can be left out if it's part of a string target_object.
+    transpiler_func: If supplied, a transpiler applied to the original code of the reverse patch only. It runs once for each original function.
+    """
+
+    if isinstance(target_object, str):
+        module_name, object_path, target_function_name = _parse_target_path(target_object, target_function_name)
+        target_object = _resolve_target_object(module_name, object_path)
+
+        if target_object is None:
+            raise ValueError(f"Module {module_name} has to be imported before it can be reverse patched")
+
+    elif target_function_name is None:
+        raise ValueError("target_function_name is required, unless the target is given as a string")
+
+    with _state_lock:
+        _purge_dead_targets()
+
+        original_function = _get_original_function(target_object, target_function_name)
+
+        if original_function is None:
+            raise ValueError(f"{target_function_name} of {target_object!r} is not a function, so it can't be reverse patched")
+
+        func_def, func_def_code = original_function
+        cache_key = (_get_target_key(PatchTarget(target_object, target_function_name)), transpiler_func)
+
+        entry = _reverse_patches.get(cache_key)
+
+        if entry is not None and entry.original_code is func_def_code:
+            reverse_function = entry.function_reference()
+
+            if reverse_function is not None:
+                return reverse_function
+
+            reverse_code = entry.reverse_code
+        else:
+            reverse_code = None
+
+    if reverse_code is None:
+        if transpiler_func is None:
+            reverse_code = func_def_code
+        else:
+            # Transpilers can take a while, so they run without the lock
+            reverse_bytecode = transpiler_func(_stage_cache.get_decoded(func_def_code))
+            assembler.unwrap_generator(reverse_bytecode)
+            reverse_code = assembler.to_code(reverse_bytecode)
+
+    reverse_function = _create_reverse_function(func_def, reverse_code)
+
+    with _state_lock:
+        _reverse_patches[cache_key] = _ReversePatch(func_def_code, reverse_code, weakref.ref(reverse_function))
+
+    return reverse_function
+
+
+def _create_reverse_function(func_def: types.FunctionType, code: types.CodeType) -> types.FunctionType:
+    reverse_function = types.FunctionType(code, func_def.__globals__, func_def.__name__, func_def.__defaults__, func_def.__closure__)
+
+    reverse_function.__kwdefaults__ = func_def.__kwdefaults__
+    reverse_function.__qualname__ = func_def.__qualname__
+    reverse_function.__module__ = func_def.__module__
+    reverse_function.__doc__ = func_def.__doc__
+    reverse_function.__annotations__ = func_def.__annotations__
+
+    return reverse_function
+
+
+
+# Patch index
+
+class _TargetPatches:
+    """
+    All registered patches for a single target, along with lists of the enabled ones sorted by priority.
+    """
+    def __init__(self) -> None:
+        # In registration order, which is used to break ties between patches of the same priority
+        self.patches: List[Patch] = []
+
+        self.sorted_patches: Optional[Tuple[List[Patch], List[Patch], List[Patch], List[Patch]]] = None
+
+    def get_enabled_patches(self) -> Tuple[List["Patch"], List["Patch"], List["Patch"], List["Patch"]]:
+        if self.sorted_patches is None:
+            enabled_patches = sorted((p for p in self.patches if p.enabled), key=lambda x: x.priority_hint or 0, reverse=True)
+
+            self.sorted_patches = (
+                [p for p in enabled_patches if p.transpiler_func is not None],
+                [p for p in enabled_patches if p.prefix_func is not None],
+                [p for p in enabled_patches if p.postfix_func is not None],
+                [p for p in enabled_patches if p.finalizer_func is not None],
+            )
+
+        return self.sorted_patches
+
+
+class _PatchIndex:
+    """
+    Maps each target to the patches registered for it, across every PatchHandler. Targets are identified by _TargetKey.
+
+    Every change to the patches of a target gives it a new version number, which is used to detect code built from outdated patches.
+    Version numbers are never reused, apart from zero which means the target has no patches at all.
+    """
+    def __init__(self) -> None:
+        self._targets: Dict[_TargetKey, _TargetPatches] = {}
+        self._versions: Dict[_TargetKey, int] = {}
+        self._version_counter = itertools.count(1)
+
+    def add(self, patch: "Patch") -> None:
+        with _state_lock:
+            _purge_dead_targets()
+
+            if patch._pending_module_name is not None:
+                _defer_patch(patch)
+                return
 
-PatchTarget = namedtuple("PatchTarget", ["target_object", "target_function_name"])
+            if patch._is_target_dead():
+                # Its id may already belong to another object
+                return
 
-def _assemble_prefix(bytecode: Bytecode, prefix_func: types.FunctionType) -> None:
-    """
-    Inserts the required bytecode for prefix functionality.
-    """
+            target_patches = self._targets.get(patch._target_key)
 
-    instruction_set = []
+            if target_patches is None:
+                target_patches = self._targets[patch._target_key] = _TargetPatches()
 
-    # Create an empty dictionary and put it in a variable named "_pyharmony_prefix_state"
+            target_patches.patches.append(patch)
+            self._changed(patch._target_key, target_patches)
 
-    state_variable = "_pyharmony_prefix_state"
-    instruction_set.append(Instr(opcodes.BUILD_MAP, 0))
-    instruction_set.append(Instr(opcodes.STORE_FAST, state_variable))
+    def remove(self, patch: "Patch") -> None:
+        with _state_lock:
+            if patch._pending_module_name is not None:
+                _undefer_patch(patch)
+                return
 
-    for arg_name in bytecode.argnames:
-        # Insert each argument into the dictionary
-        instruction_set.append(Instr(opcodes.LOAD_FAST, arg_name))
-        instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-        instruction_set.append(Instr(opcodes.LOAD_CONST, arg_name))
-        instruction_set.append(Instr(opcodes.STORE_SUBSCR))
+            target_patches = self._targets.get(patch._target_key)
 
-    # Call our higher-level prefix code
-    instruction_set.append(Instr(opcodes.LOAD_CONST, prefix_func))
-    instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-    instruction_set.append(Instr(opcodes.CALL_FUNCTION, 1))
+            if target_patches is None or patch not in target_patches.patches:
+                return
 
-    # Check if the prefix returned true or false
-    continue_label = Label()
+            target_patches.patches.remove(patch)
+            self._changed(patch._target_key, target_patches)
 
-    instruction_set.append(Instr(opcodes.POP_JUMP_IF_TRUE, continue_label))
+            if len(target_patches.patches) == 0:
+                del self._targets[patch._target_key]
+                del self._versions[patch._target_key]
 
-    # Exit if false
-    instruction_set.append(Instr(opcodes.LOAD_CONST, None))
-    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+    def discard_object(self, target_id: int) -> List["Patch"]:
+        """
+        Removes every target belonging to a (dead) target object. Returns the patches that were registered for them.
+        """
 
-    # Otherwise continue, and set parameters to the potentially modified values of the dictionary
+        with _state_lock:
+            patches = []
 
-    instruction_set.append(continue_label)
+            for target_key in [key for key in self._targets if key[0] == target_id]:
+                patches.extend(self._targets.pop(target_key).patches)
+                del self._versions[target_key]
 
-    for arg_name in bytecode.argnames:
-        # Insert each argument into the dictionary
-        instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-        instruction_set.append(Instr(opcodes.LOAD_CONST, arg_name))
-        instruction_set.append(Instr(opcodes.BINARY_SUBSCR))
-        instruction_set.append(Instr(opcodes.STORE_FAST, arg_name))
+            return patches
 
-    # Done with assembling, main execution begins here
+    def invalidate(self, target_key: _TargetKey) -> None:
+        with _state_lock:
+            target_patches = self._targets.get(target_key)
 
-    # Insert instructions to the start of the function
+            if target_patches is not None:
+                self._changed(target_key, target_patches)
+
+    def get_enabled_patches(self, target_key: _TargetKey) -> Tuple[List["Patch"], List["Patch"], List["Patch"], List["Patch"]]:
+        """
+        Returns the enabled transpilers, prefixes, postfixes and finalizers for a target, each sorted by priority.
+        """
+
+        with _state_lock:
+            target_patches = self._targets.get(target_key)
+
+            if target_patches is None:
+                return [], [], [], []
+
+            return target_patches.get_enabled_patches()
+
+    def get_version(self, target_key: _TargetKey) -> int:
+        return self._versions.get(target_key, 0)
 
-    for instruction in reversed(instruction_set):
-        bytecode.insert(0, instruction)
+    def get_patch_count(self) -> int:
+        return sum(len(target_patches.patches) for target_patches in self._targets.values())
 
+    def _changed(self, target_key: _TargetKey, target_patches: _TargetPatches) -> None:
+        target_patches.sorted_patches = None
+        self._versions[target_key] = next(self._version_counter)
 
-def _assemble_postfix(bytecode: Bytecode, postfix_func: types.FunctionType) -> None:
+
+class PatchList(list):
     """
-    Inserts the required bytecode for postfix functionality.
+    A list of patches belonging to a PatchHandler, which keeps the global patch index up to date as it is modified.
     """
+    def __init__(self, patches: Iterable["Patch"] = ()) -> None:
+        super().__init__(patches)
 
-    instruction_set = []
+        # Only lists belonging to a registered PatchHandler contribute to the index
+        self._registered = False
 
-    # Get a list of variable names. This will be a bit awkward, as we compile to a concrete bytecode implementation
-    concrete_bytecode = bytecode.to_concrete_bytecode()
+    def _register(self) -> None:
+        if not self._registered:
+            self._registered = True
+            self._on_added(self)
 
-    # Create a label for instructions to jump to, instead of returning immediately
+    def _unregister(self) -> None:
+        if self._registered:
+            self._on_removed(self)
+            self._registered = False
 
-    postfix_label = Label()
-    instruction_set.append(postfix_label)
+    def _on_added(self, patches: Iterable["Patch"]) -> None:
+        if self._registered:
+            for patch in patches:
+                _patch_index.add(patch)
 
-    # Create an empty dictionary and put it in a variable named "_pyharmony_postfix_state"
+    def _on_removed(self, patches: Iterable["Patch"]) -> None:
+        if self._registered:
+            for patch in patches:
+                _patch_index.remove(patch)
 
-    state_variable = "_pyharmony_postfix_state"
-    instruction_set.append(Instr(opcodes.BUILD_MAP, 0))
-    instruction_set.append(Instr(opcodes.STORE_FAST, state_variable))
+    def _discard(self, patches: List["Patch"]) -> None:
+        """
+        Removes patches that have already been removed from the index, such as those of a dead target object.
+        """
 
-    for arg_name in bytecode.argnames:
-        # Insert each argument into the dictionary
-        instruction_set.append(Instr(opcodes.LOAD_FAST, arg_name))
-        instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-        instruction_set.append(Instr(opcodes.LOAD_CONST, arg_name))
-        instruction_set.append(Instr(opcodes.STORE_SUBSCR))
+        remaining = [patch for patch in self if patch not in patches]
 
-    for arg_name in concrete_bytecode.varnames:
-        # Insert each variable into the dictionary
-        instruction_set.append(Instr(opcodes.LOAD_FAST, arg_name))
-        instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-        instruction_set.append(Instr(opcodes.LOAD_CONST, arg_name))
-        instruction_set.append(Instr(opcodes.STORE_SUBSCR))
+        if len(remaining) != len(self):
+            super().__setitem__(slice(None), remaining)
 
-    # Insert the result into the dictionary, which has been lingering on the stack this entire time
-    # This will replace any variable named "__result" but that's very unlikely
+    def append(self, patch: "Patch") -> None:
+        super().append(patch)
+        self._on_added((patch, ))
 
-    instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-    instruction_set.append(Instr(opcodes.LOAD_CONST, "__result"))
-    instruction_set.append(Instr(opcodes.STORE_SUBSCR))
+    def extend(self, patches: Iterable["Patch"]) -> None:
+        patches = list(patches)
+        super().extend(patches)
+        self._on_added(patches)
 
-    # Call our higher-level postfix code
+    def insert(self, index: int, patch: "Patch") -> None:
+        super().insert(index, patch)
+        self._on_added((patch, ))
 
-    instruction_set.append(Instr(opcodes.LOAD_CONST, postfix_func))
-    instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-    instruction_set.append(Instr(opcodes.CALL_FUNCTION, 1))
+    def remove(self, patch: "Patch") -> None:
+        super().remove(patch)
+        self._on_removed((patch, ))
 
-    # Get our return value
+    def pop(self, index: int = -1) -> "Patch":
+        patch = super().pop(index)
+        self._on_removed((patch, ))
+        return patch
 
-    instruction_set.append(Instr(opcodes.LOAD_FAST, state_variable))
-    instruction_set.append(Instr(opcodes.LOAD_CONST, "__result"))
-    instruction_set.append(Instr(opcodes.BINARY_SUBSCR))
+    def clear(self) -> None:
+        patches = list(self)
+        super().clear()
+        self._on_removed(patches)
 
-    # Return it
+    def __setitem__(self, index, value) -> None:
+        old_patches = self[index] if isinstance(index, slice) else [self[index]]
+        new_patches = list(value) if isinstance(index, slice) else [value]
 
-    instruction_set.append(Instr(opcodes.RETURN_VALUE))
+        super().__setitem__(index, new_patches if isinstance(index, slice) else value)
 
-    # Done with assembling, execution ends here
+        self._on_removed(old_patches)
+        self._on_added(new_patches)
 
-    # Replace all instances of RETURN_VALUE (including the prefix) to jump to our new bytecode
+    def __delitem__(self, index) -> None:
+        old_patches = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self._on_removed(old_patches)
 
-    for index, instruction in enumerate(bytecode):
-        if isinstance(instruction, Instr) and instruction.name == opcodes.RETURN_VALUE:
-            bytecode[index] = Instr(opcodes.JUMP_ABSOLUTE, postfix_label)
+    def __iadd__(self, patches: Iterable["Patch"]) -> "PatchList":
+        self.extend(patches)
+        return self
 
-    # Insert everything at the very end
+    def __imul__(self, count: int) -> "PatchList":
+        old_patches = list(self)
+        super().__imul__(count)
 
-    bytecode.extend(instruction_set)
+        self._on_removed(old_patches)
+        self._on_added(self)
+        return self
 
 
-def _reevaluate_function(target_object: object, target_function_name: str) -> None:
+
+# Patch classes
+
+# Instrumentation modes. See Patch.set_instrumentation()
+
+INSTRUMENT_COUNTS = "counts"
+INSTRUMENT_TIMING = "timing"
+INSTRUMENT_SAMPLED_TIMING = "sampled_timing"
+
+_INSTRUMENTATION_MODES = (None, INSTRUMENT_COUNTS, INSTRUMENT_TIMING, INSTRUMENT_SAMPLED_TIMING)
+
+
+class PatchStats:
     """
-    Recalculates the code object for a function, including the defined function hooks.
+    Runtime statistics of a single patch, collected when instrumentation is enabled for it.
+
+    calls: The amount of times the hook has been called.
+    skips: The amount of times a prefix has skipped the original function.
+    time: The total time in seconds spent in the hook, across all timed calls.
+    timed_calls: The amount of calls that were timed. Equal to calls when timing every call, and a fraction of it when sampling.
     """
 
-    if not hasattr(target_object, target_function_name):
-        # Do nothing if the target function doesn't exist.
-        return
+    __slots__ = ("calls", "skips", "time", "timed_calls")
 
-    func_def: types.FunctionType
-    func_def_code: types.CodeType
+    def __init__(self) -> None:
+        self.reset()
 
-    if (target_object, target_function_name) not in original_function_definitions:
+    def reset(self) -> None:
+        """
+        Sets every statistic back to zero.
+        """
 
-        # We don't have an original version of the function. Get it
-        func_def = getattr(target_object, target_function_name)
+        self.calls = 0
+        self.skips = 0
+        self.time = 0.0
+        self.timed_calls = 0
 
-        if not isinstance(func_def, types.FunctionType):
-            # This isn't a function.
-            # Arguably, we can move this check into the decorators
-            return
+    @property
+    def average_time(self) -> Optional[float]:
+        """
+        The average time in seconds spent per hook call, or None if no calls have been timed.
+        """
 
-        func_def_code = func_def.__code__
+        if self.timed_calls == 0:
+            return None
 
-        original_function_definitions[(target_object, target_function_name)] = (func_def, func_def.__code__)
-    else:
-        # Use our stored function / code definition
-        func_def, func_def_code = original_function_definitions[(target_object, target_function_name)]
+        return self.time / self.timed_calls
 
-    # Convert to bytecode we can work with
-    func_working_bytecode = Bytecode.from_code(func_def_code)
+    def __repr__(self) -> str:
+        return f"PatchStats(calls={self.calls}, skips={self.skips}, time={self.time}, timed_calls={self.timed_calls})"
 
-    # Figure out what we actually have for patching
 
-    patch_target = PatchTarget(target_object, target_function_name)
+class _SampleState:
+    """
+    The counters used by the generated code of a sampled or rate limited patch.
+    """
 
-    all_patches = [p for plist in (h.patches for name, h in all_patch_handlers.items()) for p in plist if p.enabled and p.target == patch_target]
+    __slots__ = ("calls", "window_end", "window_calls")
 
-    def filter_and_sort(predicate: types.LambdaType) -> List[Patch]:
-        return sorted(
-            [p for p in all_patches if predicate(p) is not None],
-            key=lambda x: x.priority_hint or 0, reverse=True)
+    def __init__(self) -> None:
+        self.calls = 0
+        self.window_end = 0.0
+        self.window_calls = 0
 
-    our_transpilers: List[Patch] = filter_and_sort(lambda p: p.transpiler_func)
-    our_prefixes: List[Patch] = filter_and_sort(lambda p: p.prefix_func)
-    our_postfixes: List[Patch] = filter_and_sort(lambda p: p.postfix_func)
 
-    # Perform transpilers first.
-    # Transpilers expect the original instruction set, so things like prefixes and postfixes
-    #   (which require manual instruction insertions) have to happen after
+class Guard(namedtuple("Guard", ["kind", "name", "value", "negated"])):
+    """
+    A cheap condition on a value of the target function, checked inline before a hook is called. Create them with the class methods below.
 
-    for patch in our_transpilers:
-        func_working_bytecode = patch.transpiler_func(func_working_bytecode)
+    If any guard of a patch doesn't hold, its hook isn't called at all, which avoids building its state dictionary and dispatching to Python code.
+    A skipped prefix lets the original function run, while a skipped finalizer leaves the exception as it is.
+    Guards can check any argument of the target. Postfixes and finalizers can also check "__result", and finalizers "__exception".
+    Use ~guard to negate a guard.
+    """
 
-    # Do prefixes.
-    # We do half the work in bytecode and the other half in regular code, just to make it easier
-    #   instead of writing everything in bytecode
+    __slots__ = ()
 
-    def do_prefixes(arg_object: dict) -> bool:
-        for patch in our_prefixes:
-            return_val = patch.prefix_func(arg_object)
+    IS_INSTANCE = "is_instance"
+    EQUALS = "equals"
+    IS_NONE = "is_none"
+    HAS_FLAG = "has_flag"
 
-            if return_val is not None and not return_val:
-                return False
+    @classmethod
+    def is_instance(cls, name: str, classinfo: object) -> "Guard":
+        """
+        Holds if isinstance(value, classinfo) is true. classinfo can be a type, or a tuple of types.
+        """
 
-        return True
+        return cls(cls.IS_INSTANCE, name, classinfo, False)
 
-    if len(our_prefixes) > 0:    # Don't bother with it if there's no prefixes
-        _assemble_prefix(func_working_bytecode, do_prefixes)
+    @classmethod
+    def equals(cls, name: str, value: object) -> "Guard":
+        """
+        Holds if the value is equal to a constant. The constant must be hashable.
+        """
 
-    # Do postfixes.
+        return cls(cls.EQUALS, name, value, False)
 
-    def do_postfixes(arg_object: dict) -> bool:
-        for patch in our_postfixes:
-            patch.postfix_func(arg_object)
+    @classmethod
+    def is_none(cls, name: str) -> "Guard":
+        """
+        Holds if the value is None.
+        """
 
-    if len(our_postfixes) > 0:    # Don't bother with it if there's no postfixes
-        _assemble_postfix(func_working_bytecode, do_postfixes)
+        return cls(cls.IS_NONE, name, None, False)
 
-    # Set the original function to use our bytecode
+    @classmethod
+    def has_flag(cls, name: str, attribute: str) -> "Guard":
+        """
+        Holds if an attribute of the value is truthy.
+        """
 
-    func_def.__code__ = func_working_bytecode.to_code()
+        return cls(cls.HAS_FLAG, name, attribute, False)
 
+    def __invert__(self) -> "Guard":
+        return self._replace(negated=not self.negated)
 
+    def __repr__(self) -> str:
+        return f"{'~' if self.negated else ''}Guard.{self.kind}({self.name!r}, {self.value!r})"
 
-# Patch classes
 
 class Patch:
     """
@@ -233,41 +2545,306 @@ class Patch:
     """
     def __init__(self,
                  target_object: object,
-                 target_function_name: str,
+                 target_function_name: Optional[str] = None,
                  patch_name: Optional[str] = None,
                  *,
                  enabled: bool = True,
                  priority_hint: int = 0,
+                 inject: bool = False,
+                 instrumentation: Optional[str] = None,
+                 sample_interval: int = 100,
+                 guards: Iterable[Guard] = (),
+                 sample_every: Optional[int] = None,
+                 rate_limit: Optional[int] = None,
+                 inline: bool = False,
+                 state_object: bool = False,
+                 disk_cache: bool = True,
                  transpiler_func: Callable[[Bytecode], Bytecode] = None,
                  prefix_func: Callable[[object], Optional[bool]] = None,
-                 postfix_func: Callable[[object], None] = None) -> None:
+                 postfix_func: Callable[[object], None] = None,
+                 finalizer_func: Callable[[object], object] = None) -> None:
         """
-        Creates a patch object. Only supply a single transpiler, prefix or postfix function.
+        Creates a patch object. Only supply a single transpiler, prefix, postfix or finalizer function.
+
+        The target can be given as a string of the form "package.module:Class.method" (or "package.module:function"), so the module doesn't
+        have to be imported to patch it. If the module hasn't been imported yet, the patch waits until it is, and is applied right after
+        the module has been executed (if its handler has been patched since). Until then, it can't be found through PatchHandler.stats() and the like.
+        If the module turns out not to define the target, a RuntimeWarning is issued and the patch is removed from its handler.
 
-        target_object: The object that the target function belongs to.
-        target_function_name: The attribute name of the function to patch, which belongs to target_object.
+        target_object: The object that the target function belongs to. Can also be a string such as "package.module:Class.method" (see below)
+        target_function_name: The attribute name of the function to patch, which belongs to target_object. Can be left out if it's part of a string target_object.
         patch_name: The name of this specific patch. Used for logging
         enabled: Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
         priority_hint: An integer hint used by the patch library to determine the order patches should be applied in. Larger numbers have higher priority, while smaller (including negative) numbers have lower priority. Defaults to zero
+        inject: If true, the hook function declares the values it needs as its own parameters (by name) instead of receiving a state dictionary. Prefixes can request target arguments, while postfixes can also request local variables and "__result", and finalizers "__result" and "__exception". Parameters annotated with Ref are written back to the target. Not supported for transpilers.
+        instrumentation: Enables collecting runtime statistics of this patch in Patch.stats. See set_instrumentation()
+        sample_interval: When using INSTRUMENT_SAMPLED_TIMING, only one call out of this many is timed. Defaults to 100
+        guards: Conditions that must all hold for the hook to be called, checked inline in the target. See Guard. Not supported for transpilers.
+        sample_every: If supplied, the hook is only called on one out of this many calls to the target. See set_sampling()
+        rate_limit: If supplied, the hook is called at most this many times per second. See set_sampling()
+        inline: If true, the body of the hook is copied into the target instead of calling it, which saves a call frame on every call. Meant for tiny hooks,
+            and only done if the hook is a plain function without closures, nested functions, exception handling, imports or recursion (and isn't a
+            generator or async), and that doesn't use any global variables or builtins. Anything else is called as normal. Tracebacks of an inlined hook
+            point at the target. Only supported for prefixes and postfixes.
+        state_object: If true, the hook receives a state object instead of a state dictionary, which holds each value in a slot of a class generated for
+            the target. It's cheaper to build than a dictionary, and values are read and written as attributes. Other hooks of the same target that
+            don't set this receive a StateView of the object, which works like the dictionary. The result and exception are also available as the
+            result and exception attributes. See state.StateObject. Not supported for transpilers or injected hooks.
+        disk_cache: If false, code built with this patch is never stored in (or loaded from) the on-disk cache. See set_disk_cache_dir()
+            Transpilers are identified there by their code, closure, defaults and keyword defaults. A transpiler whose output depends on anything
+            else, such as a mutable global variable, must set this to false, or other processes could load code built from an outdated value.
         """
 
-        self.target = PatchTarget(target_object, target_function_name)
+        # The target object is only referenced weakly. See _track_target()
+        self.target_path: Optional[str] = None
+        self._target_module_name: Optional[str] = None
+        self._target_object_path: Tuple[str, ...] = ()
+        self._pending_module_name: Optional[str] = None
+        self._apply_on_import = False
+
+        if isinstance(target_object, str):
+            self._target_module_name, self._target_object_path, target_function_name = _parse_target_path(target_object, target_function_name)
+            self.target_path = f"{self._target_module_name}:{'.'.join(self._target_object_path + (target_function_name, ))}"
+
+            target_object = _resolve_target_object(self._target_module_name, self._target_object_path)
+
+            if target_object is None:
+                # Waits for the module to be imported. See _on_module_imported()
+                self._pending_module_name = self._target_module_name
+
+        elif target_function_name is None:
+            raise ValueError("target_function_name is required, unless the target is given as a string")
+
+        self._target_reference = _create_reference(target_object)
+        self._target_function_name = target_function_name
+
+        if self._pending_module_name is None:
+            self._target_key: _TargetKey = (id(target_object), target_function_name)
+            _track_target(target_object)
+        else:
+            self._target_key = (".".join((self._target_module_name, ) + self._target_object_path), target_function_name)
 
-        function_count = sum(1 for f in [transpiler_func, prefix_func, postfix_func] if f is not None)
+        function_count = sum(1 for f in [transpiler_func, prefix_func, postfix_func, finalizer_func] if f is not None)
 
         if function_count != 1:
             raise ValueError(f"Expected a single patch function to be supplied, instead recieved {function_count}")
 
-        remaining_function = transpiler_func or prefix_func or postfix_func
+        remaining_function = transpiler_func or prefix_func or postfix_func or finalizer_func
 
         self.patch_name = patch_name or remaining_function.__name__
 
-        self.priority_hint = priority_hint
-        self.enabled = enabled
+        self._priority_hint = priority_hint
+        self._enabled = enabled
 
         self.transpiler_func = transpiler_func
         self.prefix_func = prefix_func
         self.postfix_func = postfix_func
+        self.finalizer_func = finalizer_func
+
+        self.inject = inject
+        self.injected_params: List[_InjectedParameter] = []
+
+        if inject:
+            if transpiler_func is not None:
+                raise ValueError("Transpilers cannot use argument injection")
+
+            self.injected_params = _get_injected_parameters(remaining_function)
+
+        self.inline = inline
+
+        if inline and (transpiler_func is not None or finalizer_func is not None):
+            raise ValueError("Only prefixes and postfixes can be inlined")
+
+        self.state_object = state_object
+        self.disk_cache = disk_cache
+
+        if state_object and (transpiler_func is not None or inject):
+            raise ValueError("Only hooks that receive the state can use state objects")
+
+        self.guards: Tuple[Guard, ...] = tuple(guards)
+
+        if len(self.guards) > 0:
+            if transpiler_func is not None:
+                raise ValueError("Transpilers cannot use guards")
+
+            try:
+                hash(self.guards)
+            except TypeError:
+                raise ValueError(f"The guards of {self.patch_name} must only compare against hashable values") from None
+
+        # Set directly rather than through the setters, as a new patch isn't in the patch index yet, so there's nothing to invalidate
+        self.stats = PatchStats()
+        self.instrumentation: Optional[str] = self._check_instrumentation(instrumentation, sample_interval)
+        self.sample_interval = sample_interval
+
+        self._check_sampling(sample_every, rate_limit)
+        self._sample_state = _SampleState()
+        self.sample_every: Optional[int] = sample_every
+        self.rate_limit: Optional[int] = rate_limit
+
+    @property
+    def target(self) -> PatchTarget:
+        """
+        The object and attribute name of the function this patch applies to. The object is None once it has been garbage collected.
+        """
+
+        return PatchTarget(self._target_reference(), self._target_function_name)
+
+    def _is_target_dead(self) -> bool:
+        return self._pending_module_name is None and self._target_reference() is None
+
+    def _bind_target(self, target_object: object) -> None:
+        """
+        Sets the target object of a patch that was waiting for its module to be imported.
+        """
+
+        self._target_reference = _create_reference(target_object)
+        self._target_key = (id(target_object), self._target_function_name)
+        self._pending_module_name = None
+
+        _track_target(target_object)
+
+    def _detached_copy(self) -> "Patch":
+        """
+        Returns a copy of this patch without its target object, which can't be pickled (and isn't needed) when sending it to a worker process.
+        """
+
+        patch_copy = copy.copy(self)
+        patch_copy._target_reference = _StrongReference(None)
+
+        return patch_copy
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
+        """
+
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value: bool) -> None:
+        if value != self._enabled:
+            self._enabled = value
+            _patch_index.invalidate(self._target_key)
+
+    @property
+    def priority_hint(self) -> int:
+        """
+        An integer hint used to determine the order patches should be applied in. Larger numbers have higher priority.
+        """
+
+        return self._priority_hint
+
+    @priority_hint.setter
+    def priority_hint(self, value: int) -> None:
+        if value != self._priority_hint:
+            self._priority_hint = value
+            _patch_index.invalidate(self._target_key)
+
+    def set_instrumentation(self, mode: Optional[str], sample_interval: int = 100) -> None:
+        """
+        Sets what runtime statistics are collected for this patch. Takes effect the next time the patch is applied.
+
+        mode: One of:
+            None: Nothing is collected, and the generated code is the same as if instrumentation didn't exist. The default
+            INSTRUMENT_COUNTS: Counts calls, and skips of the original function by prefixes
+            INSTRUMENT_TIMING: Counts like INSTRUMENT_COUNTS, and also times every call to the hook
+            INSTRUMENT_SAMPLED_TIMING: Counts like INSTRUMENT_COUNTS, but only times one call out of every sample_interval
+        sample_interval: How often calls are timed when using INSTRUMENT_SAMPLED_TIMING.
+        Transpilers run once when patching, so they are never instrumented.
+        """
+
+        mode = self._check_instrumentation(mode, sample_interval)
+
+        if (mode, sample_interval) != (self.instrumentation, self.sample_interval):
+            self.instrumentation = mode
+            self.sample_interval = sample_interval
+            _patch_index.invalidate(self._target_key)
+
+    def set_sampling(self, sample_every: Optional[int] = None, rate_limit: Optional[int] = None) -> None:
+        """
+        Limits how often the hook is called, which is checked inline in the target before any state is built. Takes effect the next time the patch is applied.
+
+        sample_every: If supplied, the hook is only called on every sample_every-th call that passes its guards.
+        rate_limit: If supplied, the hook is called at most this many times per second. Calls over the limit skip it.
+        A skipped prefix lets the original function run, and a skipped finalizer leaves the exception as it is. Pass None for both to call the hook every time.
+        Transpilers run once when patching, so they can't be sampled.
+        """
+
+        self._check_sampling(sample_every, rate_limit)
+
+        if (sample_every, rate_limit) != (self.sample_every, self.rate_limit):
+            self.sample_every = sample_every
+            self.rate_limit = rate_limit
+            _patch_index.invalidate(self._target_key)
+
+    def _check_instrumentation(self, mode: Optional[str], sample_interval: int) -> Optional[str]:
+        """
+        Validates the arguments of set_instrumentation(), and returns the mode that actually applies to this patch.
+        """
+
+        if mode not in _INSTRUMENTATION_MODES:
+            raise ValueError(f"Unknown instrumentation mode {mode!r}")
+
+        if sample_interval < 1:
+            raise ValueError("sample_interval must be at least 1")
+
+        return None if self.transpiler_func is not None else mode
+
+    def _check_sampling(self, sample_every: Optional[int], rate_limit: Optional[int]) -> None:
+        """
+        Validates the arguments of set_sampling().
+        """
+
+        if sample_every is not None and sample_every < 1:
+            raise ValueError("sample_every must be at least 1")
+
+        if rate_limit is not None and rate_limit < 1:
+            raise ValueError("rate_limit must be at least 1")
+
+        if self.transpiler_func is not None and (sample_every, rate_limit) != (None, None):
+            raise ValueError("Transpilers cannot be sampled or rate limited")
+
+    def _get_compile_key(self) -> tuple:
+        """
+        Returns a hashable value describing everything about this patch that affects the code generated for its target.
+        """
+
+        compile_key = (self.transpiler_func, self.prefix_func, self.postfix_func, self.finalizer_func, self.inject, self.guards, self.inline, self.state_object)
+
+        # Instrumented and sampled code references this patch's own stats and counters, so it can't be shared with other patches using the same hook
+
+        if self.instrumentation is not None:
+            compile_key += (self.instrumentation, self.sample_interval, self.stats)
+
+        if self.sample_every is not None or self.rate_limit is not None:
+            compile_key += (self.sample_every, self.rate_limit, self._sample_state)
+
+        return compile_key
+
+    def _get_disk_identity(self) -> Optional[tuple]:
+        """
+        Returns a value identifying this patch that is stable across processes, for use by the on-disk cache.
+        """
+
+        if not self.disk_cache:
+            return None
+
+        if self.transpiler_func is not None:
+            return diskcache.get_patch_identity("transpiler", self.transpiler_func, include_bindings=True)
+
+        # Injected parameters come from the signature of the hook (including Ref annotations), which isn't part of its code
+        options = (self.inject, tuple((param.name, param.writable) for param in self.injected_params), self.instrumentation, self.sample_interval, self.guards,
+                   self.sample_every, self.rate_limit, self.inline, self.state_object)
+
+        if self.prefix_func is not None:
+            return diskcache.get_patch_identity("prefix", self.prefix_func, options)
+
+        if self.postfix_func is not None:
+            return diskcache.get_patch_identity("postfix", self.postfix_func, options)
+
+        return diskcache.get_patch_identity("finalizer", self.finalizer_func, options)
 
 
 class PatchHandler:
@@ -282,25 +2859,88 @@ class PatchHandler:
         """
 
         self.instance_name = instance_name or str(id(self))
-        self.patches: List[Patch]
+        self._patches: PatchList
 
-        existing_instance = all_patch_handlers.get(self.instance_name, None)
+        with _state_lock:
+            _purge_dead_targets()
 
-        if existing_instance is not None:
-            self.patches = existing_instance.patches
-        else:
-            self.patches = []
-            all_patch_handlers[self.instance_name] = self
+            # The patches outlive the handlers of an instance name, as long as there are any left
+            existing_patches = _handler_patches.get(self.instance_name, None)
+
+            if existing_patches is not None:
+                self._patches = existing_patches
+            else:
+                self._patches = _handler_patches[self.instance_name] = PatchList()
+                self._patches._register()
 
-    def patch_all(self):
+            all_patch_handlers.setdefault(self.instance_name, self)
+
+    @property
+    def patches(self) -> PatchList:
+        """
+        The patches that belong to this handler. Changes to this list are tracked, so patches can be added and removed directly.
+        Patches are removed automatically once the object they target has been garbage collected.
+        """
+
+        if _dead_target_ids:
+            with _state_lock:
+                _purge_dead_targets()
+
+        return self._patches
+
+    @patches.setter
+    def patches(self, value: Iterable[Patch]) -> None:
+        # Keep the same list, as it may be shared with other handlers of the same instance_name
+        self._patches[:] = value
+
+    def patch_all(self, workers: Optional[int] = None):
         """
         (Re)applies all patches that belong to this handler, respecting the Patch.enabled property.
+
+        Only targets whose set of enabled patches has changed since they were last patched are touched. Targets left without any
+        patches get their original code object back.
+
+        workers: If supplied, targets are compiled in a pool of this many worker processes. Only worth it for large amounts of targets.
+        The worker processes are started on first use and kept around for later calls, so only the first call pays for starting them.
+        They aren't forked from this process, but started fresh (through the "forkserver" or "spawn" start method of multiprocessing), so a
+        script that patches with workers needs an if __name__ == "__main__" guard, the same as for any other such process pool.
+        Targets with hooks that can't be imported by name (such as lambdas or nested functions) are still compiled in this process.
+
+        Safe to call from multiple threads at once, and while other threads are running the targets. See _state_lock.
+        """
+
+        with _state_lock:
+            targets = dict.fromkeys(p.target for p in self.patches if p._pending_module_name is None) # if p.enabled
+
+            for patch in self.patches:
+                if patch._pending_module_name is not None:
+                    patch._apply_on_import = True
+
+        _apply_targets(targets, workers)
+
+    def set_instrumentation(self, mode: Optional[str], sample_interval: int = 100) -> None:
+        """
+        Sets what runtime statistics are collected for every patch in this handler, and reapplies them. See Patch.set_instrumentation()
         """
 
-        targets = set(p.target for p in self.patches) # if p.enabled
+        for patch in self.patches:
+            patch.set_instrumentation(mode, sample_interval)
+
+        self.patch_all()
+
+    def stats(self) -> Dict[Patch, PatchStats]:
+        """
+        Returns the runtime statistics of every patch in this handler. Only instrumented patches collect any.
+        """
+
+        return {patch: patch.stats for patch in self.patches}
+
+    def batch(self, workers: Optional[int] = None) -> ContextManager[None]:
+        """
+        Returns a context manager that defers patching until it exits. See batch_patches().
+        """
 
-        for target in targets:
-            _reevaluate_function(target.target_object, target.target_function_name)
+        return batch_patches(workers)
 
     def unpatch_all(self):
         """
@@ -319,8 +2959,13 @@ class PatchHandler:
         Please use this if you are creating a lot of handlers and discarding them, to keep the global state tracker performant.
         """
 
-        if self.instance_name in all_patch_handlers:
-            all_patch_handlers.pop(self.instance_name)
+        with _state_lock:
+            all_patch_handlers.pop(self.instance_name, None)
+
+            if _handler_patches.get(self.instance_name) is self._patches:
+                del _handler_patches[self.instance_name]
+
+            self._patches._unregister()
 
         self.unpatch_all()
 
@@ -328,13 +2973,108 @@ class PatchHandler:
 
 # Global state
 
-original_function_definitions: Dict[FunctionTarget, FunctionDefinition] = {}
+# All of the global state below is protected by _state_lock. It is only held for short periods of time:
+#   - Looking up the original code and enabled patches of targets, along with the version of those patches
+#   - Modifying patch lists, handlers and caches
+#   - Installing new code objects
+# Compiling (including running transpilers) happens without the lock, so other threads can keep changing patches meanwhile.
+# Installing is a compare-and-swap against the version of the patches the code was built from. If the patches have changed
+#   since, the code is thrown away and compiled again, so concurrent patch_all() calls always end with the latest patches installed.
+# Calling a patched function never takes the lock. Swapping __code__ is atomic, and running calls finish with the code they started with.
+# Nothing here keeps a target object (or its functions) alive. See _track_target()
+
+_state_lock = threading.RLock()
+
+# Weak references to every target object we know of, keyed by their id()
+_target_references: Dict[int, Callable[[], object]] = {}
+
+# The ids of target objects that have been garbage collected, waiting for _purge_dead_targets()
+_dead_target_ids: List[int] = []
+
+# A weak reference to the original function of each target, along with its original code
+_original_functions: Dict[_TargetKey, Tuple[Callable[[], types.FunctionType], types.CodeType]] = {}
+
+# Trampolines of targets that aren't Python functions, which are installed on their target object while it has patches
+_trampolines: Dict[_TargetKey, trampoline.Trampoline] = {}
+
+# Patches waiting for their module to be imported. See _defer_patch()
+_deferred_patches: Dict[str, List[Patch]] = {}
+
+# The fingerprint of the patches applied to each patched target, along with the code object installed for them.
+# Targets without an entry have their original code installed
+_applied_patches: Dict[_TargetKey, Tuple[tuple, types.CodeType]] = {}
+
+_code_cache: _CodeCache = _CodeCache(256)
+
+# Reverse patches of each target, keyed by the target and the transpiler they were built with. See reverse_patch()
+_reverse_patches: Dict[Tuple[_TargetKey, Optional[Callable]], _ReversePatch] = {}
+
+_stage_cache: _StageCache = _StageCache()
+
+_disk_cache: Optional[diskcache.DiskCache] = None
+set_disk_cache_dir(os.environ.get("PYHARMONY_CACHE_DIR"))
+
+_patch_index: _PatchIndex = _PatchIndex()
+
+# Handlers are only referenced weakly, while their patch lists are kept for as long as they have any patches in them
+all_patch_handlers: "weakref.WeakValueDictionary[str, PatchHandler]" = weakref.WeakValueDictionary()
+_handler_patches: Dict[str, PatchList] = {}
 
-all_patch_handlers: Dict[str, PatchHandler] = {}
 anonymous_handler: PatchHandler = PatchHandler("_anonymous")
 
 
 
+# Batching
+
+# Batches are per thread, so a batch in one thread never delays patching in another
+_batch_state = threading.local()
+
+
+@contextlib.contextmanager
+def batch_patches(workers: Optional[int] = None) -> Iterator[None]:
+    """
+    A context manager that defers all patching until it exits.
+
+    Inside of it, PatchHandler.patch_all() (including the one run by the decorators) only records which targets need to be patched.
+    When the outermost batch exits, each of those targets is reevaluated exactly once.
+
+    workers: If supplied, targets are compiled in a pool of this many worker processes when the batch exits. See PatchHandler.patch_all().
+    Batches only apply to the thread they are entered in.
+    """
+
+    if getattr(_batch_state, "pending_targets", None) is not None:
+        # Nested batches are merged into the outermost one
+        yield
+        return
+
+    _batch_state.pending_targets = {}
+
+    try:
+        yield
+    finally:
+        targets = _batch_state.pending_targets
+        _batch_state.pending_targets = None
+
+        _reevaluate_functions(targets, workers)
+
+
+
+def _apply_targets(targets: Iterable[PatchTarget], workers: Optional[int] = None) -> None:
+    """
+    Reevaluates targets, or adds them to the current batch if there is one.
+    """
+
+    pending_batch_targets = getattr(_batch_state, "pending_targets", None)
+
+    if pending_batch_targets is not None:
+        # Inside of a batch, so wait until it's finished
+        pending_batch_targets.update(dict.fromkeys(targets))
+        return
+
+    _reevaluate_functions(targets, workers)
+
+
+
 # Decorators
 
 def __create_decorator_patch(target: PatchTarget,
@@ -344,18 +3084,34 @@ def __create_decorator_patch(target: PatchTarget,
                              enabled: bool,
                              apply: bool,
                              *,
+                             inject: bool = False,
+                             guards: Iterable[Guard] = (),
+                             sample_every: Optional[int] = None,
+                             rate_limit: Optional[int] = None,
+                             inline: bool = False,
+                             state_object: bool = False,
+                             disk_cache: bool = True,
                              transpiler_func=None,
                              prefix_func=None,
-                             postfix_func=None):
+                             postfix_func=None,
+                             finalizer_func=None):
 
     patch = Patch(target.target_object,
                   target.target_function_name,
                   patch_name,
                   enabled=enabled,
                   priority_hint=priority_hint,
+                  inject=inject,
+                  guards=guards,
+                  sample_every=sample_every,
+                  rate_limit=rate_limit,
+                  inline=inline,
+                  state_object=state_object,
+                  disk_cache=disk_cache,
                   transpiler_func=transpiler_func,
                   prefix_func=prefix_func,
-                  postfix_func=postfix_func)
+                  postfix_func=postfix_func,
+                  finalizer_func=finalizer_func)
 
     handler = handler or anonymous_handler
     handler.patches.append(patch)
@@ -365,78 +3121,160 @@ def __create_decorator_patch(target: PatchTarget,
 
 
 def transpiler(target_object: object,
-               target_function_name: str,
+               target_function_name: Optional[str] = None,
                patch_name: Optional[str] = None,
                handler: Optional[PatchHandler] = None,
                priority_hint: Optional[int] = None,
                enabled: bool = True,
-               apply: bool = True) -> types.FunctionType:
+               apply: bool = True,
+               disk_cache: bool = True) -> types.FunctionType:
     """
     Specifies a bytecode-level transpiler hook.
 
-    target_object: The object that the target function belongs to.
-    target_function_name: The attribute name of the function to patch, which belongs to target_object.
+    target_object: The object that the target function belongs to, or a string such as "package.module:Class.method". See Patch
+    target_function_name: The attribute name of the function to patch, which belongs to target_object. Can be left out if it's part of a string target_object.
     patch_name: The name of this specific patch. Used for logging
     handler: The PatchHandler to associate this hook with. If not supplied, the patch will be assigned to the anonymous patch handler.
     priority_hint: An integer hint used by the patch library to determine the order patches should be applied in. Larger numbers have higher priority, while smaller (including negative) numbers have lower priority. Defaults to zero
     enabled: Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
     apply: Whether or not to run PatchHandler.patch_all() automatically after creating this hook.
+    disk_cache: If false, code built with this transpiler is never stored in the on-disk cache. Required if its output depends on mutable global state. See Patch
     """
     def wrapper(func):
 
-        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, transpiler_func=func)
+        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, disk_cache=disk_cache,
+                                 transpiler_func=func)
 
         return func
 
     return wrapper
 
 
-def prefix(target_object: object, target_function_name: str,
+def prefix(target_object: object, target_function_name: Optional[str] = None,
                patch_name: Optional[str] = None,
                handler: Optional[PatchHandler] = None,
                priority_hint: Optional[int] = None,
                enabled: bool = True,
-               apply: bool = True) -> types.FunctionType:
+               apply: bool = True,
+               inject: bool = False,
+               guards: Iterable[Guard] = (),
+               sample_every: Optional[int] = None,
+               rate_limit: Optional[int] = None,
+               inline: bool = False,
+               state_object: bool = False) -> types.FunctionType:
     """
     Specifies a prefix hook.
 
-    target_object: The object that the target function belongs to.
-    target_function_name: The attribute name of the function to patch, which belongs to target_object.
+    For generators, coroutines and async generators, the prefix runs as soon as the function is called, and skipping it returns
+    a generator (or coroutine) that finishes immediately. An async prefix is awaited when the coroutine starts instead.
+
+    target_object: The object that the target function belongs to, or a string such as "package.module:Class.method". See Patch
+    target_function_name: The attribute name of the function to patch, which belongs to target_object. Can be left out if it's part of a string target_object.
     patch_name: The name of this specific patch. Used for logging
     handler: The PatchHandler to associate this hook with. If not supplied, the patch will be assigned to the anonymous patch handler.
     priority_hint: An integer hint used by the patch library to determine the order patches should be applied in. Larger numbers have higher priority, while smaller (including negative) numbers have lower priority. Defaults to zero
     enabled: Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
     apply: Whether or not to run PatchHandler.patch_all() automatically after creating this hook.
+    inject: If true, the prefix receives the target arguments it names as parameters, instead of a state dictionary. Annotate a parameter with Ref to modify the argument.
+    guards: Conditions on the target's arguments that must all hold for the prefix to be called. See Guard.
+    sample_every: If supplied, the prefix is only called on one out of this many calls. See Patch.set_sampling()
+    rate_limit: If supplied, the prefix is called at most this many times per second. See Patch.set_sampling()
+    inline: If true, the body of the prefix is copied into the target instead of calling it, as long as it's simple enough. See Patch
+    state_object: If true, the prefix receives a state object (with the values as attributes) instead of a state dictionary. See Patch
     """
     def wrapper(func):
 
-        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, prefix_func=func)
+        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, inject=inject, guards=guards,
+                                 sample_every=sample_every, rate_limit=rate_limit, inline=inline, state_object=state_object,
+                                 prefix_func=func)
 
         return func
 
     return wrapper
 
 
-def postfix(target_object: object, target_function_name: str,
+def postfix(target_object: object, target_function_name: Optional[str] = None,
                patch_name: Optional[str] = None,
                handler: Optional[PatchHandler] = None,
                priority_hint: Optional[int] = None,
                enabled: bool = True,
-               apply: bool = True) -> types.FunctionType:
+               apply: bool = True,
+               inject: bool = False,
+               guards: Iterable[Guard] = (),
+               sample_every: Optional[int] = None,
+               rate_limit: Optional[int] = None,
+               inline: bool = False,
+               state_object: bool = False) -> types.FunctionType:
     """
     Specifies a postfix hook.
 
-    target_object: The object that the target function belongs to.
-    target_function_name: The attribute name of the function to patch, which belongs to target_object.
+    For generators, coroutines and async generators, the postfix runs once they finish, with their actual return value as the result.
+    An async postfix is awaited before a coroutine or async generator finishes.
+
+    target_object: The object that the target function belongs to, or a string such as "package.module:Class.method". See Patch
+    target_function_name: The attribute name of the function to patch, which belongs to target_object. Can be left out if it's part of a string target_object.
+    patch_name: The name of this specific patch. Used for logging
+    handler: The PatchHandler to associate this hook with. If not supplied, the patch will be assigned to the anonymous patch handler.
+    priority_hint: An integer hint used by the patch library to determine the order patches should be applied in. Larger numbers have higher priority, while smaller (including negative) numbers have lower priority. Defaults to zero
+    enabled: Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
+    apply: Whether or not to run PatchHandler.patch_all() automatically after creating this hook.
+    inject: If true, the postfix receives the target arguments, local variables and "__result" it names as parameters, instead of a state dictionary. Annotate "__result" with Ref to modify the result.
+    guards: Conditions on the target's arguments and "__result" that must all hold for the postfix to be called. See Guard.
+    sample_every: If supplied, the postfix is only called on one out of this many calls. See Patch.set_sampling()
+    rate_limit: If supplied, the postfix is called at most this many times per second. See Patch.set_sampling()
+    inline: If true, the body of the postfix is copied into the target instead of calling it, as long as it's simple enough. See Patch
+    state_object: If true, the postfix receives a state object (with the values as attributes) instead of a state dictionary. See Patch
+    """
+    def wrapper(func):
+
+        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, inject=inject, guards=guards,
+                                 sample_every=sample_every, rate_limit=rate_limit, inline=inline, state_object=state_object,
+                                 postfix_func=func)
+
+        return func
+
+    return wrapper
+
+
+def finalizer(target_object: object, target_function_name: Optional[str] = None,
+               patch_name: Optional[str] = None,
+               handler: Optional[PatchHandler] = None,
+               priority_hint: Optional[int] = None,
+               enabled: bool = True,
+               apply: bool = True,
+               inject: bool = False,
+               guards: Iterable[Guard] = (),
+               sample_every: Optional[int] = None,
+               rate_limit: Optional[int] = None,
+               state_object: bool = False) -> types.FunctionType:
+    """
+    Specifies a finalizer hook, which runs after the target function has returned or raised an exception (including from other hooks).
+
+    The finalizer receives the exception (None if there isn't one) as "__exception", and the result as "__result". Its return value decides what happens to the exception:
+        True: The exception is swallowed, and the function returns the result instead
+        An exception instance: The exception is replaced with this one
+        Anything else (such as None): The exception is raised as usual
+    The return value is ignored if the target didn't raise.
+    The result can be modified by the finalizer, through a Ref or the state dictionary.
+
+    target_object: The object that the target function belongs to, or a string such as "package.module:Class.method". See Patch
+    target_function_name: The attribute name of the function to patch, which belongs to target_object. Can be left out if it's part of a string target_object.
     patch_name: The name of this specific patch. Used for logging
     handler: The PatchHandler to associate this hook with. If not supplied, the patch will be assigned to the anonymous patch handler.
     priority_hint: An integer hint used by the patch library to determine the order patches should be applied in. Larger numbers have higher priority, while smaller (including negative) numbers have lower priority. Defaults to zero
     enabled: Whether or not this patch is enabled. If false, then this patch will be skipped over when evaluating which patches to apply to the target method.
     apply: Whether or not to run PatchHandler.patch_all() automatically after creating this hook.
+    inject: If true, the finalizer receives the target arguments, "__result" and "__exception" it names as parameters, instead of a state dictionary. Annotate "__result" with Ref to modify the result.
+    guards: Conditions on the target's arguments, "__result" and "__exception" that must all hold for the finalizer to be called. See Guard.
+    sample_every: If supplied, the finalizer is only called on one out of this many calls. See Patch.set_sampling()
+    rate_limit: If supplied, the finalizer is called at most this many times per second. See Patch.set_sampling()
+    state_object: If true, the finalizer receives a state object (with the values as attributes) instead of a state dictionary. See Patch
     """
     def wrapper(func):
 
-        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, postfix_func=func)
+        __create_decorator_patch(PatchTarget(target_object, target_function_name), patch_name, priority_hint, handler, enabled, apply, inject=inject, guards=guards,
+                                 sample_every=sample_every, rate_limit=rate_limit, state_object=state_object,
+                                 finalizer_func=func)
 
         return func
 
@@ -0,0 +1,117 @@
+"""
+Contains the state objects that hooks can receive instead of a state dictionary. See Patch (state_object)
+"""
+
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, Tuple
+
+
+class StateObject:
+    """
+    Base class of the generated state classes, which have a slot for every argument of their target (along with its local variables and
+    "__result" for postfixes, or "__result" and "__exception" for finalizers). Values are accessed as attributes, so building one is a
+    single allocation with no hashing involved.
+
+    Values that aren't available (such as a local variable that hasn't been assigned yet) are left unset, so reading them raises an
+    AttributeError, the same way a state dictionary wouldn't have their key.
+
+    "__result" and "__exception" can also be accessed as "result" and "exception", unless the target has a variable of the same name.
+    Those don't get name mangled inside of a class body, and don't need getattr().
+    """
+
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{name}={value!r}' for name, value in StateView(self).items())})"
+
+
+class StateView(MutableMapping):
+    """
+    A dictionary view of a state object. Hooks that take a state dictionary receive one of these when other hooks of the same target use state objects.
+
+    Keys can only be the fields of the state object, so unlike a state dictionary, it can't store anything else.
+    """
+
+    __slots__ = ("state", )
+
+    def __init__(self, state: StateObject) -> None:
+        self.state = state
+
+    def __getitem__(self, name: str) -> object:
+        if name in type(self.state).__slots__:
+            try:
+                return getattr(self.state, name)
+            except AttributeError:
+                pass
+
+        raise KeyError(name)
+
+    def __setitem__(self, name: str, value: object) -> None:
+        if name not in type(self.state).__slots__:
+            raise KeyError(f"{name} is not a field of {type(self.state).__name__}")
+
+        setattr(self.state, name, value)
+
+    def __delitem__(self, name: str) -> None:
+        if name not in self:
+            raise KeyError(name)
+
+        delattr(self.state, name)
+
+    def __contains__(self, name: object) -> bool:
+        return name in type(self.state).__slots__ and hasattr(self.state, name)
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name in type(self.state).__slots__ if hasattr(self.state, name))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+# Fields that are also reachable under a plain name, as long as it isn't taken by another field
+_FIELD_ALIASES = {"__result": "result", "__exception": "exception"}
+
+# Generated classes are shared by targets with the same name and fields, so the same class is found again in every process (see get_state_class())
+_state_classes: Dict[Tuple[str, Tuple[str, ...]], type] = {}
+
+
+def get_state_class(name: str, fields: Tuple[str, ...]) -> type:
+    """
+    Returns the state class with the given fields, creating it if needed. name is the name of the target function, along with the kind of hook.
+
+    Creating it again always returns the same class, which is what lets patched code referencing it be linked again by the disk cache.
+    """
+
+    state_class = _state_classes.get((name, fields))
+
+    if state_class is None:
+        class_name = f"{name}_state"
+        state_class = type(class_name, (StateObject, ), {"__slots__": fields, "__module__": __name__})
+
+        # Slots such as "__result" are name mangled like private attributes, so they also have to be reachable under their actual name
+        mangle_prefix = "_" + class_name.lstrip("_") if class_name.lstrip("_") else ""
+
+        for field in fields:
+            if field.startswith("__") and mangle_prefix:
+                setattr(state_class, field, state_class.__dict__[mangle_prefix + field])
+
+            alias = _FIELD_ALIASES.get(field)
+
+            if alias is not None and alias not in fields:
+                setattr(state_class, alias, getattr(state_class, field))
+
+        # Another thread could have beaten us to it
+        state_class = _state_classes.setdefault((name, fields), state_class)
+
+    return state_class
+
+
+def is_field_name(name: str) -> bool:
+    """
+    Returns whether a variable can be a field of a state object. Special names (such as __class__) would clash with the attributes of the class.
+    """
+
+    return name.isidentifier() and not (name.startswith("__") and name.endswith("__"))
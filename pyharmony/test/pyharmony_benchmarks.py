@@ -0,0 +1,502 @@
+"""
+Benchmarks for the overhead pyHarmony adds to patched functions, and for the time it takes to apply patches.
+
+Run with:
+    python -m pyharmony.test.pyharmony_benchmarks [--quick] [--output results.json] [--compare previous.json]
+
+Results are written as JSON, so runs from different commits can be compared with --compare.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import types
+from typing import Callable, Dict, List, Optional
+import bytecode
+import pyharmony
+from pyharmony import Patch, PatchHandler, Ref
+
+# Bump this whenever the layout of the results changes
+RESULTS_FORMAT_VERSION = 1
+
+
+
+# Targets
+
+def call_target(arg1, arg2):
+    return arg1 + arg2
+
+
+def many_locals_target(arg1, arg2):
+    local_1 = arg1 + 1
+    local_2 = arg2 + 2
+    local_3 = local_1 * 3
+    local_4 = local_2 * 4
+    local_5 = local_3 + local_4
+    local_6 = local_5 - arg1
+    local_7 = local_6 - arg2
+    local_8 = local_7 * 2
+    local_9 = local_8 + local_1
+    local_10 = local_9 + local_2
+    return local_10
+
+
+def scaling_target(value):
+    return value + 1
+
+
+
+# Hooks
+
+def transpiler_hook(code: bytecode.Bytecode) -> bytecode.Bytecode:
+    # Leave the code as is, so only the cost of rebuilding the function is measured
+    return code
+
+
+def prefix_hook(arg_obj: dict) -> None:
+    pass
+
+
+def injected_prefix_hook(arg1) -> None:
+    pass
+
+
+def skipping_prefix_hook(arg_obj: dict) -> bool:
+    return False
+
+
+def postfix_hook(arg_obj: dict) -> None:
+    pass
+
+
+def injected_postfix_hook(__result) -> None:
+    pass
+
+
+def state_object_hook(state) -> None:
+    pass
+
+
+clamp_limit = 50
+
+
+def clamping_prefix_hook(arg1: Ref) -> None:
+    # Uses a global and a builtin, so it can't be inlined
+    arg1.value = min(arg1.value, clamp_limit)
+
+
+def local_clamping_prefix_hook(arg1: Ref) -> None:
+    if arg1.value > 50:
+        arg1.value = 50
+
+
+
+# Call overhead
+
+def _copy_function(template: types.FunctionType, name: str) -> types.FunctionType:
+    """
+    Creates a fresh copy of a target function with its own code object, so patches and cached code never leak between benchmarks.
+    """
+
+    return types.FunctionType(template.__code__.replace(co_name=name), template.__globals__, name)
+
+
+def _create_call_case(template: types.FunctionType, hooks: List[Callable[[types.ModuleType, str], Patch]]) -> Callable[[], tuple]:
+    """
+    Returns a function that creates a patched copy of template, and returns it along with an unpatched copy and its handler.
+    """
+
+    def create():
+        holder = types.ModuleType("call_case")
+        holder.target = _copy_function(template, "target")
+        unpatched = _copy_function(template, "target")
+        handler = PatchHandler()
+
+        for hook in hooks:
+            handler.patches.append(hook(holder, "target"))
+
+        handler.patch_all()
+
+        return holder.target, unpatched, handler
+
+    return create
+
+
+def _prefixes(count: int, inject: bool = False, state_object: bool = False) -> List[Callable[[types.ModuleType, str], Patch]]:
+    if inject:
+        return [lambda holder, name: Patch(holder, name, inject=True, prefix_func=injected_prefix_hook)] * count
+
+    if state_object:
+        return [lambda holder, name: Patch(holder, name, state_object=True, prefix_func=state_object_hook)] * count
+
+    return [lambda holder, name: Patch(holder, name, prefix_func=prefix_hook)] * count
+
+
+CALL_CASES: Dict[str, Callable[[], tuple]] = {
+    "transpiler": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, transpiler_func=transpiler_hook)]),
+    "prefix_1": _create_call_case(call_target, _prefixes(1)),
+    "prefix_5": _create_call_case(call_target, _prefixes(5)),
+    "prefix_20": _create_call_case(call_target, _prefixes(20)),
+    "injected_prefix_1": _create_call_case(call_target, _prefixes(1, inject=True)),
+    "injected_prefix_5": _create_call_case(call_target, _prefixes(5, inject=True)),
+    "injected_prefix_20": _create_call_case(call_target, _prefixes(20, inject=True)),
+    "state_object_prefix_1": _create_call_case(call_target, _prefixes(1, state_object=True)),
+    "state_object_prefix_5": _create_call_case(call_target, _prefixes(5, state_object=True)),
+    "state_object_prefix_20": _create_call_case(call_target, _prefixes(20, state_object=True)),
+    "clamping_prefix": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, inject=True, prefix_func=clamping_prefix_hook)]),
+    "inlined_clamping_prefix": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, inject=True, inline=True, prefix_func=clamping_prefix_hook)]),
+    "local_clamping_prefix": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, inject=True, prefix_func=local_clamping_prefix_hook)]),
+    "inlined_local_clamping_prefix": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, inject=True, inline=True,
+                                                                                                 prefix_func=local_clamping_prefix_hook)]),
+    "prefix_skip": _create_call_case(call_target, [lambda holder, name: Patch(holder, name, prefix_func=skipping_prefix_hook)]),
+    "postfix_many_locals": _create_call_case(many_locals_target, [lambda holder, name: Patch(holder, name, postfix_func=postfix_hook)]),
+    "injected_postfix_many_locals": _create_call_case(many_locals_target, [lambda holder, name: Patch(holder, name, inject=True, postfix_func=injected_postfix_hook)]),
+    "state_object_postfix_many_locals": _create_call_case(many_locals_target, [lambda holder, name: Patch(holder, name, state_object=True, postfix_func=state_object_hook)]),
+}
+
+
+def _time_calls(func: Callable, number: int, repeat: int) -> float:
+    """
+    Returns the fastest time per call in nanoseconds. The minimum is the most stable measure, as everything else is noise from the system.
+    """
+
+    timer = timeit.Timer("func(1, 2)", globals={"func": func})
+    timer.timeit(number // 10 or 1)    # Warm up
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def benchmark_call_overhead(number: int, repeat: int, cases: Optional[List[str]] = None) -> List[dict]:
+    """
+    Measures the time per call of each patched case, compared to the same function while unpatched.
+    """
+
+    results = []
+
+    for case_name, create in CALL_CASES.items():
+        if cases is not None and case_name not in cases:
+            continue
+
+        func, unpatched, handler = create()
+
+        try:
+            baseline_ns = _time_calls(unpatched, number, repeat)
+            patched_ns = _time_calls(func, number, repeat)
+        finally:
+            handler.destroy()
+
+        results.append({
+            "name": case_name,
+            "baseline_ns": baseline_ns,
+            "patched_ns": patched_ns,
+            "overhead_ns": patched_ns - baseline_ns,
+        })
+
+    return results
+
+
+
+# Patching scaling
+
+def _create_scaling_handlers(target_count: int, patch_count: int, handler_count: int) -> List[PatchHandler]:
+    holder = types.ModuleType("scaling_case")
+    names = [f"target_{index}" for index in range(target_count)]
+
+    for name in names:
+        setattr(holder, name, _copy_function(scaling_target, name))
+
+    handlers = []
+
+    for _ in range(handler_count):
+        handler = PatchHandler()
+
+        for name in names:
+            for _ in range(patch_count):
+                handler.patches.append(Patch(holder, name, postfix_func=postfix_hook))
+
+        handlers.append(handler)
+
+    return handlers
+
+
+def _time_operation(operation: Callable[[], None]) -> float:
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        start = time.perf_counter()
+        operation()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _run_scaling(target_count: int, patch_count: int, handler_count: int) -> Dict[str, float]:
+    """
+    Times each patching operation once, on a freshly created set of targets and handlers.
+    """
+
+    handlers = _create_scaling_handlers(target_count, patch_count, handler_count)
+
+    def patch_all():
+        for handler in handlers:
+            handler.patch_all()
+
+    def unpatch_all():
+        for handler in handlers:
+            handler.unpatch_all()
+
+    def destroy():
+        for handler in handlers:
+            handler.destroy()
+
+    pyharmony.clear_code_cache()
+
+    timings = {
+        "patch_all_cold": _time_operation(patch_all),
+        "patch_all_warm": _time_operation(patch_all),
+        "unpatch_all": _time_operation(unpatch_all),
+    }
+
+    for handler in handlers:
+        for patch in handler.patches:
+            patch.enabled = True
+
+    patch_all()
+
+    timings["destroy"] = _time_operation(destroy)
+
+    return timings
+
+
+def benchmark_scaling(sizes: List[int], repeat: int) -> List[dict]:
+    """
+    Measures how patch_all(), unpatch_all() and destroy() scale as the amount of targets, patches per target and handlers grow.
+    Each dimension is scaled on its own, while the others stay at their smallest size.
+    """
+
+    configurations = []
+
+    for size in sizes:
+        configurations.append(("targets", size, 1, 1))
+
+    for size in sizes[1:]:
+        configurations.append(("patches", sizes[0], size, 1))
+        configurations.append(("handlers", sizes[0], 1, size))
+
+    results = []
+
+    for dimension, target_count, patch_count, handler_count in configurations:
+        runs = [_run_scaling(target_count, patch_count, handler_count) for _ in range(repeat)]
+
+        for operation in runs[0]:
+            seconds = [run[operation] for run in runs]
+
+            results.append({
+                "dimension": dimension,
+                "targets": target_count,
+                "patches_per_target": patch_count,
+                "handlers": handler_count,
+                "operation": operation,
+                "min_seconds": min(seconds),
+                "median_seconds": statistics.median(seconds),
+            })
+
+    return results
+
+
+
+# Concurrent churn
+
+def _run_churn(duration: float, reader_count: int, writer_count: int) -> dict:
+    """
+    Runs reader threads calling a patched function for a while, with writer threads repeatedly changing and reapplying its patch.
+    The patch only has its priority changed, so the readers always run equivalent code.
+    """
+
+    holder = types.ModuleType("churn_case")
+    holder.target = _copy_function(call_target, "target")
+
+    handler = PatchHandler()
+    patch = Patch(holder, "target", inject=True, prefix_func=injected_prefix_hook)
+    handler.patches.append(patch)
+    handler.patch_all()
+
+    stop = threading.Event()
+    calls = [0] * reader_count
+    repatches = [0] * writer_count
+
+    def read(index):
+        target = holder.target
+        count = 0
+
+        while not stop.is_set():
+            for _ in range(100):
+                target(1, 2)
+
+            count += 100
+
+        calls[index] = count
+
+    def write(index):
+        count = 0
+
+        while not stop.is_set():
+            patch.priority_hint = count % 2
+            handler.patch_all()
+            count += 1
+
+        repatches[index] = count
+
+    threads = [threading.Thread(target=read, args=(index, )) for index in range(reader_count)]
+    threads += [threading.Thread(target=write, args=(index, )) for index in range(writer_count)]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    handler.destroy()
+
+    return {
+        "readers": reader_count,
+        "writers": writer_count,
+        "ns_per_call": duration * reader_count / max(sum(calls), 1) * 1e9,
+        "repatches_per_second": sum(repatches) / duration,
+    }
+
+
+def benchmark_concurrent_churn(duration: float, writer_counts: List[int], reader_count: int = 2) -> List[dict]:
+    """
+    Measures the cost of repatching a function while other threads are calling it.
+
+    Each run reports the wall time per call seen by the readers, and how many patch_all() calls per second the writers complete
+    while contending for the patching lock. Readers never take the lock, so with the GIL any slowdown they see comes from sharing
+    the interpreter with the writers' compiles. A run with zero writers is the baseline.
+    """
+
+    return [_run_churn(duration, reader_count, writer_count) for writer_count in [0] + writer_counts]
+
+
+
+# Results
+
+def _get_environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "bytecode": getattr(bytecode, "__version__", None),
+        "commit": commit,
+    }
+
+
+def run_benchmarks(quick: bool = False) -> dict:
+    """
+    Runs every benchmark, and returns the results as a JSON compatible dictionary.
+
+    quick: Uses fewer iterations and smaller sizes. Useful for checking the benchmarks still work, but too noisy to compare.
+    """
+
+    number, repeat = (20000, 3) if quick else (200000, 7)
+    sizes = [1, 10, 50] if quick else [1, 10, 100, 500]
+    churn_duration = 0.25 if quick else 2.0
+
+    # The disk cache would make cold patching times depend on previous runs
+    pyharmony.set_disk_cache_dir(None)
+
+    return {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "quick": quick,
+        "settings": {"number": number, "repeat": repeat, "sizes": sizes, "churn_duration": churn_duration},
+        "environment": _get_environment(),
+        "call_overhead": benchmark_call_overhead(number, repeat),
+        "scaling": benchmark_scaling(sizes, repeat),
+        "concurrency": benchmark_concurrent_churn(churn_duration, [1, 4]),
+    }
+
+
+def compare_results(previous: dict, current: dict) -> List[str]:
+    """
+    Returns a line for each benchmark present in both results, with how much it has changed.
+    """
+
+    lines = []
+
+    previous_calls = {result["name"]: result for result in previous.get("call_overhead", [])}
+
+    for result in current["call_overhead"]:
+        old = previous_calls.get(result["name"])
+
+        if old is not None:
+            lines.append(f"call {result['name']}: {old['patched_ns']:.1f}ns -> {result['patched_ns']:.1f}ns ({result['patched_ns'] / old['patched_ns']:.2f}x)")
+
+    def scaling_key(result: dict) -> tuple:
+        return (result["operation"], result["targets"], result["patches_per_target"], result["handlers"])
+
+    previous_scaling = {scaling_key(result): result for result in previous.get("scaling", [])}
+
+    for result in current["scaling"]:
+        old = previous_scaling.get(scaling_key(result))
+
+        if old is not None and old["min_seconds"] > 0:
+            lines.append(f"{result['operation']} targets={result['targets']} patches={result['patches_per_target']} handlers={result['handlers']}: "
+                         f"{old['min_seconds'] * 1000:.3f}ms -> {result['min_seconds'] * 1000:.3f}ms ({result['min_seconds'] / old['min_seconds']:.2f}x)")
+
+    previous_concurrency = {(result["readers"], result["writers"]): result for result in previous.get("concurrency", [])}
+
+    for result in current.get("concurrency", []):
+        old = previous_concurrency.get((result["readers"], result["writers"]))
+
+        if old is not None:
+            lines.append(f"churn readers={result['readers']} writers={result['writers']}: {old['ns_per_call']:.1f}ns -> {result['ns_per_call']:.1f}ns per call, "
+                         f"{old['repatches_per_second']:.0f} -> {result['repatches_per_second']:.0f} repatches/s")
+
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks pyHarmony call overhead and patching time.")
+    parser.add_argument("--quick", action="store_true", help="use fewer iterations and smaller sizes")
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.quick)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+        for line in compare_results(previous, results):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,20 @@
 import unittest
+import asyncio
+import dis
+import functools
+import gc
+import inspect
+import math
+import os
 import sys
+import tempfile
+import threading
 import types
-from bytecode import Bytecode, Instr
-from pyharmony import Patch, PatchHandler, transpiler, prefix, postfix, opcodes
+import weakref
+from typing import Optional
+from bytecode import Bytecode, Instr, Label
+import pyharmony
+from pyharmony import CodeMatch, CodeMatcher, Guard, Patch, PatchHandler, Ref, transpiler, prefix, postfix, finalizer, opcodes
 
 
 def test_function(arg1, arg2):
@@ -10,7 +22,81 @@ def test_function(arg1, arg2):
     return arg1 + 10
 
 
+def test_function_locals(value):
+    if value > 0:
+        positive = True
+        return value * 2
+
+    doubled = value * 2
+    return doubled
+
+
+def parallel_target_1(value):
+    return value + 1
+
+
+def parallel_target_2(value):
+    return value + 2
+
+
+def parallel_postfix(__result: Ref) -> None:
+    __result.value *= 10
+
+
+def threaded_target(value):
+    return value
+
+
+def generator_target(count):
+    for index in range(count):
+        yield index
+
+    return count
+
+
+async def coroutine_target(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+async def async_generator_target(count):
+    for index in range(count):
+        await asyncio.sleep(0)
+        yield index
+
+
+def raising_target(value):
+    if value < 0:
+        raise ValueError(value)
+
+    return value
+
+
+class SpecializationTarget:
+    def method(self, value):
+        return value + 1
+
+
+trampoline_sqrt = math.sqrt
+
+
+class TrampolineTarget(dict):
+    scaled = functools.partial(pow, 2)
+
+    @classmethod
+    def create(cls, value):
+        return cls(value=value)
+
+    @property
+    def total(self):
+        return sum(self.values())
+
+
+inline_scale = 2
+
+
 thismodule = sys.modules[__name__]
+pyharmony_module = sys.modules["pyharmony.pyharmony"]
 
 
 class pyHarmonyTests(unittest.TestCase):
@@ -32,7 +118,8 @@ class pyHarmonyTests(unittest.TestCase):
 
     def test_transpiler(self):
         def my_transpiler(bytecode: Bytecode) -> Bytecode:
-            bytecode[4] = Instr(opcodes.LOAD_CONST, 20)
+            index = next(index for index, instr in enumerate(bytecode) if isinstance(instr, Instr) and instr.name == opcodes.LOAD_CONST and instr.arg == 10)
+            bytecode[index] = Instr(opcodes.LOAD_CONST, 20)
             return bytecode
 
         transpiler(thismodule, "test_function", handler=self.patch_handler)(my_transpiler)
@@ -252,5 +339,1554 @@ class pyHarmonyTests(unittest.TestCase):
         self.assertEqual(test_function(100, arg2), 1)
 
 
+
+
+    def test_injected_prefix(self):
+        def my_prefix(arg2) -> None:
+            arg2.prefix_run = True
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(100, arg2), 110)
+        self.assertTrue(arg2.run)
+        self.assertTrue(arg2.prefix_run)
+
+        # A read-only injected prefix shouldn't build any state
+        self.assertNotIn("BUILD_MAP", [i.opname for i in dis.get_instructions(test_function)])
+
+
+
+    def test_injected_prefix_ref(self):
+        def my_prefix(arg1: Ref[int]) -> None:
+            arg1.value += 1
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(100, arg2), 111)
+        self.assertTrue(arg2.run)
+
+
+
+    def test_injected_prefix_run_false(self):
+        def my_prefix(arg1, arg2) -> bool:
+            return arg1 < 50
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertIsNone(test_function(100, arg2))
+        self.assertFalse(arg2.run)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(10, arg2), 20)
+        self.assertTrue(arg2.run)
+
+
+
+    def test_injected_prefix_mixed(self):
+        def my_prefix_1(arg_obj: dict) -> None:
+            arg_obj["arg1"] += 1
+
+        def my_prefix_2(arg1: Ref) -> None:
+            arg1.value *= 2
+
+        # The regular prefix runs first, so the injected prefix sees its modification
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=1)(my_prefix_1)
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix_2)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(100, arg2), 212)
+
+
+
+    def test_injected_prefix_unknown_parameter(self):
+        def my_prefix(arg3) -> None:
+            pass
+
+        with self.assertRaises(ValueError):
+            prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+
+
+
+
+    def test_injected_postfix_result(self):
+        def my_postfix(__result: Ref[int]) -> None:
+            __result.value += 5
+
+        postfix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_postfix)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(100, arg2), 115)
+        self.assertTrue(arg2.run)
+
+        # A result-only postfix shouldn't build any state
+        self.assertNotIn("BUILD_MAP", [i.opname for i in dis.get_instructions(test_function)])
+
+
+
+    def test_injected_postfix_locals(self):
+        captured = []
+
+        def my_postfix(value, positive, doubled, __result) -> None:
+            captured.append((value, positive, doubled, __result))
+
+        postfix(thismodule, "test_function_locals", handler=self.patch_handler, inject=True)(my_postfix)
+
+        self.assertEqual(test_function_locals(5), 10)
+        self.assertEqual(test_function_locals(-5), -10)
+
+        # Locals that aren't assigned at a return site are passed as None
+        self.assertEqual(captured, [(5, True, None, 10), (-5, None, -10, -10)])
+
+
+
+    def test_postfix_unassigned_locals(self):
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] = sorted(k for k in arg_obj if k != "__result")
+
+        postfix(thismodule, "test_function_locals", handler=self.patch_handler)(my_postfix)
+
+        self.assertEqual(test_function_locals(5), ["positive", "value"])
+        self.assertEqual(test_function_locals(-5), ["doubled", "value"])
+
+
+
+
+    def test_prefix_chain(self):
+        calls = []
+
+        def my_prefix_1(arg_obj: dict) -> None:
+            calls.append(1)
+            arg_obj["shared"] = True
+
+        def my_prefix_2(arg1) -> None:
+            calls.append(2)
+
+        def my_prefix_3(arg_obj: dict) -> bool:
+            calls.append(3)
+            return not arg_obj["shared"]
+
+        def my_prefix_4(arg_obj: dict) -> None:
+            calls.append(4)
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=4)(my_prefix_1)
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=3, inject=True)(my_prefix_2)
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=2)(my_prefix_3)
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=1)(my_prefix_4)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        # Regular prefixes share their dictionary, and returning False stops any later prefixes from running
+        self.assertIsNone(test_function(100, arg2))
+        self.assertFalse(arg2.run)
+        self.assertEqual(calls, [1, 2, 3])
+
+        # Each hook is called directly from the patched function
+        for hook in (my_prefix_1, my_prefix_2, my_prefix_3, my_prefix_4):
+            self.assertIn(hook, test_function.__code__.co_consts)
+
+
+
+    def test_postfix_chain(self):
+        def my_postfix_1(arg_obj: dict) -> None:
+            arg_obj["__result"] += 1
+
+        def my_postfix_2(__result: Ref) -> None:
+            __result.value *= 2
+
+        def my_postfix_3(arg_obj: dict) -> None:
+            arg_obj["__result"] += arg_obj["arg1"]
+
+        postfix(thismodule, "test_function", handler=self.patch_handler, priority_hint=3)(my_postfix_1)
+        postfix(thismodule, "test_function", handler=self.patch_handler, priority_hint=2, inject=True)(my_postfix_2)
+        postfix(thismodule, "test_function", handler=self.patch_handler, priority_hint=1)(my_postfix_3)
+
+        arg2 = pyHarmonyTests.getArg2()
+
+        self.assertEqual(test_function(100, arg2), (110 + 1) * 2 + 100)
+
+
+
+
+    def test_code_cache(self):
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] = 1234
+
+        postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix)
+        patched_code = test_function.__code__
+
+        self.patch_handler.unpatch_all()
+        unpatched_code = test_function.__code__
+
+        hits = pyharmony.code_cache_info().hits
+
+        # Flipping back to a known configuration reuses the same code object
+        self.patch_handler.patches[0].enabled = True
+        self.patch_handler.patch_all()
+
+        self.assertIs(test_function.__code__, patched_code)
+        self.assertEqual(pyharmony.code_cache_info().hits, hits + 1)
+
+        self.patch_handler.unpatch_all()
+
+        # The original code doesn't need to come from the cache
+        self.assertIs(test_function.__code__, unpatched_code)
+        self.assertEqual(pyharmony.code_cache_info().hits, hits + 1)
+
+
+
+    def test_code_cache_eviction(self):
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] = 1234
+
+        try:
+            pyharmony.set_code_cache_size(0)
+            postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix)
+
+            self.assertEqual(pyharmony.code_cache_info().current_size, 0)
+        finally:
+            pyharmony.set_code_cache_size(256)
+
+
+
+
+    def test_patch_list_changes(self):
+        def my_postfix_1(arg_obj: dict) -> None:
+            arg_obj["__result"] = 1
+
+        def my_postfix_2(arg_obj: dict) -> None:
+            arg_obj["__result"] = 2
+
+        patch_1 = Patch(thismodule, "test_function", postfix_func=my_postfix_1, priority_hint=1)
+        patch_2 = Patch(thismodule, "test_function", postfix_func=my_postfix_2)
+
+        self.patch_handler.patches.extend([patch_1, patch_2])
+        self.patch_handler.patch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 2)
+
+        # Changing the priority is picked up on the next patch
+        patch_1.priority_hint = -1
+        self.patch_handler.patch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 1)
+
+        # As is removing patches from the list
+        self.patch_handler.patches.remove(patch_1)
+        self.patch_handler.patch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 2)
+
+        # Reassigning the list is the same as replacing its contents
+        self.patch_handler.patches = [patch_1]
+        self.patch_handler.patch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 1)
+
+
+
+    def test_patch_shared_handler(self):
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] = 1234
+
+        postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix)
+
+        # Handlers with the same instance name share their patches
+        other_handler = PatchHandler(self.patch_handler.instance_name)
+        self.assertIs(other_handler.patches, self.patch_handler.patches)
+
+        other_handler.unpatch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 110)
+
+
+
+
+    def test_batch(self):
+        def my_postfix_1(arg_obj: dict) -> None:
+            arg_obj["__result"] += 1
+
+        def my_postfix_2(arg_obj: dict) -> None:
+            arg_obj["__result"] += 2
+
+        def get_lookups() -> int:
+            info = pyharmony.code_cache_info()
+            return info.hits + info.misses
+
+        lookups = get_lookups()
+
+        with self.patch_handler.batch():
+            postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix_1)
+
+            with pyharmony.batch_patches():
+                postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix_2)
+
+            # Nothing is applied until the outermost batch exits
+            self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 110)
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 113)
+
+        # The target was only reevaluated once
+        self.assertEqual(get_lookups(), lookups + 1)
+
+
+
+
+    def test_disk_cache(self):
+        def my_postfix(__result: Ref) -> None:
+            __result.value += 1
+
+        def fail_compile(*args):
+            raise AssertionError("Expected the patched code to be loaded from the disk cache")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            try:
+                pyharmony.set_disk_cache_dir(cache_dir)
+
+                postfix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_postfix)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+                # Simulate a new process, which has nothing in memory
+                self.patch_handler.unpatch_all()
+                pyharmony.clear_code_cache()
+
+                original_compile = pyharmony_module._compile_function
+                pyharmony_module._compile_function = fail_compile
+
+                try:
+                    self.patch_handler.patches[0].enabled = True
+                    self.patch_handler.patch_all()
+                finally:
+                    pyharmony_module._compile_function = original_compile
+
+                # The hook is linked back into the cached code
+                self.assertIn(my_postfix, test_function.__code__.co_consts)
+                self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+            finally:
+                pyharmony.set_disk_cache_dir(None)
+
+
+
+    def test_disk_cache_stale(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            disk_cache = pyharmony.diskcache.DiskCache(cache_dir)
+            original_code = test_function.__code__
+
+            self.assertTrue(disk_cache.store(original_code, "test_function", ("identity", ), [], original_code))
+            self.assertIsNotNone(disk_cache.load(original_code, "test_function", ("identity", ), []))
+
+            # A different original function with the same name invalidates the file
+            other_code = original_code.replace(co_consts=tuple(c if c != 10 else 11 for c in original_code.co_consts))
+
+            self.assertIsNone(disk_cache.load(other_code, "test_function", ("identity", ), []))
+            self.assertEqual(os.listdir(cache_dir), [])
+
+
+
+
+    def test_disk_cache_transpiler_bindings(self):
+        def make_transpiler(value):
+            def my_transpiler(bytecode: Bytecode) -> Bytecode:
+                matcher = CodeMatcher.of(bytecode)
+                matcher.set_arg(matcher.find(Instr(opcodes.LOAD_CONST, 10)), 0, value)
+                return bytecode
+
+            return my_transpiler
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            try:
+                pyharmony.set_disk_cache_dir(cache_dir)
+
+                transpiler(thismodule, "test_function", handler=self.patch_handler)(make_transpiler(20))
+                self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 120)
+
+                # Simulate a new process, which has a transpiler with the same code but a different closure
+                self.patch_handler.unpatch_all()
+                self.patch_handler.patches.clear()
+                pyharmony.clear_code_cache()
+
+                transpiler(thismodule, "test_function", handler=self.patch_handler)(make_transpiler(30))
+                self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 130)
+            finally:
+                pyharmony.set_disk_cache_dir(None)
+
+        # Transpilers bound to values that can't be identified across processes aren't cached at all
+        self.assertIsNone(Patch(thismodule, "test_function", transpiler_func=make_transpiler([20]))._get_disk_identity())
+        self.assertIsNone(Patch(thismodule, "test_function", transpiler_func=make_transpiler(20), disk_cache=False)._get_disk_identity())
+        self.assertIsNotNone(Patch(thismodule, "test_function", transpiler_func=make_transpiler(20))._get_disk_identity())
+
+
+
+
+    def test_disk_cache_injected_parameters(self):
+        def my_prefix(arg1: Ref) -> None:
+            arg1.value += 1
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            try:
+                pyharmony.set_disk_cache_dir(cache_dir)
+
+                prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+                self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+                # Simulate a new process, where the same hook no longer writes back to the argument. Only its annotations differ
+                self.patch_handler.unpatch_all()
+                self.patch_handler.patches.clear()
+                pyharmony.clear_code_cache()
+                my_prefix.__annotations__ = {"return": None}
+
+                prefix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_prefix)
+
+                with self.assertRaises(AttributeError):
+                    test_function(100, pyHarmonyTests.getArg2())
+            finally:
+                pyharmony.set_disk_cache_dir(None)
+
+
+
+
+    def test_parallel_patch_all(self):
+        def my_nested_postfix(__result: Ref) -> None:
+            __result.value += 1
+
+        postfix(thismodule, "parallel_target_1", handler=self.patch_handler, inject=True, apply=False)(parallel_postfix)
+        postfix(thismodule, "parallel_target_2", handler=self.patch_handler, inject=True, apply=False)(parallel_postfix)
+
+        # Nested functions can't be sent to a worker process, so this target is compiled serially instead
+        postfix(thismodule, "test_function", handler=self.patch_handler, inject=True, apply=False)(my_nested_postfix)
+
+        pyharmony.clear_code_cache()
+        self.patch_handler.patch_all(workers=2)
+
+        self.assertEqual(parallel_target_1(1), 20)
+        self.assertEqual(parallel_target_2(1), 30)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+        # The compiled code references our own hook, not a copy from the worker
+        self.assertIn(parallel_postfix, parallel_target_1.__code__.co_consts)
+
+        # The worker processes are kept for the next call
+        pool = pyharmony.parallel._pool
+        self.assertIsNotNone(pool)
+        self.patch_handler.unpatch_all()
+
+        for patch in self.patch_handler.patches:
+            patch.enabled = True
+
+        pyharmony.clear_code_cache()
+        self.patch_handler.patch_all(workers=2)
+
+        self.assertEqual(parallel_target_1(1), 20)
+        self.assertIs(pyharmony.parallel._pool, pool)
+
+
+
+
+    def test_instrumentation_counts(self):
+        def my_prefix(arg1) -> bool:
+            return arg1 > 0
+
+        def my_postfix(arg_obj: dict) -> None:
+            pass
+
+        prefix_patch = prefix(thismodule, "test_function", handler=self.patch_handler, inject=True, apply=False)(my_prefix)
+        postfix(thismodule, "test_function", handler=self.patch_handler, apply=False)(my_postfix)
+
+        self.patch_handler.patch_all()
+        uninstrumented_code = test_function.__code__
+
+        # Creating a patch doesn't invalidate the patched target, only changing the settings of an existing patch does
+        target_key = (id(thismodule), "test_function")
+        version = pyharmony_module._patch_index.get_version(target_key)
+        Patch(thismodule, "test_function", prefix_func=my_prefix, instrumentation=pyharmony.INSTRUMENT_COUNTS, sample_every=2)
+        self.assertEqual(pyharmony_module._patch_index.get_version(target_key), version)
+
+        self.patch_handler.set_instrumentation(pyharmony.INSTRUMENT_COUNTS)
+        self.assertNotEqual(pyharmony_module._patch_index.get_version(target_key), version)
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 110)
+        self.assertIsNone(test_function(-1, pyHarmonyTests.getArg2()))
+
+        stats = self.patch_handler.stats()
+        prefix_stats = next(s for p, s in stats.items() if p.prefix_func is prefix_patch)
+        postfix_stats = next(s for p, s in stats.items() if p.postfix_func is my_postfix)
+
+        self.assertEqual((prefix_stats.calls, prefix_stats.skips, prefix_stats.timed_calls), (2, 1, 0))
+        self.assertEqual((postfix_stats.calls, postfix_stats.skips), (2, 0))
+
+        # Turning it off again generates exactly the same code as before
+        self.patch_handler.set_instrumentation(None)
+
+        self.assertEqual(test_function.__code__.co_code, uninstrumented_code.co_code)
+        self.assertEqual(test_function.__code__.co_consts, uninstrumented_code.co_consts)
+
+        test_function(100, pyHarmonyTests.getArg2())
+        self.assertEqual(prefix_stats.calls, 2)
+
+
+
+
+    def test_instrumentation_timing(self):
+        def my_postfix(__result: Ref) -> None:
+            __result.value += 1
+
+        postfix(thismodule, "test_function", handler=self.patch_handler, inject=True, apply=False)(my_postfix)
+        patch = self.patch_handler.patches[0]
+
+        self.patch_handler.set_instrumentation(pyharmony.INSTRUMENT_TIMING)
+
+        for _ in range(5):
+            self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+        self.assertEqual((patch.stats.calls, patch.stats.timed_calls), (5, 5))
+        self.assertGreater(patch.stats.time, 0)
+        self.assertIsNotNone(patch.stats.average_time)
+
+        patch.stats.reset()
+        self.patch_handler.set_instrumentation(pyharmony.INSTRUMENT_SAMPLED_TIMING, sample_interval=4)
+
+        for _ in range(10):
+            self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+        # Only the 4th and 8th calls are timed
+        self.assertEqual((patch.stats.calls, patch.stats.timed_calls), (10, 2))
+
+        with self.assertRaises(ValueError):
+            patch.set_instrumentation("everything")
+
+
+
+
+    def test_benchmarks_run(self):
+        from pyharmony.test import pyharmony_benchmarks
+
+        results = pyharmony_benchmarks.benchmark_call_overhead(number=10, repeat=1, cases=["prefix_1", "prefix_skip"])
+
+        self.assertEqual([result["name"] for result in results], ["prefix_1", "prefix_skip"])
+
+        handler_names = set(pyharmony.all_patch_handlers)
+        scaling = pyharmony_benchmarks.benchmark_scaling([1, 2], repeat=1)
+
+        self.assertEqual({result["operation"] for result in scaling}, {"patch_all_cold", "patch_all_warm", "unpatch_all", "destroy"})
+
+        # Every handler created by the benchmarks has been destroyed again
+        self.assertEqual(set(pyharmony.all_patch_handlers), handler_names)
+
+
+
+
+    def test_patches_changed_while_compiling(self):
+        def my_postfix(__result: Ref) -> None:
+            __result.value += 1
+
+        postfix_patch = Patch(thismodule, "test_function", inject=True, enabled=False, postfix_func=my_postfix)
+
+        def my_transpiler(bytecode: Bytecode) -> Bytecode:
+            # Simulates another thread enabling a patch while this target is being compiled
+            postfix_patch.enabled = True
+            return bytecode
+
+        self.patch_handler.patches.append(postfix_patch)
+        transpiler(thismodule, "test_function", handler=self.patch_handler)(my_transpiler)
+
+        # The code compiled without the postfix is thrown away, and compiled again with it
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+
+
+
+    def test_threaded_patching(self):
+        handlers = [PatchHandler(f"unit_test_thread_{index}") for index in range(4)]
+        errors = []
+        stop_reading = threading.Event()
+
+        def make_postfix(amount):
+            def my_postfix(__result: Ref) -> None:
+                __result.value += amount
+
+            return my_postfix
+
+        for index, handler in enumerate(handlers):
+            postfix(thismodule, "threaded_target", handler=handler, inject=True, apply=False)(make_postfix(10 ** index))
+
+        def write(handler):
+            try:
+                for iteration in range(20):
+                    handler.patches[0].enabled = iteration % 2 == 1
+                    handler.patch_all()
+            except Exception as e:    # pylint: disable=broad-except
+                errors.append(e)
+
+        def read():
+            try:
+                while not stop_reading.is_set():
+                    threaded_target(0)
+            except Exception as e:    # pylint: disable=broad-except
+                errors.append(e)
+
+        reader = threading.Thread(target=read)
+        writers = [threading.Thread(target=write, args=(handler, )) for handler in handlers]
+
+        reader.start()
+
+        for writer in writers:
+            writer.start()
+
+        for writer in writers:
+            writer.join()
+
+        stop_reading.set()
+        reader.join()
+
+        try:
+            self.assertEqual(errors, [])
+
+            # Every handler finished with its patch enabled, so whichever patch_all() finished last must have installed all of them
+            self.assertEqual(threaded_target(0), 1111)
+        finally:
+            for handler in handlers:
+                handler.destroy()
+
+
+
+
+
+    def test_generator(self):
+        calls = []
+
+        def my_prefix(count) -> None:
+            calls.append(("prefix", count))
+
+        def my_postfix(__result: Ref) -> None:
+            calls.append(("postfix", __result.value))
+            __result.value += 100
+
+        prefix(thismodule, "generator_target", handler=self.patch_handler, inject=True)(my_prefix)
+        postfix(thismodule, "generator_target", handler=self.patch_handler, inject=True)(my_postfix)
+
+        generator = generator_target(3)
+
+        # The prefix runs as soon as the generator is created, and the postfix only once it has finished
+        self.assertEqual(calls, [("prefix", 3)])
+        self.assertEqual([next(generator) for _ in range(3)], [0, 1, 2])
+        self.assertEqual(calls, [("prefix", 3)])
+
+        with self.assertRaises(StopIteration) as context:
+            next(generator)
+
+        self.assertEqual(context.exception.value, 103)
+        self.assertEqual(calls, [("prefix", 3), ("postfix", 3)])
+
+
+
+
+    def test_coroutine(self):
+        calls = []
+
+        def my_prefix(arg_obj: dict) -> bool:
+            calls.append("prefix")
+            return arg_obj["value"] > 0
+
+        def my_postfix(__result) -> None:
+            calls.append(("postfix", __result))
+
+        prefix(thismodule, "coroutine_target", handler=self.patch_handler)(my_prefix)
+        postfix(thismodule, "coroutine_target", handler=self.patch_handler, inject=True)(my_postfix)
+
+        coroutine = coroutine_target(5)
+        self.assertEqual(calls, ["prefix"])
+        self.assertEqual(asyncio.run(coroutine), 10)
+
+        # Skipping still returns something that can be awaited, and postfixes still run
+        self.assertIsNone(asyncio.run(coroutine_target(-5)))
+        self.assertEqual(calls, ["prefix", ("postfix", 10), "prefix", ("postfix", None)])
+
+        self.assertTrue(asyncio.iscoroutinefunction(coroutine_target))
+
+
+
+
+    def test_async_hooks(self):
+        calls = []
+
+        async def my_prefix(value) -> bool:
+            await asyncio.sleep(0)
+            calls.append(("prefix", value))
+            return value > 0
+
+        async def my_postfix(__result: Ref) -> None:
+            await asyncio.sleep(0)
+            __result.value = (__result.value, "postfix")
+
+        prefix(thismodule, "coroutine_target", handler=self.patch_handler, inject=True)(my_prefix)
+        postfix(thismodule, "coroutine_target", handler=self.patch_handler, inject=True)(my_postfix)
+
+        # Async prefixes can only run once the coroutine starts
+        coroutine = coroutine_target(5)
+        self.assertEqual(calls, [])
+        self.assertEqual(asyncio.run(coroutine), (10, "postfix"))
+        self.assertEqual(asyncio.run(coroutine_target(-5)), (None, "postfix"))
+
+        # Async hooks can't be awaited by a regular function
+        with self.assertRaises(ValueError):
+            postfix(thismodule, "test_function", handler=self.patch_handler, inject=True)(my_postfix)
+
+
+
+
+    def test_async_generator(self):
+        calls = []
+
+        def my_prefix(count) -> bool:
+            calls.append("prefix")
+            return count < 10
+
+        async def my_postfix(count) -> None:
+            calls.append(("postfix", count))
+
+        prefix(thismodule, "async_generator_target", handler=self.patch_handler, inject=True)(my_prefix)
+        postfix(thismodule, "async_generator_target", handler=self.patch_handler, inject=True)(my_postfix)
+
+        async def collect(count):
+            return [index async for index in async_generator_target(count)]
+
+        self.assertEqual(asyncio.run(collect(3)), [0, 1, 2])
+        self.assertEqual(asyncio.run(collect(20)), [])
+        self.assertEqual(calls, ["prefix", ("postfix", 3), "prefix", ("postfix", 20)])
+
+
+
+
+
+    def test_finalizer(self):
+        calls = []
+
+        def my_finalizer(value, __exception, __result: Ref) -> Optional[object]:
+            calls.append((value, type(__exception).__name__, __result.value))
+
+            if value == -1:
+                __result.value = "swallowed"
+                return True
+
+            if value == -2:
+                return KeyError(value)
+
+            return None
+
+        finalizer(thismodule, "raising_target", handler=self.patch_handler, inject=True)(my_finalizer)
+
+        self.assertEqual(raising_target(5), 5)
+        self.assertEqual(raising_target(-1), "swallowed")
+
+        with self.assertRaises(KeyError) as context:
+            raising_target(-2)
+
+        # The replacement is raised while handling the original, so it keeps it as context
+        self.assertIsInstance(context.exception.__context__, ValueError)
+
+        with self.assertRaises(ValueError):
+            raising_target(-3)
+
+        self.assertEqual(calls, [(5, "NoneType", 5), (-1, "ValueError", None), (-2, "ValueError", None), (-3, "ValueError", None)])
+
+
+
+
+    def test_finalizer_return_values(self):
+        def my_finalizer(value, __exception) -> object:
+            # Only True and exception instances change anything
+            return {1: 0, 2: False, 3: "", 4: KeyError(value)}.get(abs(value))
+
+        finalizer(thismodule, "raising_target", handler=self.patch_handler, inject=True)(my_finalizer)
+
+        for value in (1, 2, 3, 4):
+            # Without an exception, the return value is ignored
+            self.assertEqual(raising_target(value), value)
+
+        for value in (-1, -2, -3):
+            with self.assertRaises(ValueError):
+                raising_target(value)
+
+        with self.assertRaises(KeyError):
+            raising_target(-4)
+
+
+
+
+    def test_finalizer_wraps_hooks(self):
+        def my_postfix(arg_obj: dict) -> None:
+            if arg_obj["__result"] == 0:
+                raise ZeroDivisionError()
+
+        def my_finalizer(arg_obj: dict) -> bool:
+            if isinstance(arg_obj["__exception"], ZeroDivisionError):
+                arg_obj["__result"] = "postfix raised"
+                return True
+
+            if arg_obj["__exception"] is None:
+                arg_obj["__result"] += 1
+
+            return None
+
+        postfix(thismodule, "raising_target", handler=self.patch_handler)(my_postfix)
+        finalizer(thismodule, "raising_target", handler=self.patch_handler)(my_finalizer)
+
+        self.assertEqual(raising_target(5), 6)
+        self.assertEqual(raising_target(0), "postfix raised")
+
+        with self.assertRaises(ValueError):
+            raising_target(-1)
+
+        # Without an exception, the only extra instructions on the way through the original code are entering and leaving the try block.
+        # Python 3.11+ doesn't even have those, as try blocks only exist in the exception table
+        if sys.version_info >= (3, 11):
+            self.assertNotEqual(raising_target.__code__.co_exceptiontable, b"")
+        else:
+            self.assertIn(opcodes.SETUP_FINALLY, [instr.opname for instr in dis.get_instructions(raising_target)])
+
+
+
+
+    def test_finalizer_generator(self):
+        calls = []
+
+        def my_finalizer(count, __exception) -> bool:
+            calls.append((count, type(__exception).__name__))
+            return True
+
+        finalizer(thismodule, "generator_target", handler=self.patch_handler, inject=True)(my_finalizer)
+
+        generator = generator_target(5)
+        self.assertEqual(next(generator), 0)
+
+        with self.assertRaises(StopIteration):
+            generator.throw(RuntimeError())
+
+        self.assertEqual(list(generator_target(2)), [0, 1])
+        self.assertEqual(calls, [(5, "RuntimeError"), (2, "NoneType")])
+
+
+
+
+    @unittest.skipIf(sys.version_info < (3, 11), "the specializing adaptive interpreter was added in Python 3.11")
+    def test_patched_code_specializes(self):
+        def my_prefix(value) -> None:
+            pass
+
+        def my_postfix(value, __result: Ref) -> None:
+            __result.value += value
+
+        prefix(SpecializationTarget, "method", handler=self.patch_handler, inject=True)(my_prefix)
+        postfix(SpecializationTarget, "method", handler=self.patch_handler, inject=True)(my_postfix)
+        self.patch_handler.set_instrumentation(pyharmony.INSTRUMENT_COUNTS)
+
+        target = SpecializationTarget()
+
+        for value in range(1000):
+            self.assertEqual(target.method(value), value * 2 + 1)
+
+        # Calls into the hooks and reads of their stats quicken just like they would in hand-written code
+        opnames = [instr.opname for instr in dis.get_instructions(SpecializationTarget.method, adaptive=True)]
+
+        self.assertIn("CALL_PY_EXACT_ARGS", opnames)
+        self.assertNotIn("LOAD_ATTR", opnames)
+        self.assertNotIn("STORE_ATTR", opnames)
+        self.assertNotIn("BINARY_OP", opnames)
+
+
+
+
+    def test_patched_code_metadata(self):
+        def my_prefix(value) -> None:
+            pass
+
+        original_code = SpecializationTarget.method.__code__
+        original_lines = [line for _, _, line in original_code.co_lines()] if sys.version_info >= (3, 10) else None
+
+        prefix(SpecializationTarget, "method", handler=self.patch_handler, inject=True)(my_prefix)
+        patched_code = SpecializationTarget.method.__code__
+
+        self.assertIsNot(patched_code, original_code)
+        self.assertEqual(patched_code.co_firstlineno, original_code.co_firstlineno)
+
+        if sys.version_info >= (3, 11):
+            self.assertEqual(patched_code.co_qualname, "SpecializationTarget.method")
+
+        if original_lines is not None:
+            # Every line of the original code is still in the line table
+            self.assertTrue(set(original_lines) <= {line for _, _, line in patched_code.co_lines()})
+
+
+
+
+    def test_guards_prefix(self):
+        calls = []
+
+        def my_prefix_1(arg_obj: dict) -> None:
+            calls.append(arg_obj["arg1"])
+            arg_obj["arg1"] += 1
+
+        def my_prefix_2(arg1: Ref) -> bool:
+            arg1.value *= 2
+            return arg1.value < 1000
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=1, guards=[Guard.is_instance("arg1", int), ~Guard.equals("arg1", 5)])(my_prefix_1)
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True, guards=[Guard.has_flag("arg2", "doubled")])(my_prefix_2)
+
+        arg2 = pyHarmonyTests.getArg2()
+        arg2.doubled = False
+
+        self.assertEqual(test_function(100, arg2), 111)
+        self.assertEqual(test_function(5, arg2), 15)
+        self.assertEqual(test_function(2.5, arg2), 12.5)
+        self.assertEqual(calls, [100])
+
+        # The second prefix sees the argument modified by the first one, and can still skip the original function
+        arg2.doubled = True
+
+        self.assertEqual(test_function(100, arg2), 212)
+        self.assertEqual(test_function(5, arg2), 20)
+        self.assertIsNone(test_function(600, arg2))
+        self.assertEqual(calls, [100, 100, 600])
+
+
+
+
+    def test_guards_postfix_finalizer(self):
+        calls = []
+
+        def my_postfix(arg_obj: dict) -> None:
+            calls.append(("postfix", arg_obj["__result"]))
+            arg_obj["__result"] += 1
+
+        def my_finalizer(__exception) -> bool:
+            calls.append(("finalizer", type(__exception).__name__))
+            return True
+
+        postfix(thismodule, "raising_target", handler=self.patch_handler, guards=[Guard.equals("__result", 5)])(my_postfix)
+        finalizer(thismodule, "raising_target", handler=self.patch_handler, inject=True, guards=[~Guard.is_none("__exception"), Guard.is_instance("value", int)])(my_finalizer)
+
+        self.assertEqual(raising_target(5), 6)
+        self.assertEqual(raising_target(4), 4)
+        self.assertIsNone(raising_target(-1))
+
+        with self.assertRaises(ValueError):
+            raising_target(-1.5)
+
+        self.assertEqual(calls, [("postfix", 5), ("finalizer", "ValueError")])
+
+
+
+
+    def test_guards_invalid(self):
+        def my_prefix(arg_obj: dict) -> None:
+            pass
+
+        with self.assertRaises(ValueError):
+            prefix(thismodule, "test_function", handler=self.patch_handler, guards=[Guard.is_none("__result")])(my_prefix)
+
+        self.patch_handler.patches.clear()
+
+        with self.assertRaises(ValueError):
+            prefix(thismodule, "test_function", handler=self.patch_handler, guards=[Guard.equals("arg1", [])])(my_prefix)
+
+        with self.assertRaises(ValueError):
+            Patch(thismodule, "test_function", transpiler_func=lambda bytecode: bytecode, guards=[Guard.is_none("arg1")])
+
+        self.assertEqual(repr(~Guard.is_instance("arg1", int)), "~Guard.is_instance('arg1', <class 'int'>)")
+
+
+
+
+    def test_sampled_hooks(self):
+        calls = []
+
+        def my_prefix(arg_obj: dict) -> None:
+            calls.append(("prefix", arg_obj["arg1"]))
+            arg_obj["arg1"] += 1
+
+        def my_postfix(__result: Ref) -> None:
+            calls.append(("postfix", __result.value))
+            __result.value *= 10
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, guards=[~Guard.equals("arg1", 0)], sample_every=2)(my_prefix)
+        postfix(thismodule, "test_function", handler=self.patch_handler, inject=True, sample_every=3)(my_postfix)
+
+        results = [test_function(value, pyHarmonyTests.getArg2()) for value in (1, 0, 2, 3, 0, 4)]
+
+        # Calls rejected by a guard don't count towards sampling
+        self.assertEqual(results, [11, 10, 130, 13, 10, 150])
+        self.assertEqual(calls, [("prefix", 2), ("postfix", 13), ("prefix", 4), ("postfix", 15)])
+
+        with self.assertRaises(ValueError):
+            self.patch_handler.patches[0].set_sampling(sample_every=0)
+
+
+
+
+    def test_rate_limited_hooks(self):
+        calls = []
+
+        def my_postfix(arg1) -> None:
+            calls.append(arg1)
+
+        postfix(thismodule, "test_function", handler=self.patch_handler, inject=True, rate_limit=2)(my_postfix)
+        patch = self.patch_handler.patches[0]
+
+        for value in range(5):
+            self.assertEqual(test_function(value, pyHarmonyTests.getArg2()), value + 10)
+
+        self.assertEqual(calls, [0, 1])
+
+        # Pretend the current window is over
+        patch._sample_state.window_end = 0.0
+
+        for value in range(5, 10):
+            test_function(value, pyHarmonyTests.getArg2())
+
+        self.assertEqual(calls, [0, 1, 5, 6])
+
+        # Turning it off again calls the postfix every time
+        patch.set_sampling()
+        self.patch_handler.patch_all()
+
+        test_function(10, pyHarmonyTests.getArg2())
+        self.assertEqual(calls, [0, 1, 5, 6, 10])
+
+
+
+
+    def test_dead_targets_released(self):
+        def create_class():
+            class Dynamic:
+                def method(self, value):
+                    # The __class__ cell of super() makes the method reference the class
+                    return super().__hash__() and value
+
+            return Dynamic
+
+        def my_postfix(__result: Ref) -> None:
+            __result.value += 1
+
+        gc.collect()
+        before = pyharmony.state_info()
+
+        dynamic_class = create_class()
+        postfix(dynamic_class, "method", handler=self.patch_handler, inject=True)(my_postfix)
+
+        self.assertEqual(dynamic_class().method(1), 2)
+
+        info = pyharmony.state_info()
+        self.assertEqual((info.targets, info.original_functions, info.patches), (before.targets + 1, before.original_functions + 1, before.patches + 1))
+        self.assertGreater(info.retained_bytes, before.retained_bytes)
+
+        class_reference = weakref.ref(dynamic_class)
+        del dynamic_class
+        gc.collect()
+
+        # Nothing keeps the class alive, and everything belonging to it is cleaned up
+        self.assertIsNone(class_reference())
+        self.assertEqual(len(self.patch_handler.patches), 0)
+
+        info = pyharmony.state_info()
+        self.assertEqual((info.targets, info.original_functions, info.patches), (before.targets, before.original_functions, before.patches))
+
+
+
+
+    def test_handlers_released(self):
+        def my_prefix(arg_obj: dict) -> None:
+            arg_obj["arg1"] += 1
+
+        handler = PatchHandler("weak_handler")
+        del handler
+        gc.collect()
+
+        self.assertNotIn("weak_handler", pyharmony.all_patch_handlers)
+
+        # A handler that still has patches keeps them, for the next handler of the same name
+        handler = PatchHandler("weak_handler")
+        prefix(thismodule, "test_function", handler=handler)(my_prefix)
+        del handler
+        gc.collect()
+
+        self.assertNotIn("weak_handler", pyharmony.all_patch_handlers)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+
+        handler = PatchHandler("weak_handler")
+        self.assertEqual(len(handler.patches), 1)
+
+        handler_count = pyharmony.state_info().handlers
+        handler.destroy()
+
+        self.assertEqual(pyharmony.state_info().handlers, handler_count - 1)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 110)
+
+
+
+
+    def test_incremental_repatching(self):
+        def my_prefix(arg_obj: dict) -> None:
+            pass
+
+        def my_postfix(arg_obj: dict) -> None:
+            pass
+
+        original_code = test_function.__code__
+        original_raising_code = raising_target.__code__
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, apply=False)(my_prefix)
+        postfix(thismodule, "raising_target", handler=self.patch_handler, apply=False)(my_postfix)
+        self.patch_handler.patch_all()
+
+        patched_raising_code = raising_target.__code__
+        cache_info = pyharmony.code_cache_info()
+
+        # Nothing changed, so nothing is looked up or rebuilt
+        self.patch_handler.patch_all()
+        self.assertEqual(pyharmony.code_cache_info(), cache_info)
+
+        # Only the target that lost its patches is touched, and it gets back the exact original code object
+        self.patch_handler.patches[0].enabled = False
+        self.patch_handler.patch_all()
+
+        self.assertIs(test_function.__code__, original_code)
+        self.assertIs(raising_target.__code__, patched_raising_code)
+        self.assertEqual(pyharmony.code_cache_info(), cache_info)
+
+        self.patch_handler.destroy()
+
+        self.assertIs(raising_target.__code__, original_raising_code)
+
+
+
+
+    def test_deferred_target(self):
+        module_directory = tempfile.mkdtemp()
+
+        with open(os.path.join(module_directory, "pyharmony_deferred_target.py"), "w") as file:
+            file.write("class Target:\n    def method(self, value):\n        return value + 1\n")
+
+        def my_postfix(__result: Ref) -> None:
+            __result.value *= 10
+
+        sys.path.insert(0, module_directory)
+
+        try:
+            deferred_count = pyharmony.state_info().deferred_patches
+            postfix("pyharmony_deferred_target:Target.method", handler=self.patch_handler, inject=True)(my_postfix)
+            postfix("pyharmony_deferred_target:MissingTarget.method", handler=self.patch_handler, inject=True)(my_postfix)
+
+            # Registering the patches doesn't import the module
+            self.assertNotIn("pyharmony_deferred_target", sys.modules)
+            self.assertEqual(pyharmony.state_info().deferred_patches, deferred_count + 2)
+
+            # Until then, it's identified by the path of its target instead of an object
+            self.assertEqual(self.patch_handler.patches[0]._target_key, ("pyharmony_deferred_target.Target", "method"))
+
+            # A target that the module doesn't define is reported, and its patch is dropped
+            with self.assertWarnsRegex(RuntimeWarning, "pyharmony_deferred_target:MissingTarget.method"):
+                import pyharmony_deferred_target    # pylint: disable=import-error,import-outside-toplevel
+
+            self.assertEqual(len(self.patch_handler.patches), 1)
+            self.assertEqual(pyharmony_deferred_target.Target().method(1), 20)
+            self.assertEqual(pyharmony.state_info().deferred_patches, deferred_count)
+            self.assertIs(self.patch_handler.patches[0].target.target_object, pyharmony_deferred_target.Target)
+            self.assertIs(pyharmony_deferred_target.__loader__, pyharmony_deferred_target.__spec__.loader)
+            self.assertEqual(type(pyharmony_deferred_target.__loader__).__name__, "SourceFileLoader")
+
+            self.patch_handler.unpatch_all()
+            self.assertEqual(pyharmony_deferred_target.Target().method(1), 2)
+        finally:
+            sys.path.remove(module_directory)
+            sys.modules.pop("pyharmony_deferred_target", None)
+
+
+
+
+    def test_string_target(self):
+        def my_prefix(arg_obj: dict) -> None:
+            arg_obj["arg1"] += 1
+
+        # Modules that are already imported are patched right away
+        prefix(f"{__name__}:test_function", handler=self.patch_handler)(my_prefix)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+        self.assertEqual(self.patch_handler.patches[0].target, (thismodule, "test_function"))
+
+        with self.assertRaises(ValueError):
+            Patch(f"{__name__}:MissingClass.method", prefix_func=my_prefix)
+
+        with self.assertRaises(ValueError):
+            Patch("no_function_name", prefix_func=my_prefix)
+
+
+
+
+    def test_code_matcher(self):
+        matchers = []
+
+        def first_transpiler(bytecode: Bytecode) -> Bytecode:
+            matcher = CodeMatcher.of(bytecode)
+            match = matcher.find(CodeMatch(opcodes.LOAD_FAST, "arg1"), Instr(opcodes.LOAD_CONST, 10))
+            matcher.set_arg(match, 1, 20)
+            matchers.append(matcher)
+            return bytecode
+
+        def second_transpiler(bytecode: Bytecode) -> Bytecode:
+            matcher = CodeMatcher.of(bytecode)
+            self.assertIsNone(matcher.find(Instr(opcodes.LOAD_CONST, 10)))
+            match = matcher.find(Instr(opcodes.LOAD_CONST, 20))
+            matcher.insert_after(match, [Instr(opcodes.LOAD_CONST, 3), Instr(opcodes.BINARY_MULTIPLY) if sys.version_info < (3, 11) else Instr(opcodes.BINARY_OP, 5)])
+            matchers.append(matcher)
+            return bytecode
+
+        self.patch_handler.patches.extend([Patch(thismodule, "test_function", transpiler_func=first_transpiler, priority_hint=1),
+                                           Patch(thismodule, "test_function", transpiler_func=second_transpiler)])
+        self.patch_handler.patch_all()
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 160)
+
+        # The second transpiler reuses the index built by the first
+        self.assertIs(matchers[0], matchers[1])
+
+
+
+
+    def test_code_matcher_edits(self):
+        loop_start = Label()
+        loop_end = Label()
+        bytecode = Bytecode([Instr(opcodes.LOAD_CONST, 1), loop_start, Instr(opcodes.LOAD_CONST, 2), Instr(opcodes.POP_TOP), loop_end,
+                             Instr(opcodes.LOAD_CONST, 1), Instr(opcodes.POP_TOP), Instr(opcodes.LOAD_CONST, 1.0), Instr(opcodes.RETURN_VALUE)])
+        matcher = CodeMatcher(bytecode)
+
+        # Labels in between instructions don't stop a match, and arguments are compared by type as well as value
+        self.assertEqual(matcher.count(Instr(opcodes.LOAD_CONST, 1)), 2)
+        self.assertEqual(matcher.find(Instr(opcodes.POP_TOP), Instr(opcodes.LOAD_CONST, 1)).positions, [3, 5])
+
+        # Code inserted before a match runs when jumping to it, unless it goes before the labels
+        match = matcher.find(Instr(opcodes.LOAD_CONST, 2))
+        matcher.insert_before(match, [Instr(opcodes.NOP)])
+        self.assertIs(bytecode[1], loop_start)
+        self.assertEqual(bytecode[2].name, opcodes.NOP)
+        matcher.insert_before(matcher.find(Instr(opcodes.LOAD_CONST, 1), start=3), [Instr(opcodes.NOP)], before_labels=True)
+        self.assertIs(bytecode[6], loop_end)
+
+        # Edits made while iterating are skipped over, and labels are kept
+        for match in matcher.find_all(opcodes.POP_TOP):
+            matcher.replace(match, [Instr(opcodes.POP_TOP), Instr(opcodes.NOP)])
+
+        self.assertEqual(matcher.count(opcodes.NOP), 4)
+        matcher.remove(matcher.find(opcodes.LOAD_CONST, opcodes.POP_TOP, opcodes.NOP))
+        self.assertIn(loop_end, bytecode)
+
+        # The index matches a freshly built one after all of the edits
+        fresh = CodeMatcher(bytecode)
+        self.assertEqual((matcher._by_name, matcher._by_arg), (fresh._by_name, fresh._by_arg))
+        self.assertIs(CodeMatcher.of(bytecode), CodeMatcher.of(bytecode))
+
+        bytecode.append(Instr(opcodes.NOP))
+        self.assertEqual(CodeMatcher.of(bytecode).count(opcodes.NOP), 4)
+
+        # Instructions changed in place aren't missed either
+        matcher = CodeMatcher.of(bytecode)
+        instr = next(instr for instr in bytecode if isinstance(instr, Instr) and instr.name == opcodes.LOAD_CONST)
+        instr.arg = 3
+        self.assertIsNot(CodeMatcher.of(bytecode), matcher)
+        self.assertEqual(CodeMatcher.of(bytecode).count(Instr(opcodes.LOAD_CONST, 3)), 1)
+        instr.set(opcodes.NOP)
+        self.assertEqual(CodeMatcher.of(bytecode).count(opcodes.NOP), 5)
+
+
+
+
+    def test_staged_compile(self):
+        transpiler_calls = []
+
+        def my_transpiler(bytecode: Bytecode) -> Bytecode:
+            transpiler_calls.append(bytecode)
+
+            # Instructions are modified in place, which mustn't leak into the cached output of earlier stages
+            instr = next(instr for instr in bytecode if isinstance(instr, Instr) and instr.name == opcodes.LOAD_CONST and instr.arg == 10)
+            instr.arg = 20
+            return bytecode
+
+        def my_prefix(arg_obj: dict) -> None:
+            arg_obj["arg1"] += 1
+
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] *= 2
+
+        transpiler(thismodule, "test_function", handler=self.patch_handler)(my_transpiler)
+        prefix(thismodule, "test_function", handler=self.patch_handler)(my_prefix)
+        postfix(thismodule, "test_function", handler=self.patch_handler)(my_postfix)
+
+        # Adding hooks reuses the output of the transpiler
+        self.assertEqual(len(transpiler_calls), 1)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 242)
+
+        self.patch_handler.patches[1].enabled = False
+        self.patch_handler.patch_all()
+        self.assertEqual(len(transpiler_calls), 1)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 240)
+
+        # Clearing the code cache runs the transpiler again, on the same decoded original code
+        pyharmony.clear_code_cache()
+        self.patch_handler.patch_all()
+        self.assertEqual(len(transpiler_calls), 2)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 240)
+
+
+
+
+    def test_inlined_hooks(self):
+        def my_prefix(arg1: Ref) -> None:
+            if arg1.value > 50:
+                arg1.value = 50
+
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] *= 2
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True, inline=True)(my_prefix)
+        postfix(thismodule, "test_function", handler=self.patch_handler, inline=True)(my_postfix)
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 120)
+        self.assertEqual(test_function(1, pyHarmonyTests.getArg2()), 22)
+
+        # Neither hook is called
+        self.assertNotIn(my_prefix, test_function.__code__.co_consts)
+        self.assertNotIn(my_postfix, test_function.__code__.co_consts)
+
+
+
+
+    def test_inlined_hooks_fallback(self):
+        calls = []
+
+        def my_prefix(arg1: Ref) -> None:
+            # Closures can't be inlined
+            calls.append(arg1.value)
+            arg1.value += 1
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, inject=True, inline=True)(my_prefix)
+
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 111)
+        self.assertEqual(calls, [100])
+        self.assertIn(my_prefix, test_function.__code__.co_consts)
+
+        with self.assertRaises(ValueError):
+            Patch(thismodule, "test_function", finalizer_func=lambda: None, inline=True)
+
+
+
+
+    def test_inlined_hook_globals(self):
+        def my_postfix(arg_obj: dict) -> None:
+            arg_obj["__result"] = abs(arg_obj["__result"]) * inline_scale
+
+        postfix(thismodule, "test_function", handler=self.patch_handler, inline=True)(my_postfix)
+
+        # Hooks using globals or builtins are called instead, so they see their current values
+        self.assertIn(my_postfix, test_function.__code__.co_consts)
+        self.assertEqual(test_function(-100, pyHarmonyTests.getArg2()), 180)
+
+        try:
+            thismodule.inline_scale = 3
+            thismodule.abs = lambda value: value
+            self.assertEqual(test_function(-100, pyHarmonyTests.getArg2()), -270)
+
+            del thismodule.abs
+            del thismodule.inline_scale
+
+            with self.assertRaisesRegex(NameError, "inline_scale"):
+                test_function(-100, pyHarmonyTests.getArg2())
+        finally:
+            thismodule.inline_scale = 2
+            vars(thismodule).pop("abs", None)
+
+
+
+
+    def test_reverse_patch(self):
+        def my_prefix(arg_obj: dict) -> None:
+            arg_obj["original"] = original(arg_obj["arg1"], pyHarmonyTests.getArg2())
+            return False
+
+        original = pyharmony.reverse_patch(thismodule, "test_function")
+        prefix(thismodule, "test_function", handler=self.patch_handler)(my_prefix)
+
+        # The reverse patch runs the original code, even though the target itself is skipped
+        self.assertIsNone(test_function(100, pyHarmonyTests.getArg2()))
+        self.assertEqual(original(100, pyHarmonyTests.getArg2()), 110)
+        self.assertIsNot(original.__code__, test_function.__code__)
+        self.assertEqual(original.__qualname__, "test_function")
+
+        # It's cached until the original function changes
+        self.assertIs(pyharmony.reverse_patch(f"{__name__}:test_function"), original)
+        self.patch_handler.unpatch_all()
+        self.assertIs(pyharmony.reverse_patch(thismodule, "test_function"), original)
+
+
+
+
+    def test_reverse_patch_transpiler(self):
+        transpiler_calls = []
+
+        def my_transpiler(bytecode: Bytecode) -> Bytecode:
+            transpiler_calls.append(bytecode)
+            matcher = CodeMatcher.of(bytecode)
+            matcher.set_arg(matcher.find(Instr(opcodes.LOAD_CONST, 10)), 0, 20)
+            return bytecode
+
+        reversed_function = pyharmony.reverse_patch(thismodule, "test_function", transpiler_func=my_transpiler)
+
+        # Only the reverse patch is transpiled
+        self.assertEqual(reversed_function(100, pyHarmonyTests.getArg2()), 120)
+        self.assertEqual(test_function(100, pyHarmonyTests.getArg2()), 110)
+
+        # Recreating it doesn't run the transpiler again
+        del reversed_function
+        gc.collect()
+
+        self.assertEqual(pyharmony.reverse_patch(thismodule, "test_function", transpiler_func=my_transpiler)(1, pyHarmonyTests.getArg2()), 21)
+        self.assertEqual(len(transpiler_calls), 1)
+
+        with self.assertRaises(ValueError):
+            pyharmony.reverse_patch(thismodule, "MissingFunction")
+
+
+
+
+    def test_trampolines(self):
+        prefix_args = []
+
+        def my_prefix(x) -> None:
+            prefix_args.append(x)
+
+        def my_postfix(__result: Ref) -> None:
+            __result.value = __result.value * 10
+
+        prefix(thismodule, "trampoline_sqrt", handler=self.patch_handler, inject=True)(my_prefix)
+        postfix(thismodule, "trampoline_sqrt", handler=self.patch_handler, inject=True)(my_postfix)
+
+        # The trampoline has the same parameters as the builtin, so they can be injected by name
+        self.assertIsInstance(trampoline_sqrt, types.FunctionType)
+        self.assertEqual(trampoline_sqrt(16.0), 40.0)
+        self.assertEqual(prefix_args, [16.0])
+        self.assertEqual(str(inspect.signature(trampoline_sqrt)), "(x, /)")
+
+        # A method of a C type is installed on the subclass, without affecting the base class
+        postfix(TrampolineTarget, "get", handler=self.patch_handler, inject=True)(my_postfix)
+        postfix(TrampolineTarget, "scaled", handler=self.patch_handler, inject=True)(my_postfix)
+
+        self.assertEqual(TrampolineTarget(a=2).get("a"), 20)
+        self.assertEqual(TrampolineTarget().get("b", 3), 30)
+        self.assertEqual({"a": 2}.get("a"), 2)
+        self.assertEqual(TrampolineTarget().scaled(3), 80)
+        self.assertEqual(pyharmony.reverse_patch(TrampolineTarget, "scaled")(3), 8)
+
+        # Unpatching puts the original attributes back
+        self.patch_handler.unpatch_all()
+
+        self.assertIs(trampoline_sqrt, math.sqrt)
+        self.assertNotIn("get", TrampolineTarget.__dict__)
+        self.assertIsInstance(TrampolineTarget.__dict__["scaled"], functools.partial)
+        self.assertEqual(TrampolineTarget().scaled(3), 8)
+
+
+
+
+    def test_descriptor_targets(self):
+        def total_postfix(__result: Ref) -> None:
+            __result.value += 100
+
+        def create_postfix(__result: Ref) -> None:
+            __result.value["patched"] = 0
+
+        original_property = TrampolineTarget.__dict__["total"]
+
+        postfix(TrampolineTarget, "total", handler=self.patch_handler, inject=True)(total_postfix)
+        postfix(TrampolineTarget, "create", handler=self.patch_handler, inject=True)(create_postfix)
+
+        # Python functions wrapped by descriptors are patched in place, without a trampoline
+        self.assertEqual(TrampolineTarget(a=1, b=2).total, 103)
+        self.assertEqual(TrampolineTarget.create(1), {"value": 1, "patched": 0})
+        self.assertIs(TrampolineTarget.__dict__["total"], original_property)
+
+        # Immutable types can't be patched, which is reported instead of leaving the target untouched
+        with self.assertRaisesRegex(ValueError, "builtin or immutable type"):
+            postfix(dict, "get", handler=self.patch_handler, inject=True)(total_postfix)
+
+        self.assertIsNone({}.get("a"))
+
+        self.patch_handler.unpatch_all()
+        self.assertEqual(TrampolineTarget(a=1, b=2).total, 3)
+
+
+
+
+    def test_state_objects(self):
+        seen = []
+
+        def object_prefix(state) -> None:
+            seen.append(type(state).__name__)
+            state.arg1 += 5
+
+        def dict_prefix(arg_obj: dict) -> None:
+            seen.append(dict(arg_obj))
+
+        def object_postfix(state) -> None:
+            state.result *= 2
+
+        prefix(thismodule, "test_function", handler=self.patch_handler, priority_hint=1, state_object=True)(object_prefix)
+        prefix(thismodule, "test_function", handler=self.patch_handler)(dict_prefix)
+        postfix(thismodule, "test_function", handler=self.patch_handler, state_object=True)(object_postfix)
+
+        # Hooks without state_object see the same values through a StateView
+        arg2 = pyHarmonyTests.getArg2()
+        self.assertEqual(test_function(100, arg2), 230)
+        self.assertEqual(seen, ["test_function_prefix_state", {"arg1": 105, "arg2": arg2}])
+
+        state_class = pyharmony.state.get_state_class("test_function_prefix", ("arg1", "arg2"))
+        self.assertFalse(hasattr(state_class(), "__dict__"))
+
+        # The result is only aliased if the target doesn't have a variable with the same name
+        state_object = pyharmony.state.get_state_class("test_function_postfix", ("result", "__result"))()
+        state_object.result = 1
+        self.assertFalse(hasattr(state_object, "__result"))
+
+        with self.assertRaises(ValueError):
+            Patch(thismodule, "test_function", inject=True, state_object=True, prefix_func=object_prefix)
+
+
+
+
+    def test_state_object_locals(self):
+        seen = []
+
+        def locals_postfix(state) -> None:
+            view = pyharmony.StateView(state)
+            seen.append((view.get("doubled"), view.get("positive"), view["__result"]))
+
+        def my_finalizer(state) -> None:
+            seen.append(state.exception)
+            state.result += 1
+
+        postfix(thismodule, "test_function_locals", handler=self.patch_handler, state_object=True)(locals_postfix)
+        finalizer(thismodule, "test_function_locals", handler=self.patch_handler, state_object=True)(my_finalizer)
+
+        # Locals that aren't assigned at a return are left unset, like missing keys of a state dictionary
+        self.assertEqual(test_function_locals(2), 5)
+        self.assertEqual(test_function_locals(-2), -3)
+        self.assertEqual(seen, [(None, True, 4), None, (-4, None, -4), None])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,253 @@
+"""
+Contains support for patching targets that aren't Python functions, such as builtins, methods of C extensions, descriptors and functools.partial objects.
+"""
+
+import builtins
+import functools
+import inspect
+import keyword
+import sys
+import types
+from typing import Callable, List, Optional, Tuple
+
+# Type flags, which aren't exposed by the inspect module
+_TPFLAGS_IMMUTABLETYPE = 1 << 8
+_TPFLAGS_HEAPTYPE = 1 << 9
+
+# Callables that are stored on the target object as is. They are called with the same arguments as the attribute, apart from method
+#   descriptors of C types, which take the instance as their first argument
+_UNBOUND_TYPES = (types.BuiltinFunctionType, types.MethodType, functools.partial)
+_METHOD_DESCRIPTOR_TYPES = (types.MethodDescriptorType, types.WrapperDescriptorType)
+
+_ORIGINAL_NAME = "_pyharmony_original"
+
+_MISSING = object()
+
+
+class Trampoline:
+    """
+    A Python function installed in place of a target that isn't one, which calls the original target.
+
+    Patches are assembled into the code of the trampoline like any other function, so the only extra cost is the frame of the trampoline itself.
+    It's only installed while the target has patches, otherwise the original attribute is put back.
+
+    function: The trampoline function.
+    original: The original attribute of the target object, as stored in its __dict__.
+    inherited: If true, the original attribute belongs to a base class of the target object, so it's deleted instead of being put back.
+    descriptor: The object that is installed on the target object, which is the trampoline wrapped in the same kind of descriptor as the original.
+    """
+
+    __slots__ = ("function", "original", "inherited", "descriptor")
+
+    def __init__(self, function: types.FunctionType, original: object, inherited: bool, descriptor: object) -> None:
+        self.function = function
+        self.original = original
+        self.inherited = inherited
+        self.descriptor = descriptor
+
+    def install(self, target_object: object, target_function_name: str) -> None:
+        if _get_static_attribute(target_object, target_function_name)[0] is not self.descriptor:
+            setattr(target_object, target_function_name, self.descriptor)
+
+    def uninstall(self, target_object: object, target_function_name: str) -> None:
+        # Leave the target alone if something else has replaced the trampoline since
+        if _get_static_attribute(target_object, target_function_name)[0] is not self.descriptor:
+            return
+
+        if self.inherited:
+            delattr(target_object, target_function_name)
+        else:
+            setattr(target_object, target_function_name, self.original)
+
+
+def get_wrapped_function(target_object: object, target_function_name: str) -> Optional[types.FunctionType]:
+    """
+    Returns the Python function wrapped by a classmethod, staticmethod or property (its getter), or None if the target isn't one of those.
+    The function is patched directly, so these don't need a trampoline.
+    """
+
+    attribute = _get_static_attribute(target_object, target_function_name)[0]
+
+    if isinstance(attribute, (classmethod, staticmethod)):
+        function = attribute.__func__
+    elif isinstance(attribute, property):
+        function = attribute.fget
+    else:
+        return None
+
+    return function if isinstance(function, types.FunctionType) else None
+
+
+def create_trampoline(target_object: object, target_function_name: str) -> Optional[Trampoline]:
+    """
+    Creates a trampoline for a target, or returns None if the target isn't something that a trampoline can be installed for.
+
+    The trampoline has the same parameters as the target (so that hooks can access them by name), as long as its signature can be introspected.
+    Otherwise it takes *args and **kwargs, and passes them on.
+    """
+
+    attribute, inherited = _get_static_attribute(target_object, target_function_name)
+
+    if attribute is _MISSING or not is_writable(target_object):
+        return None
+
+    is_type = isinstance(target_object, type)
+
+    if isinstance(attribute, (classmethod, staticmethod)):
+        original = attribute.__func__
+        wrap: Callable[[types.FunctionType], object] = type(attribute)
+    elif isinstance(attribute, property):
+        if attribute.fget is None:
+            return None
+
+        original = attribute.fget
+        wrap = attribute.getter
+    elif is_type and isinstance(attribute, types.ClassMethodDescriptorType):
+        # Takes the class as its first argument when called directly
+        original = attribute
+        wrap = classmethod
+    elif is_type and isinstance(attribute, _METHOD_DESCRIPTOR_TYPES):
+        # Python functions bind to instances the same way
+        original = attribute
+        wrap = _identity
+    elif isinstance(attribute, _UNBOUND_TYPES):
+        original = attribute
+
+        # Unlike Python functions, none of these bind to the instance when looked up through a class
+        wrap = staticmethod if is_type else _identity
+    else:
+        return None
+
+    function = _create_function(original, target_function_name)
+
+    return Trampoline(function, attribute, inherited, wrap(function))
+
+
+def _identity(function: types.FunctionType) -> types.FunctionType:
+    return function
+
+
+def _get_static_attribute(target_object: object, target_function_name: str) -> Tuple[object, bool]:
+    """
+    Returns an attribute of an object without invoking any descriptors, along with whether it was inherited from a base class.
+    Returns _MISSING if the object has no such attribute of its own (or of its classes, if the object is a class).
+    """
+
+    if isinstance(target_object, type):
+        for base in target_object.__mro__:
+            if target_function_name in base.__dict__:
+                return base.__dict__[target_function_name], base is not target_object
+
+        return _MISSING, False
+
+    instance_dict = getattr(target_object, "__dict__", None)
+
+    if isinstance(instance_dict, dict) and target_function_name in instance_dict:
+        return instance_dict[target_function_name], False
+
+    return _MISSING, False
+
+
+def is_writable(target_object: object) -> bool:
+    """
+    Returns whether a trampoline can be installed on an object. Builtin and immutable types don't allow setting their attributes.
+    """
+
+    if isinstance(target_object, type):
+        return bool(target_object.__flags__ & _TPFLAGS_HEAPTYPE) and not target_object.__flags__ & _TPFLAGS_IMMUTABLETYPE
+
+    return True
+
+
+def _get_parameters(original: Callable) -> Optional[List[inspect.Parameter]]:
+    """
+    Returns the parameters of a callable, or None if they can't be introspected or used as the parameters of a Python function.
+    """
+
+    try:
+        parameters = list(inspect.signature(original).parameters.values())
+    except (TypeError, ValueError):
+        return None
+
+    for parameter in parameters:
+        if not parameter.name.isidentifier() or keyword.iskeyword(parameter.name) or parameter.name == _ORIGINAL_NAME:
+            return None
+
+    return parameters
+
+
+def _create_function(original: Callable, target_function_name: str) -> types.FunctionType:
+    """
+    Creates a function that calls original with the same arguments it was called with.
+
+    The original is referenced through a closure variable rather than a constant, so the code of the trampoline can still be marshalled.
+    """
+
+    parameters = _get_parameters(original)
+
+    if parameters is None:
+        parameters = [inspect.Parameter("args", inspect.Parameter.VAR_POSITIONAL), inspect.Parameter("kwargs", inspect.Parameter.VAR_KEYWORD)]
+
+    definition = []
+    arguments = []
+    defaults = []
+    kwdefaults = {}
+
+    for index, parameter in enumerate(parameters):
+        kind = parameter.kind
+        text = parameter.name
+
+        if kind == inspect.Parameter.KEYWORD_ONLY and (index == 0 or parameters[index - 1].kind < inspect.Parameter.VAR_POSITIONAL):
+            definition.append("*")
+
+        if parameter.default is not inspect.Parameter.empty:
+            # Set afterwards, as the default might not have a usable repr
+            text += "=None"
+
+            if kind == inspect.Parameter.KEYWORD_ONLY:
+                kwdefaults[parameter.name] = parameter.default
+            else:
+                defaults.append(parameter.default)
+
+        if kind == inspect.Parameter.VAR_POSITIONAL:
+            definition.append("*" + text)
+            arguments.append("*" + text)
+        elif kind == inspect.Parameter.VAR_KEYWORD:
+            definition.append("**" + text)
+            arguments.append("**" + text)
+        elif kind == inspect.Parameter.KEYWORD_ONLY:
+            definition.append(text)
+            arguments.append(f"{parameter.name}={parameter.name}")
+        else:
+            definition.append(text)
+            arguments.append(parameter.name)
+
+        if kind == inspect.Parameter.POSITIONAL_ONLY and (index == len(parameters) - 1 or parameters[index + 1].kind != kind):
+            definition.append("/")
+
+    module_name = getattr(original, "__module__", None)
+    qualified_name = getattr(original, "__qualname__", target_function_name)
+    function_name = target_function_name if target_function_name.isidentifier() and not keyword.iskeyword(target_function_name) else "_pyharmony_trampoline"
+
+    source = (f"def _pyharmony_create_trampoline({_ORIGINAL_NAME}):\n"
+              f"    def {function_name}({', '.join(definition)}):\n"
+              f"        return {_ORIGINAL_NAME}({', '.join(arguments)})\n"
+              f"    return {function_name}\n")
+
+    # The file name is part of the key of the disk cache, so it has to tell apart trampolines for different targets
+    namespace = {"__builtins__": builtins}
+    exec(compile(source, f"<pyharmony trampoline for {module_name}.{qualified_name}>", "exec"), namespace)    # pylint: disable=exec-used
+
+    function = namespace["_pyharmony_create_trampoline"](original)
+
+    if sys.version_info >= (3, 11):
+        function.__code__ = function.__code__.replace(co_qualname=qualified_name)
+
+    function.__defaults__ = tuple(defaults) if len(defaults) > 0 else None
+    function.__kwdefaults__ = kwdefaults if len(kwdefaults) > 0 else None
+    function.__name__ = target_function_name
+    function.__qualname__ = qualified_name
+    function.__module__ = module_name
+    function.__doc__ = getattr(original, "__doc__", None)
+
+    return function